@@ -1,9 +1,15 @@
 import gradio as gr
 from ui_layout import create_ui
 import config_utils
+import comfy_utils
+import history_utils
+import history_export
+import thumbnail_manager
 import os
+import mimetypes
+import email.utils
 from fastapi import FastAPI, Request
-from fastapi.responses import Response
+from fastapi.responses import Response, FileResponse, RedirectResponse, StreamingResponse
 import requests
 import uvicorn
 import json
@@ -11,6 +17,15 @@ import json
 app = FastAPI()
 TTS_API_URL = "http://127.0.0.1:8000/generate-voice"
 
+# /thumb・/original で画像の場所を解決するための設定 (起動時に main で設定する)
+media_config = {}
+
+# サムネイルは履歴エントリごとに内容が変わらないので、ブラウザに長期キャッシュさせる
+THUMB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 元画像はバックアップ時に差し替わることがあるので、毎回 ETag で再検証させる
+ORIGINAL_CACHE_CONTROL = "public, no-cache"
+RANGE_CHUNK_SIZE = 64 * 1024
+
 @app.post("/api/tts")
 async def tts_proxy(request: Request):
     try:
@@ -21,8 +36,122 @@ async def tts_proxy(request: Request):
     except Exception as e:
         return Response(content=json.dumps({"error": str(e)}), status_code=500, media_type="application/json")
 
+def parse_range(range_header, size):
+    """Range ヘッダ (単一範囲のみ対応) を (開始, 終了) にする。対応しない・範囲外なら None"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:
+            # "bytes=-500" は末尾 500 バイト
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def iter_file_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def cached_file_response(request, path, cache_control, allow_range=False):
+    """ETag / Last-Modified 付きでファイルを返す。条件付きリクエストには 304、Range には 206 で応える"""
+    st = os.stat(path)
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            if int(st.st_mtime) <= email.utils.parsedate_to_datetime(request.headers["if-modified-since"]).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if allow_range:
+        headers["Accept-Ranges"] = "bytes"
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        # If-Range が現在の ETag と違えば (ファイルが変わっていれば) 全体を返す
+        if range_header and (not if_range or if_range.strip() == etag):
+            byte_range = parse_range(range_header, st.st_size)
+            if byte_range is None:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{st.st_size}"})
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(iter_file_range(path, start, end), status_code=206, headers=headers, media_type=media_type)
+    return FileResponse(path, headers=headers, media_type=media_type)
+
+@app.get("/thumb/{entry_id}")
+def serve_thumbnail(entry_id: str, request: Request):
+    entry = history_utils.find_history_entry(media_config, entry_id)
+    if entry is None:
+        return Response(status_code=404)
+    full_path, thumb_path = history_utils.get_thumbnail_target(entry, media_config)
+    if thumb_path is None:
+        # ローカルに無い画像 (ComfyUI の /view など) はそのまま転送する
+        return RedirectResponse(full_path) if full_path else Response(status_code=404)
+    if not os.path.exists(thumb_path):
+        # 作成中はプレースホルダーを返し、キャッシュさせない (作れなかった画像は 404)
+        if thumbnail_manager.request_thumbnail(full_path, thumb_path, history_utils.note_file_added) is None:
+            return Response(status_code=404, headers={"Cache-Control": "no-store"})
+        placeholder = thumbnail_manager.get_placeholder_path(os.path.dirname(thumb_path))
+        return FileResponse(placeholder, media_type="image/webp", headers={"Cache-Control": "no-store"})
+    return cached_file_response(request, thumb_path, THUMB_CACHE_CONTROL)
+
+@app.get("/original/{entry_id}")
+def serve_original(entry_id: str, request: Request):
+    entry = history_utils.find_history_entry(media_config, entry_id)
+    if entry is None:
+        return Response(status_code=404)
+    full_path = history_utils.resolve_image_path(entry, media_config)
+    if not full_path:
+        return Response(status_code=404)
+    if str(full_path).startswith("http"):
+        return RedirectResponse(full_path)
+    if not os.path.exists(full_path):
+        return Response(status_code=404)
+    return cached_file_response(request, full_path, ORIGINAL_CACHE_CONTROL, allow_range=True)
+
+@app.get("/export/{token}")
+def export_history(token: str):
+    """Export で選んだエントリの画像と設定を ZIP でストリーミングする (一時ファイルを作らない)"""
+    entry_ids = history_export.get_export_ids(token)
+    if entry_ids is None:
+        return Response(status_code=404)
+    filename = f"history_export_{len(entry_ids)}.zip"
+    return StreamingResponse(history_utils.iter_history_export(media_config, entry_ids), media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"})
+
 if __name__ == "__main__":
     config = config_utils.load_config()
+    media_config.update(config)
+    comfy_utils.configure_http_client(config)
+    history_utils.configure_history_store(config)
+    history_utils.configure_output_index(config)
+    history_utils.start_thumbnail_warmup(config)
     server_name = config.get("server_name")
     server_port = config.get("server_port")
     
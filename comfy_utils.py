@@ -1,10 +1,125 @@
 import json
+import copy
+import collections
+import hashlib
 import requests
 import time
 import io
 import traceback
 import os
+import uuid
+import urllib.parse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from requests.adapters import HTTPAdapter
+import system_manager
+
+try:
+    import websocket  # websocket-client
+except ImportError:
+    websocket = None
+
+# ジョブ1件あたりの最大待機時間 (秒)。config の "comfy_job_timeout" で上書き可能
+DEFAULT_JOB_TIMEOUT = 600
+
+# ComfyUI への HTTP 通信設定 (config の "comfy_http_pool_size" / "comfy_http_timeout" / "comfy_download_timeout")
+DEFAULT_HTTP_POOL_SIZE = 8
+DEFAULT_HTTP_TIMEOUT = 10
+DEFAULT_DOWNLOAD_TIMEOUT = 20
+
+_http_settings = {
+    "pool_size": DEFAULT_HTTP_POOL_SIZE,
+    "timeout": DEFAULT_HTTP_TIMEOUT,
+    "download_timeout": DEFAULT_DOWNLOAD_TIMEOUT,
+}
+_http_session = None
+_http_lock = threading.Lock()
+
+def configure_http_client(config):
+    """config の値で共有 HTTP クライアントを設定し直す (次回の呼び出しから反映)"""
+    global _http_session
+    with _http_lock:
+        _http_settings["pool_size"] = max(1, int(config.get("comfy_http_pool_size", DEFAULT_HTTP_POOL_SIZE)))
+        _http_settings["timeout"] = float(config.get("comfy_http_timeout", DEFAULT_HTTP_TIMEOUT))
+        _http_settings["download_timeout"] = float(config.get("comfy_download_timeout", DEFAULT_DOWNLOAD_TIMEOUT))
+        if _http_session is not None:
+            _http_session.close()
+        _http_session = None
+
+def get_http_session():
+    """
+    ComfyUI 呼び出しで共有する requests.Session を返す。
+    Keep-Alive でコネクションをプールするため、ポーリングやダウンロードの度に TCP 接続を張り直さない。
+    """
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            pool_size = _http_settings["pool_size"]
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+def http_get(url, **kwargs):
+    """共有セッションでの GET。timeout 未指定時は comfy_http_timeout を使う"""
+    kwargs.setdefault("timeout", _http_settings["timeout"])
+    return get_http_session().get(url, **kwargs)
+
+def http_post(url, **kwargs):
+    """共有セッションでの POST。timeout 未指定時は comfy_http_timeout を使う"""
+    kwargs.setdefault("timeout", _http_settings["timeout"])
+    return get_http_session().post(url, **kwargs)
+
+# バックエンド選択時のヘルスチェック・キュー取得のタイムアウト (秒)
+BACKEND_PROBE_TIMEOUT = 2
+
+def get_backend_urls(primary_url, config):
+    """メインの ComfyUI URL と config の "comfy_backends" を合わせたバックエンド一覧 (重複除去・順序維持)"""
+    urls = []
+    for url in [primary_url] + list(config.get("comfy_backends", []) or []):
+        url = str(url or "").strip().rstrip("/")
+        if url and url not in urls:
+            urls.append(url)
+    return urls
+
+def get_backend_load(comfy_url):
+    """
+    バックエンドの負荷 (実行中 + 待機中のジョブ数) を返す。
+    ポートが閉じている・/queue に応答しない場合は None (= 利用不可)
+    """
+    parsed = urllib.parse.urlparse(comfy_url)
+    if not system_manager.check_comfy_status(parsed.hostname or "127.0.0.1", parsed.port or 8188):
+        return None
+    try:
+        r = http_get(f"{comfy_url}/queue", timeout=BACKEND_PROBE_TIMEOUT)
+        r.raise_for_status()
+        queue = r.json()
+        return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+    except Exception as e:
+        print(f"⚠️ Backend {comfy_url} did not answer /queue: {e}")
+        return None
+
+def select_backend(primary_url, config):
+    """
+    バックエンドプールから最も空いている (キューが短い) 正常なバックエンドの URL を返す。
+    同じ負荷なら一覧の前にあるもの (メインの URL) を優先する。
+    プール未設定時はチェックせずにメインの URL をそのまま返し、全滅時もメインの URL を返して通常のエラー表示に任せる。
+    """
+    urls = get_backend_urls(primary_url, config)
+    if len(urls) <= 1:
+        return urls[0] if urls else str(primary_url).strip().rstrip("/")
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        loads = list(pool.map(get_backend_load, urls))
+
+    candidates = [(load, i) for i, load in enumerate(loads) if load is not None]
+    if not candidates:
+        print("⚠️ No healthy ComfyUI backend found. Falling back to the primary URL.")
+        return urls[0]
+    return urls[min(candidates)[1]]
 
 def load_workflow(workflow_path):
     """ワークフローJSONファイルを読み込む"""
@@ -14,63 +129,179 @@ def load_workflow(workflow_path):
     except FileNotFoundError:
         return None
 
-def run_comfy_api(workflow, comfy_url):
+def run_comfy_api(workflow, comfy_url, timeout=DEFAULT_JOB_TIMEOUT, local_output_dir=None):
     """
     ComfyUIにジョブを送信し、完了を待って画像を取得する。
     【v1.4.1 改良】特定のノードID(52等)への依存を完全に排除。
+    完了検知は WebSocket (/ws) のイベントで行い、使えない場合のみ /history のポーリングに切り替える。
+    timeout 秒を超えた場合は RuntimeError を送出し、Gradio のワーカーが無限に待たないようにする。
+    local_output_dir を指定すると、そこに保存された画像はダウンロードせずファイルパスで返す。
+    """
+    job = submit_prompt(workflow, comfy_url)
+    outputs = wait_for_job(job, timeout)
+    return fetch_output_image(job, outputs, local_output_dir)
+
+def submit_prompt(workflow, comfy_url, owner=None):
     """
-    # 1. ジョブの送信
+    ComfyUIにジョブを送信し、完了待ちに必要な情報 (job) を返す。
+    送信前にイベントストリームへ接続しておくことで完了通知の取りこぼしを防ぐ。
+    Auto Gen のパイプライン実行では、複数の job を送信してから順に wait_for_job する。
+    owner (Gradio のセッションID等) を指定すると、cancel_owner_jobs でまとめて中止できるよう登録される。
+    """
+    client_id = uuid.uuid4().hex
+    ws = open_event_socket(comfy_url, client_id)
+    job = {"comfy_url": comfy_url, "client_id": client_id, "ws": ws, "prompt_id": None,
+           "owner": owner, "cancel_event": threading.Event()}
+
     try:
-        payload = {"prompt": workflow}
-        r = requests.post(f"{comfy_url}/prompt", json=payload, timeout=10)
+        payload = {"prompt": workflow, "client_id": client_id}
+        r = http_post(f"{comfy_url}/prompt", json=payload)
         r.raise_for_status()
-        prompt_id = r.json()["prompt_id"]
+        job["prompt_id"] = r.json()["prompt_id"]
+        register_job(job)
+        return job
     except requests.exceptions.HTTPError as e:
+        close_job(job)
+        # 参照画像が見つからない等の検証エラーに備え、次回は画像をアップロードし直す
+        invalidate_upload_cache(comfy_url)
         print(f"\n[ERROR] ComfyUI Prompt API HTTP Error: {e}")
         print(f"[ERROR] Response Details: {e.response.text}")
         raise RuntimeError(f"ComfyUI API Error: {e}")
     except Exception as e:
+        close_job(job)
+        # 接続できない = ComfyUI が停止・再起動中の可能性があるため、アップロード済みの情報は破棄する
+        invalidate_upload_cache(comfy_url)
         traceback.print_exc()
         raise RuntimeError(f"ComfyUIへの接続に失敗しました: {e}")
 
-    # 2. 実行完了のポーリング
-    while True:
+def wait_for_job(job, timeout=DEFAULT_JOB_TIMEOUT):
+    """
+    送信済み job の完了を待ち、/history と同じ形式の outputs を返す。
+    WebSocket を優先し、使えない場合は /history のポーリングに切り替える。
+    """
+    for event in iter_job_events(job, timeout):
+        if event[0] == "done":
+            return event[1]
+
+def iter_job_events(job, timeout=DEFAULT_JOB_TIMEOUT, preview_interval=None):
+    """
+    送信済み job の進行状況を順に yield するジェネレーター。
+      ("progress", 現在のステップ, 総ステップ数)
+      ("preview", PIL画像)          ... preview_interval 秒に1回まで (None ならプレビューはデコードしない)
+      ("done", outputs)             ... 最後に必ず1回
+    WebSocket が使えない場合は /history のポーリングで完了だけを通知する。
+    """
+    deadline = time.time() + float(timeout)
+    try:
+        outputs = None
+        cancel_event = job.get("cancel_event")
+        if job.get("ws") is not None:
+            for event in iter_prompt_events(job["ws"], job["prompt_id"], deadline, cancel_event, preview_interval):
+                if event[0] == "done":
+                    outputs = event[1]
+                    break
+                yield event
+        if outputs is None:
+            outputs = wait_for_prompt_polling(job["comfy_url"], job["prompt_id"], deadline, cancel_event)
+        yield ("done", outputs)
+    finally:
+        close_job(job)
+
+def close_job(job):
+    """job が保持しているイベントストリームを閉じ、中止対象の登録から外す"""
+    unregister_job(job)
+    ws = job.get("ws")
+    job["ws"] = None
+    if ws is not None:
         try:
-            h_res = requests.get(f"{comfy_url}/history/{prompt_id}", timeout=5)
-            h_res.raise_for_status()
-            history = h_res.json()
-            if prompt_id in history:
-                break
-            time.sleep(0.5)
+            ws.close()
         except Exception:
-            time.sleep(1)
+            pass
+
+# --- ジョブのキャンセル ---
+# owner (Gradio のセッション) ごとに、送信済みで完了していないジョブを記録する
+_active_jobs = {}
+_jobs_lock = threading.Lock()
 
-    # 3. 出力画像の情報を特定 (ID指定ではなく、中身を走査して特定)
-    outputs = history[prompt_id].get("outputs", {})
-    target_img_info = None
+def register_job(job):
+    if job.get("owner") is None:
+        return
+    with _jobs_lock:
+        _active_jobs.setdefault(job["owner"], {})[job["prompt_id"]] = job
 
-    # すべての出力ノードを確認し、最初に画像(images)を持っているものを採用する
-    # これにより SaveImage ノードの番号が何番であっても動作する
+def unregister_job(job):
+    if job.get("owner") is None:
+        return
+    with _jobs_lock:
+        jobs = _active_jobs.get(job["owner"])
+        if jobs is not None:
+            jobs.pop(job.get("prompt_id"), None)
+            if not jobs:
+                del _active_jobs[job["owner"]]
+
+def is_cancelled(job):
+    cancel_event = job.get("cancel_event")
+    return cancel_event is not None and cancel_event.is_set()
+
+def cancel_job(job):
+    """
+    ジョブを中止する。実行中なら /interrupt、キュー待ちなら /queue から削除し、
+    wait_for_job で待っているスレッドにも中止を通知する。
+    /interrupt は古い ComfyUI では実行中のプロンプトを無条件に止めるため、自分のジョブが実行中の時だけ送る。
+    """
+    if job.get("cancel_event") is not None:
+        job["cancel_event"].set()
+    prompt_id = job.get("prompt_id")
+    if not prompt_id:
+        return
+    comfy_url = job["comfy_url"]
+    try:
+        r = http_get(f"{comfy_url}/queue", timeout=BACKEND_PROBE_TIMEOUT)
+        r.raise_for_status()
+        queue = r.json()
+        running = {item[1] for item in queue.get("queue_running", []) if len(item) > 1}
+        pending = {item[1] for item in queue.get("queue_pending", []) if len(item) > 1}
+        if prompt_id in running:
+            http_post(f"{comfy_url}/interrupt", json={"prompt_id": prompt_id})
+        elif prompt_id in pending:
+            http_post(f"{comfy_url}/queue", json={"delete": [prompt_id]})
+    except Exception as e:
+        print(f"⚠️ Failed to cancel ComfyUI prompt {prompt_id}: {e}")
+
+def cancel_owner_jobs(owner):
+    """owner が送信した未完了のジョブをすべて中止し、中止した件数を返す"""
+    if owner is None:
+        return 0
+    with _jobs_lock:
+        jobs = list(_active_jobs.get(owner, {}).values())
+    for job in jobs:
+        cancel_job(job)
+    return len(jobs)
+
+def find_output_images(outputs):
+    """
+    outputs から保存画像の情報 (filename/subfolder/type) のリストを返す。
+    ID指定ではなく中身を走査し、最初に画像(images)を持っている出力ノードを採用する。
+    これにより SaveImage ノードの番号が何番であっても動作する。
+    """
     for node_id in outputs:
         if "images" in outputs[node_id] and len(outputs[node_id]["images"]) > 0:
-            target_img_info = outputs[node_id]["images"][0]
-            break
-
-    if not target_img_info:
-        raise RuntimeError("出力画像が見つかりませんでした。ワークフローに 'Save Image' ノードが含まれているか確認してください。")
-
-    # 4. 画像データの取得
-    view_params = {
-        "filename": target_img_info["filename"],
-        "subfolder": target_img_info.get("subfolder", ""),
-        "type": target_img_info.get("type", "output")
-    }
-    
+            return [
+                {
+                    "filename": img_info["filename"],
+                    "subfolder": img_info.get("subfolder", ""),
+                    "type": img_info.get("type", "output")
+                }
+                for img_info in outputs[node_id]["images"]
+            ]
+    raise RuntimeError("出力画像が見つかりませんでした。ワークフローに 'Save Image' ノードが含まれているか確認してください。")
+
+def download_image(comfy_url, view_params):
+    """/view から画像をダウンロードして PIL 画像を返す"""
     try:
-        img_res = requests.get(f"{comfy_url}/view", params=view_params, timeout=20)
+        img_res = http_get(f"{comfy_url}/view", params=view_params, timeout=_http_settings["download_timeout"])
         img_res.raise_for_status()
-        img_obj = Image.open(io.BytesIO(img_res.content)).convert("RGB")
-        return img_obj, view_params
+        return Image.open(io.BytesIO(img_res.content)).convert("RGB")
     except requests.exceptions.HTTPError as e:
         print(f"\n[ERROR] ComfyUI View API HTTP Error: {e}")
         print(f"[ERROR] Response Details: {e.response.text}")
@@ -79,6 +310,165 @@ def run_comfy_api(workflow, comfy_url):
         traceback.print_exc()
         raise RuntimeError(f"画像の取得に失敗しました: {e}")
 
+def find_local_output(output_dir, view_params):
+    """
+    ComfyUI の出力フォルダがローカルにある場合、保存画像のファイルパスを返す。見つからなければ None
+    (type が output 以外の一時画像や、別マシンのバックエンドの出力は対象外)
+    """
+    if not output_dir or view_params.get("type", "output") != "output":
+        return None
+    path = os.path.join(output_dir, view_params.get("subfolder", ""), view_params["filename"])
+    return path if os.path.isfile(path) else None
+
+def fetch_image(comfy_url, view_params, local_output_dir=None):
+    """
+    保存画像を取得する。ローカルの出力フォルダにあればファイルパスをそのまま返し (デコードは使う側で必要な時だけ行う)、
+    なければ /view からダウンロードして PIL 画像を返す。
+    """
+    local_path = find_local_output(local_output_dir, view_params)
+    if local_path:
+        return local_path
+    return download_image(comfy_url, view_params)
+
+def fetch_output_image(job, outputs, local_output_dir=None):
+    """outputs の最初の保存画像を取得して (PIL画像 または ファイルパス, view_params) を返す"""
+    view_params = find_output_images(outputs)[0]
+    return fetch_image(job["comfy_url"], view_params, local_output_dir), view_params
+
+def fetch_output_images(job, outputs, local_output_dir=None):
+    """
+    outputs の保存画像をすべて取得し、[(PIL画像 または ファイルパス, view_params), ...] をバッチ内の順番で返す。
+    local_output_dir にファイルがあればそのパスを使い、HTTP での再転送とデコードを省く。
+    ダウンロードが必要な画像が複数ある場合は共有セッションのプール内で並列に取得する。
+    """
+    image_infos = find_output_images(outputs)
+    if len(image_infos) == 1:
+        return [(fetch_image(job["comfy_url"], image_infos[0], local_output_dir), image_infos[0])]
+
+    workers = min(len(image_infos), _http_settings["pool_size"])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        images = list(pool.map(lambda info: fetch_image(job["comfy_url"], info, local_output_dir), image_infos))
+    return list(zip(images, image_infos))
+
+def open_event_socket(comfy_url, client_id):
+    """ComfyUIのイベントストリーム (/ws?clientId=) に接続する。利用できない場合は None を返す"""
+    if websocket is None:
+        return None
+    parsed = urllib.parse.urlparse(comfy_url)
+    scheme = "wss" if parsed.scheme == "https" else "ws"
+    ws_url = f"{scheme}://{parsed.netloc}{parsed.path}/ws?clientId={client_id}"
+    try:
+        return websocket.create_connection(ws_url, timeout=5)
+    except Exception as e:
+        print(f"⚠️ ComfyUI WebSocket unavailable ({e}), falling back to /history polling.")
+        return None
+
+# ComfyUI のバイナリフレームの種類 (先頭4バイト)
+PREVIEW_IMAGE = 1
+PREVIEW_IMAGE_WITH_METADATA = 4
+
+def decode_preview_frame(message):
+    """ComfyUI のプレビュー用バイナリフレームを PIL 画像にする。プレビュー以外・壊れたデータは None"""
+    if len(message) < 8:
+        return None
+    frame_type = int.from_bytes(message[:4], "big")
+    if frame_type == PREVIEW_IMAGE:
+        # [種類 4byte][画像形式 4byte][JPEG/PNG]
+        image_bytes = message[8:]
+    elif frame_type == PREVIEW_IMAGE_WITH_METADATA:
+        # [種類 4byte][メタデータ長 4byte][メタデータJSON][画像]
+        metadata_length = int.from_bytes(message[4:8], "big")
+        image_bytes = message[8 + metadata_length:]
+    else:
+        return None
+    try:
+        return Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    except Exception:
+        return None
+
+def iter_prompt_events(ws, prompt_id, deadline, cancel_event=None, preview_interval=None):
+    """
+    WebSocket のイベントを読み、prompt_id の進行状況を yield する (形式は iter_job_events と同じ)。
+    SaveImage ノードの executed を受け取った時点で ("done", outputs) を返して終わる。
+    接続が切れた場合など、判定できなかったときは ("done", None) を返す (呼び出し側でポーリングに切り替える)。
+    cancel_event がセットされたら RuntimeError で待機を打ち切る。
+    """
+    outputs = {}
+    last_preview = 0.0
+    while True:
+        if cancel_event is not None and cancel_event.is_set():
+            raise RuntimeError("生成はキャンセルされました。")
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RuntimeError(f"ComfyUIの処理がタイムアウトしました (prompt_id: {prompt_id})")
+        try:
+            ws.settimeout(min(remaining, 1.0))
+            message = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            continue
+        except Exception as e:
+            print(f"⚠️ ComfyUI WebSocket closed ({e}), falling back to /history polling.")
+            yield ("done", None)
+            return
+
+        # バイナリフレーム (プレビュー画像) は完了判定には使わない。
+        # この接続の clientId で送信したジョブのものしか届かないので prompt_id の確認は不要
+        if not isinstance(message, str):
+            if preview_interval is not None and time.time() - last_preview >= preview_interval:
+                preview = decode_preview_frame(message)
+                if preview is not None:
+                    last_preview = time.time()
+                    yield ("preview", preview)
+            continue
+        try:
+            event = json.loads(message)
+        except ValueError:
+            continue
+
+        data = event.get("data", {})
+        if not isinstance(data, dict):
+            continue
+        event_type = event.get("type")
+        # 古い ComfyUI の progress には prompt_id が含まれない
+        if event_type == "progress" and data.get("prompt_id", prompt_id) == prompt_id:
+            yield ("progress", int(data.get("value", 0)), int(data.get("max", 0)))
+            continue
+        if data.get("prompt_id") != prompt_id:
+            continue
+
+        if event_type == "executed":
+            node_output = data.get("output") or {}
+            outputs[str(data.get("node"))] = node_output
+            images = node_output.get("images") or []
+            if any(img.get("type", "output") == "output" for img in images):
+                yield ("done", outputs)
+                return
+        elif event_type == "executing" and data.get("node") is None:
+            # 全ノード実行完了。executed が届かなかった場合は None を返し /history から取得させる
+            yield ("done", outputs if outputs else None)
+            return
+        elif event_type == "execution_error":
+            msg = data.get("exception_message", "unknown error")
+            raise RuntimeError(f"ComfyUIの実行中にエラーが発生しました: {msg}")
+        elif event_type == "execution_interrupted":
+            raise RuntimeError("ComfyUIの処理が中断されました。")
+
+def wait_for_prompt_polling(comfy_url, prompt_id, deadline, cancel_event=None):
+    """/history/{prompt_id} をポーリングして完了を待つ (WebSocket が使えない場合のフォールバック)"""
+    while time.time() < deadline:
+        if cancel_event is not None and cancel_event.is_set():
+            raise RuntimeError("生成はキャンセルされました。")
+        try:
+            h_res = http_get(f"{comfy_url}/history/{prompt_id}")
+            h_res.raise_for_status()
+            history = h_res.json()
+            if prompt_id in history:
+                return history[prompt_id].get("outputs", {})
+            time.sleep(0.5)
+        except Exception:
+            time.sleep(1)
+    raise RuntimeError(f"ComfyUIの処理がタイムアウトしました (prompt_id: {prompt_id})")
+
 def find_node_by_title(workflow, title):
     """
     ノードの _meta データの title 文字列からノードIDを探す
@@ -88,26 +478,152 @@ def find_node_by_title(workflow, title):
             return node_id
     return None
 
-def get_upstream_lora_count(workflow, lora_nodes, nid, visited=None):
+def get_upstream_counts(workflow, counted_nodes):
+    """
+    ワークフローをトポロジカル順に一度だけ走査し、各ノードの上流に counted_nodes が
+    最大何個連なっているか (チェーンの深さ) を O(V+E) で求めて {ノードID: 深さ} を返す。
+    循環参照があった場合、循環に含まれるノードは深さ 0 のまま残る。
+    """
+    children = {nid: [] for nid in workflow}
+    indegree = {nid: 0 for nid in workflow}
+    for nid, node in workflow.items():
+        if not isinstance(node, dict): continue
+        for value in node.get("inputs", {}).values():
+            if isinstance(value, list) and len(value) >= 1:
+                source_id = str(value[0])
+                if source_id in children:
+                    children[source_id].append(nid)
+                    indegree[nid] += 1
+
+    depths = {nid: 0 for nid in workflow}
+    ready = collections.deque(nid for nid, count in indegree.items() if count == 0)
+    while ready:
+        nid = ready.popleft()
+        depth = depths[nid] + (1 if nid in counted_nodes else 0)
+        for child in children[nid]:
+            if depth > depths[child]:
+                depths[child] = depth
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                ready.append(child)
+    return depths
+
+def order_lora_chain(workflow, lora_nodes):
+    """LoRA ノードを上流の LoRA 数が少ない順 (Checkpoint に近い順) に並べて返す"""
+    depths = get_upstream_counts(workflow, lora_nodes)
+    return sorted((nid for nid in workflow if nid in lora_nodes), key=lambda nid: depths[nid])
+
+# generation_manager が値を流し込むノードの初期タイトル (anima-t2i.json に準拠)
+NODE_TITLES = {
+    "positive": "CLIP Text Encode (Positive Prompt)",
+    "negative": "CLIP Text Encode (Negative Prompt)",
+    "latent": "空の潜在画像",
+    "sampler": "Kサンプラー",
+    "save": "画像を保存",
+}
+
+_compiled_workflows = {}
+_compiled_lock = threading.Lock()
+
+def compile_workflow(workflow):
+    """
+    ワークフローを一度だけ走査し、ノード特定用のインデックスを持つ「コンパイル済みワークフロー」を返す。
+    - titles  : タイトル → ノードID (最初に見つかったもの)
+    - classes : class_type → ノードIDのリスト
+    - nodes   : generation_manager が使う役割名 → ノードID
+    - lora_chain : Checkpoint に近い順に並べた LoRA ノードID
+    テンプレート (template) は書き換えず、生成ごとに instantiate_workflow でコピーして使う。
+    """
+    titles = {}
+    classes = {}
+    for nid, node in workflow.items():
+        if not isinstance(node, dict): continue
+        title = node.get("_meta", {}).get("title")
+        if title is not None and title not in titles:
+            titles[title] = nid
+        classes.setdefault(node.get("class_type", ""), []).append(nid)
+
+    def first_by_class(match):
+        for class_type, ids in classes.items():
+            if match(class_type):
+                return ids[0]
+        return None
+
+    nodes = {role: titles.get(title) for role, title in NODE_TITLES.items()}
+
+    # モデルノード ("Load Checkpoint" や "拡散モデルを読み込む" などのタイトル、またはクラス名で探す)
+    nodes["ckpt"] = titles.get("Load Checkpoint") or titles.get("拡散モデルを読み込む") or \
+        first_by_class(lambda c: c in ["CheckpointLoaderSimple", "UNETLoader"])
+    nodes["negpip"] = titles.get("NegPiP") or first_by_class(lambda c: "NegPiP" in c or "negpip" in c.lower())
+    nodes["lllite"] = titles.get("LLLite") or first_by_class(lambda c: "LLLite" in c or "lllite" in c.lower())
+
+    # LLLite の参照画像を読み込む LoadImage (上流を優先、なければ最初の LoadImage)
+    nodes["lllite_image"] = None
+    if nodes["lllite"]:
+        nodes["lllite_image"] = find_upstream_node(workflow, nodes["lllite"], "LoadImage") or \
+            (classes.get("LoadImage") or [None])[0]
+
+    # ワークフロー内のLoRAノード (クラス名またはタイトルで判定) を接続順に並べる
+    lora_nodes = set()
+    for nid, node in workflow.items():
+        if not isinstance(node, dict): continue
+        if "LoraLoader" in node.get("class_type", "") or "LoRA" in node.get("_meta", {}).get("title", ""):
+            lora_nodes.add(nid)
+    lora_chain = order_lora_chain(workflow, lora_nodes)
+
+    return {"template": workflow, "titles": titles, "classes": classes, "nodes": nodes, "lora_chain": lora_chain}
+
+def find_upstream_node(workflow, node_id, class_type, visited=None):
+    """node_id から入力を遡り、最初に見つかった class_type のノードIDを返す"""
     if visited is None:
         visited = set()
-    if nid in visited:
-        return 0
-    visited.add(nid)
-    
-    node = workflow.get(str(nid), {})
-    inputs = node.get("inputs", {})
-    
-    max_count = 0
-    for key, value in inputs.items():
-        if isinstance(value, list) and len(value) >= 1:
-            source_id = str(value[0])
-            count = get_upstream_lora_count(workflow, lora_nodes, source_id, visited)
-            if source_id in lora_nodes:
-                count += 1
-            if count > max_count:
-                max_count = count
-    return max_count
+    node_id = str(node_id)
+    if node_id in visited:
+        return None
+    visited.add(node_id)
+    node = workflow.get(node_id, {})
+    if node.get("class_type") == class_type:
+        return node_id
+    for k, v in node.get("inputs", {}).items():
+        if isinstance(v, list) and len(v) == 2:
+            found = find_upstream_node(workflow, v[0], class_type, visited)
+            if found:
+                return found
+    return None
+
+def get_compiled_workflow(workflow_path):
+    """
+    コンパイル済みワークフローを返す。ファイルごとに一度だけ構築し、更新日時 (mtime) が変わったら作り直す。
+    ファイルが無い・読み込めない場合は None を返す。
+    """
+    if not workflow_path:
+        return None
+    try:
+        key = os.path.abspath(workflow_path)
+        mtime = os.path.getmtime(key)
+    except OSError:
+        return None
+
+    with _compiled_lock:
+        cached = _compiled_workflows.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+    try:
+        workflow = load_workflow(workflow_path)
+    except ValueError as e:
+        print(f"⚠️ Failed to parse workflow {workflow_path}: {e}")
+        return None
+    if not workflow:
+        return None
+    compiled = compile_workflow(workflow)
+    with _compiled_lock:
+        _compiled_workflows[key] = (mtime, compiled)
+    return compiled
+
+def instantiate_workflow(compiled):
+    """コンパイル済みワークフローから、値を書き換えてよい送信用のコピーを作る"""
+    return copy.deepcopy(compiled["template"])
 
 def extract_default_settings(workflow_file, ckpt_files, lora_files, lllite_files):
     default_ckpt = "None"
@@ -117,17 +633,12 @@ def extract_default_settings(workflow_file, ckpt_files, lora_files, lllite_files
     if not workflow_file or not os.path.exists(workflow_file):
         return default_ckpt, default_loras, default_lllite
 
-    workflow = load_workflow(workflow_file)
-    if not workflow:
+    compiled = get_compiled_workflow(workflow_file)
+    if not compiled:
         return default_ckpt, default_loras, default_lllite
+    workflow = compiled["template"]
 
-    ckpt_node_id = find_node_by_title(workflow, "拡散モデルを読み込む") or find_node_by_title(workflow, "Load Checkpoint")
-    if not ckpt_node_id:
-        for nid, node in workflow.items():
-            class_type = node.get("class_type", "") if isinstance(node, dict) else ""
-            if class_type in ["CheckpointLoaderSimple", "UNETLoader"]:
-                ckpt_node_id = nid
-                break
+    ckpt_node_id = compiled["nodes"]["ckpt"]
     if ckpt_node_id:
         inputs = workflow[ckpt_node_id].get("inputs", {})
         default_ckpt = inputs.get("unet_name", inputs.get("ckpt_name", "None"))
@@ -135,18 +646,7 @@ def extract_default_settings(workflow_file, ckpt_files, lora_files, lllite_files
             ckpt_files.append(default_ckpt)
             ckpt_files.sort()
 
-    lora_nodes = set()
-    for nid, node in workflow.items():
-        if not isinstance(node, dict): continue
-        class_type = node.get("class_type", "")
-        title = node.get("_meta", {}).get("title", "")
-        if "LoraLoader" in class_type or "LoRA" in title:
-            lora_nodes.add(nid)
-            
-    sorted_loras = list(lora_nodes)
-    sorted_loras.sort(key=lambda nid: get_upstream_lora_count(workflow, lora_nodes, nid))
-    
-    for i, nid in enumerate(sorted_loras):
+    for i, nid in enumerate(compiled["lora_chain"]):
         if i >= 5: break
         inputs = workflow[nid].get("inputs", {})
         l_name = inputs.get("lora_name", "None")
@@ -157,13 +657,7 @@ def extract_default_settings(workflow_file, ckpt_files, lora_files, lllite_files
             lora_files.append(l_name)
     lora_files.sort()
 
-    lllite_node_id = find_node_by_title(workflow, "LLLite")
-    if not lllite_node_id:
-        for nid, node in workflow.items():
-            class_type = node.get("class_type", "") if isinstance(node, dict) else ""
-            if "LLLite" in class_type or "lllite" in class_type.lower():
-                lllite_node_id = nid
-                break
+    lllite_node_id = compiled["nodes"]["lllite"]
     if lllite_node_id:
         inputs = workflow[lllite_node_id].get("inputs", {})
         l_model = inputs.get("model_name", "None")
@@ -180,16 +674,74 @@ def extract_default_settings(workflow_file, ckpt_files, lora_files, lllite_files
 
     return default_ckpt, default_loras, default_lllite
 
+# LLLite 参照画像のアップロードキャッシュ
+# (内容のハッシュ, ComfyUI URL) → サーバー側のファイル名。同じ画像の再アップロードを省く
+_upload_cache = {}
+_file_digest_cache = {}  # 絶対パス → (mtime_ns, サイズ, ハッシュ)
+_image_size_cache = {}   # ハッシュ → (幅, 高さ)
+_upload_lock = threading.Lock()
+
+def file_digest(file_path):
+    """ファイル内容の SHA-256 を返す。更新日時とサイズが変わらない限り再計算しない"""
+    path = os.path.abspath(file_path)
+    st = os.stat(path)
+    with _upload_lock:
+        cached = _file_digest_cache.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _upload_lock:
+        _file_digest_cache[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+def get_image_size(file_path):
+    """画像の (幅, 高さ) を返す。同じ内容の画像はデコードせずキャッシュから返す"""
+    digest = file_digest(file_path)
+    with _upload_lock:
+        size = _image_size_cache.get(digest)
+    if size is None:
+        with Image.open(file_path) as img:
+            size = img.size
+        with _upload_lock:
+            _image_size_cache[digest] = size
+    return size
+
+def invalidate_upload_cache(comfy_url=None):
+    """アップロード済みファイル名のキャッシュを破棄する (ComfyUI の再起動・接続断を検知したとき)"""
+    with _upload_lock:
+        if comfy_url is None:
+            _upload_cache.clear()
+        else:
+            for key in [k for k in _upload_cache if k[1] == comfy_url]:
+                del _upload_cache[key]
+
 def upload_image(file_path, comfy_url):
-    """Gradioで取得した画像をComfyUIにアップロードし、ファイル名を返す"""
+    """
+    Gradioで取得した画像をComfyUIにアップロードし、ファイル名を返す。
+    内容が同じ画像は、同じ ComfyUI に対して一度だけアップロードし、以降は前回のファイル名を再利用する。
+    """
     if not file_path or not os.path.exists(file_path):
         return None
     try:
+        key = (file_digest(file_path), comfy_url)
+        with _upload_lock:
+            cached_name = _upload_cache.get(key)
+        if cached_name:
+            return cached_name
+
         with open(file_path, "rb") as f:
             files = {"image": f}
-            res = requests.post(f"{comfy_url}/upload/image", files=files, timeout=10)
+            res = http_post(f"{comfy_url}/upload/image", files=files)
             res.raise_for_status()
-            return res.json()["name"]
+            name = res.json()["name"]
+        with _upload_lock:
+            _upload_cache[key] = name
+        return name
     except Exception as e:
         print(f"⚠️ Failed to upload image: {e}")
         return None
\ No newline at end of file
@@ -13,10 +13,25 @@ DEFAULT_CONFIG = {
     "server_name": "0.0.0.0",
     "server_port": 7861,
     "comfy_url": "http://127.0.0.1:8188",
+    "comfy_backends": [], # 追加の ComfyUI URL のリスト。comfy_url と合わせたプールから最も空いているものに送信する
+    "comfy_job_timeout": 600, # ジョブ1件あたりの最大待機秒数 (超過時はエラーにしてワーカーを解放)
+    "comfy_http_pool_size": 8, # ComfyUI との Keep-Alive 接続プールのサイズ
+    "comfy_http_timeout": 10, # API 呼び出し (送信・ポーリング・アップロード) のタイムアウト秒数
+    "comfy_download_timeout": 20, # /view からの画像ダウンロードのタイムアウト秒数
+    "live_preview_interval": 0.5, # 生成中のプレビュー画像を Generate タブに送る最短間隔 (秒)
     "workflow_file": "anima-t2i.json",
     "launch_bat": "",
     "comfy_output_dir": "", # 【追加】ComfyUIの本来のOutputパスを明示指定
     "backup_output_dir": "", 
+    "output_index_ttl": 2, # 出力フォルダのファイル一覧を再確認する間隔 (秒)。変更がなければ再スキャンしない
+    "thumbnail_warmup": True, # 起動時に足りない履歴サムネイルをバックグラウンドで作成する
+    "thumbnail_workers": 0, # サムネイル作成のワーカープロセス数 (0 で CPU コア数 - 1)
+    "history_backend": "jsonl", # 履歴の保存形式: "jsonl" (history.json + 追記ログ) / "sqlite" (history_db_path の DB)
+    "history_db_path": "history.db",
+    "history_compact_threshold": 1000, # 履歴の追記ログ (history.jsonl) がこの件数を超えたら history.json にまとめ直す
+    "history_write_delay": 0.2, # 履歴の変更をまとめてファイルに書き込むまでの待ち時間 (秒)
+    "history_ingest_workers": 0, # PNG メタデータからの履歴取り込みのワーカープロセス数 (0 で CPU コア数 - 1)
+    "duplicate_threshold": 5, # Duplicates で近似重複とみなすサムネイルの dHash のハミング距離 (0〜7)
     "DEEPL_API_KEY": "",
     "default_negative_prompt": "worst quality, low quality, score_1, score_2, score_3, blurry, jpeg artifacts, sepia, extra arms, extra legs, bad anatomy, missing limb, bad hands, extra fingers, extra digits, bad fingers, bad legs, extra legs, bad feet, ",
     "quality_tags_list": ["masterpiece", "best quality", "good quality", "normal quality", "score_9", "score_8", "score_7", "score_6", "score_5", "score_4"],
@@ -51,6 +66,7 @@ DEFAULT_CONFIG = {
         "Creative": [8.0, 40]
     },
     "default_cfg_steps": "Standard",
+    "auto_gen_inflight": 2, # Auto Gen で ComfyUI のキューに同時に積んでおくジョブ数
     "tags_csv_path": "danbooru_tags.csv",
     "external_link_name": "Catbox.moe",
     "external_link_url": "https://catbox.moe/"
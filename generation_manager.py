@@ -5,46 +5,41 @@ import history_utils
 import datetime # 【追加】現在時刻を取得するために必要
 import traceback
 import math
-from PIL import Image
+import os
 
-def generate_and_save(
+def build_generation(
     prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, 
     ckpt_name, l1_name, l1_str, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str,
     turbo_lora_en, highres_lora_en, detail_lora_en,
     quality_tags, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, 
     decade_tags, period_tags, meta_tags, safety_tags, artist_tags, custom_tags, 
     current_comfy_url, workflow_file, config,
-    lllite_en=False, lllite_model="None", lllite_img=None, lllite_str=1.0, lllite_start=0.0, lllite_end=1.0, lllite_auto_res=True
+    lllite_en=False, lllite_model="None", lllite_img=None, lllite_str=1.0, lllite_start=0.0, lllite_end=1.0, lllite_auto_res=True,
+    batch_size=1
 ):
     """
-    ワークフローの初期タイトル値を使用して、IDを動的に特定する生成マネージャー。
+    ワークフローの初期タイトル値を使用して、IDを動的に特定し、送信用のワークフローと履歴用データを組み立てる。
+    実行先のバックエンドはここで選ばれ、new_entry["backend"] に記録される。
+    戻り値: (workflow, new_entry, status)  失敗時は workflow が None になり status にエラー内容が入る。
     """
-    # 1. ワークフローのロード
-    workflow = comfy_utils.load_workflow(workflow_file)
-    if not workflow:
-        return None, "❌ Workflow file not found.", None
+    # 1. ワークフローのロード (ファイルごとにコンパイル済みのテンプレートを再利用し、ここではコピーするだけ)
+    compiled = comfy_utils.get_compiled_workflow(workflow_file)
+    if not compiled:
+        return None, None, "❌ Workflow file not found."
+    workflow = comfy_utils.instantiate_workflow(compiled)
 
-    # --- 2. ワークフロー初期値（タイトル）によるノード特定 ---
-    # 提供された anima-t2i.json のタイトル名に基づいて検索します
-    pos_node_id = comfy_utils.find_node_by_title(workflow, "CLIP Text Encode (Positive Prompt)")
-    neg_node_id = comfy_utils.find_node_by_title(workflow, "CLIP Text Encode (Negative Prompt)")
-    latent_node_id = comfy_utils.find_node_by_title(workflow, "空の潜在画像")
-    sampler_node_id = comfy_utils.find_node_by_title(workflow, "Kサンプラー")
-    
-    # 【追加】保存ノードを特定 ("画像を保存" というタイトルを探す)
-    save_node_id = comfy_utils.find_node_by_title(workflow, "画像を保存")
+    # 実行先のバックエンドを先に決める (参照画像のアップロードもジョブを実行するバックエンドに送る必要があるため)
+    active_url = comfy_utils.select_backend(current_comfy_url, config)
 
-    # 【変更】モデルノードを特定 ("Load Checkpoint" や "拡散モデルを読み込む" などのタイトル、またはクラス名で探す)
-    ckpt_node_id = comfy_utils.find_node_by_title(workflow, "Load Checkpoint")
-    if not ckpt_node_id:
-        ckpt_node_id = comfy_utils.find_node_by_title(workflow, "拡散モデルを読み込む")
-        
-    if not ckpt_node_id:
-        for nid, node in workflow.items():
-            class_type = node.get("class_type", "") if isinstance(node, dict) else ""
-            if class_type in ["CheckpointLoaderSimple", "UNETLoader"]:
-                ckpt_node_id = nid
-                break
+    # --- 2. ワークフロー初期値（タイトル）によるノード特定 ---
+    # 提供された anima-t2i.json のタイトル名に基づき、コンパイル時に特定済みのIDを使います
+    nodes = compiled["nodes"]
+    pos_node_id = nodes["positive"]
+    neg_node_id = nodes["negative"]
+    latent_node_id = nodes["latent"]
+    sampler_node_id = nodes["sampler"]
+    save_node_id = nodes["save"]
+    ckpt_node_id = nodes["ckpt"]
 
     # 3. タグの結合ロジック
     selected_years = []
@@ -89,13 +84,7 @@ def generate_and_save(
     active_neg_prompt = ", ".join([t.strip() for t in neg_prompt.split(",") if t.strip() and not t.strip().startswith("#")])
 
     # --- NegPiP ノードの制御 ---
-    negpip_node_id = comfy_utils.find_node_by_title(workflow, "NegPiP")
-    if not negpip_node_id:
-        for nid, node in workflow.items():
-            class_type = node.get("class_type", "") if isinstance(node, dict) else ""
-            if "NegPiP" in class_type or "negpip" in class_type.lower():
-                negpip_node_id = nid
-                break
+    negpip_node_id = nodes["negpip"]
 
     if negpip_node_id:
         if enable_negpip:
@@ -107,13 +96,7 @@ def generate_and_save(
             pass
 
     # --- Anima ControlNet-LLLite ノードの制御 ---
-    lllite_node_id = comfy_utils.find_node_by_title(workflow, "LLLite")
-    if not lllite_node_id:
-        for nid, node in workflow.items():
-            class_type = node.get("class_type", "") if isinstance(node, dict) else ""
-            if "LLLite" in class_type or "lllite" in class_type.lower():
-                lllite_node_id = nid
-                break
+    lllite_node_id = nodes["lllite"]
                 
     if lllite_node_id:
         if lllite_en and lllite_model != "None":
@@ -122,7 +105,6 @@ def generate_and_save(
             
             uploaded_filename = None
             if lllite_img:
-                active_url = str(current_comfy_url).strip().rstrip("/")
                 uploaded_filename = comfy_utils.upload_image(lllite_img, active_url)
                 
             if "model_name" in workflow[lllite_node_id].get("inputs", {}):
@@ -136,26 +118,9 @@ def generate_and_save(
             if "end_percent" in workflow[lllite_node_id].get("inputs", {}):
                 workflow[lllite_node_id]["inputs"]["end_percent"] = float(lllite_end)
                 
-            if uploaded_filename:
-                def find_upstream_load_image(node_id):
-                    node = workflow.get(str(node_id), {})
-                    if node.get("class_type") == "LoadImage":
-                        return str(node_id)
-                    for k, v in node.get("inputs", {}).items():
-                        if isinstance(v, list) and len(v) == 2:
-                            found = find_upstream_load_image(v[0])
-                            if found:
-                                return found
-                    return None
-                
-                load_image_id = find_upstream_load_image(lllite_node_id)
-                if load_image_id:
-                    workflow[load_image_id]["inputs"]["image"] = uploaded_filename
-                else:
-                    for nid, node in workflow.items():
-                        if node.get("class_type") == "LoadImage":
-                            node["inputs"]["image"] = uploaded_filename
-                            break
+            load_image_id = nodes["lllite_image"]
+            if uploaded_filename and load_image_id:
+                workflow[load_image_id]["inputs"]["image"] = uploaded_filename
         else:
             # 無効化時は強度を0にする
             if "strength" in workflow[lllite_node_id].get("inputs", {}):
@@ -169,8 +134,7 @@ def generate_and_save(
     # 参照画像のアスペクト比に合わせて新しい Width と Height を計算します。
     if lllite_node_id and lllite_en and lllite_img and lllite_auto_res:
         try:
-            with Image.open(lllite_img) as ref_img:
-                img_w, img_h = ref_img.size
+            img_w, img_h = comfy_utils.get_image_size(lllite_img)
             
             if img_w > 0 and img_h > 0:
                 target_area = int(width) * int(height)
@@ -191,9 +155,15 @@ def generate_and_save(
         workflow[pos_node_id]["inputs"]["text"] = full_positive_prompt
     if neg_node_id:
         workflow[neg_node_id]["inputs"]["text"] = active_neg_prompt
+    batch_size = max(1, int(batch_size or 1))
     if latent_node_id:
         workflow[latent_node_id]["inputs"]["width"] = int(width)
         workflow[latent_node_id]["inputs"]["height"] = int(height)
+        # バッチ生成: 1ジョブで複数枚生成し、モデル読み込みやテキストエンコードのコストを分け合う
+        if "batch_size" in workflow[latent_node_id]["inputs"]:
+            workflow[latent_node_id]["inputs"]["batch_size"] = batch_size
+        else:
+            batch_size = 1
     if sampler_node_id:
         workflow[sampler_node_id]["inputs"].update({
             "seed": final_seed, 
@@ -210,20 +180,8 @@ def generate_and_save(
                 workflow[ckpt_node_id]["inputs"]["ckpt_name"] = ckpt_name
     
     # 【変更】LoRA設定 (接続順序に基づく自動特定ロジック)
-    # ワークフロー内のLoRAノードを全て取得する
-    lora_nodes = set()
-    for nid, node in workflow.items():
-        if not isinstance(node, dict): continue
-        class_type = node.get("class_type", "")
-        title = node.get("_meta", {}).get("title", "")
-        
-        # クラス名またはタイトルでLoRAノードを判定
-        if "LoraLoader" in class_type or "LoRA" in title:
-            lora_nodes.add(nid)
-    
-    # リスト化して、上流のLoRA数が少ない順（Checkpointに近い順）にソート
-    sorted_loras = list(lora_nodes)
-    sorted_loras.sort(key=lambda nid: comfy_utils.get_upstream_lora_count(workflow, lora_nodes, nid))
+    # 上流のLoRA数が少ない順（Checkpointに近い順）に並べた LoRA ノードはコンパイル時に計算済み
+    sorted_loras = compiled["lora_chain"]
         
     # --- 適用するLoRAのリストを作成 ---
     active_loras = []
@@ -268,38 +226,125 @@ def generate_and_save(
         
         workflow[save_node_id]["inputs"]["filename_prefix"] = new_prefix
 
-    try:
-        # 6. ComfyUI API 実行
-        active_url = str(current_comfy_url).strip().rstrip("/")
-        output_image, img_info = comfy_utils.run_comfy_api(workflow, active_url)
+    # 6. 保存用データの構築
+    new_entry = {
+        "prompt": prompt, "neg_prompt": neg_prompt, "trigger_first": trigger_first, "enable_negpip": enable_negpip, "seed": final_seed, "cfg": cfg, 
+        "steps": steps, "width": width, "height": height, "sampler_name": sampler_name, 
+        "quality_tags": quality_tags, "y1_en": y1_en, "y1_val": y1_val, 
+        "y2_en": y2_en, "y2_val": y2_val, "y3_en": y3_en, "y3_val": y3_val,
+        "decade_tags": decade_tags, "period_tags": period_tags, "meta_tags": meta_tags, 
+        "safety_tags": safety_tags, "artist_tags": artist_tags, "custom_tags": custom_tags,
+        "caption": f"Seed: {final_seed} | {sampler_name}",
+        "ckpt_name": ckpt_name,
+        "lora1_name": l1_name, "lora1_strength": l1_str,
+        "turbo_lora_en": turbo_lora_en, "highres_lora_en": highres_lora_en, "detail_lora_en": detail_lora_en,
+        "lora2_name": l2_name, "lora2_strength": l2_str,
+        "lora3_name": l3_name, "lora3_strength": l3_str,
+        "lora4_name": l4_name, "lora4_strength": l4_str,
+        "lora5_name": l5_name, "lora5_strength": l5_str,
+        "lllite_en": lllite_en, "lllite_model": lllite_model, "lllite_img": lllite_img, 
+        "lllite_str": lllite_str, "lllite_start": lllite_start, "lllite_end": lllite_end, "lllite_auto_res": lllite_auto_res,
+        "batch_size": batch_size,
+        "backend": active_url
+    }
 
-        # 7. 保存用データの構築
-        new_entry = {
-            "prompt": prompt, "neg_prompt": neg_prompt, "trigger_first": trigger_first, "enable_negpip": enable_negpip, "seed": final_seed, "cfg": cfg, 
-            "steps": steps, "width": width, "height": height, "sampler_name": sampler_name, 
-            "quality_tags": quality_tags, "y1_en": y1_en, "y1_val": y1_val, 
-            "y2_en": y2_en, "y2_val": y2_val, "y3_en": y3_en, "y3_val": y3_val,
-            "decade_tags": decade_tags, "period_tags": period_tags, "meta_tags": meta_tags, 
-            "safety_tags": safety_tags, "artist_tags": artist_tags, "custom_tags": custom_tags,
-            "caption": f"Seed: {final_seed} | {sampler_name}",
-            "ckpt_name": ckpt_name,
-            "lora1_name": l1_name, "lora1_strength": l1_str,
-            "turbo_lora_en": turbo_lora_en, "highres_lora_en": highres_lora_en, "detail_lora_en": detail_lora_en,
-            "lora2_name": l2_name, "lora2_strength": l2_str,
-            "lora3_name": l3_name, "lora3_strength": l3_str,
-            "lora4_name": l4_name, "lora4_strength": l4_str,
-            "lora5_name": l5_name, "lora5_strength": l5_str,
-            "lllite_en": lllite_en, "lllite_model": lllite_model, "lllite_img": lllite_img, 
-            "lllite_str": lllite_str, "lllite_start": lllite_start, "lllite_end": lllite_end, "lllite_auto_res": lllite_auto_res
-        }
+    return workflow, new_entry, None
 
-        # 8. 履歴への追加実行
-        # (注: 引数の数は元のコードに合わせています)
-        saved_entry = history_utils.add_to_history(config, new_entry, img_info, active_url, output_image)
+def generate_and_save_stream(
+    prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, 
+    ckpt_name, l1_name, l1_str, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str,
+    turbo_lora_en, highres_lora_en, detail_lora_en,
+    quality_tags, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, 
+    decade_tags, period_tags, meta_tags, safety_tags, artist_tags, custom_tags, 
+    current_comfy_url, workflow_file, config,
+    lllite_en=False, lllite_model="None", lllite_img=None, lllite_str=1.0, lllite_start=0.0, lllite_end=1.0, lllite_auto_res=True,
+    batch_size=1, owner=None, preview_interval=None
+):
+    """
+    1ジョブ (batch_size 枚) 生成して履歴に保存するジェネレーター。
+    生成中は ("progress", 現在, 総数) / ("preview", PIL画像) を yield し、
+    最後に ("result", 画像のリスト, ステータス, 保存した履歴エントリのリスト) を yield する (失敗時は画像・エントリが None)。
+    owner (Gradio のセッションID) を渡すと、Stop やブラウザを閉じた時に comfy_utils.cancel_owner_jobs で中止できる。
+    """
+    workflow, new_entry, status = build_generation(
+        prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, 
+        ckpt_name, l1_name, l1_str, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str,
+        turbo_lora_en, highres_lora_en, detail_lora_en,
+        quality_tags, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, 
+        decade_tags, period_tags, meta_tags, safety_tags, artist_tags, custom_tags, 
+        current_comfy_url, workflow_file, config,
+        lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res,
+        batch_size
+    )
+    if workflow is None:
+        yield ("result", None, status, None)
+        return
+
+    job = None
+    finished = False
+    try:
+        # 7. ComfyUI API 実行 (build_generation で選んだバックエンドに送信する)
+        job_timeout = config.get("comfy_job_timeout", comfy_utils.DEFAULT_JOB_TIMEOUT)
+        job = comfy_utils.submit_prompt(workflow, new_entry["backend"], owner)
+        outputs = None
+        for event in comfy_utils.iter_job_events(job, job_timeout, preview_interval):
+            if event[0] == "done":
+                outputs = event[1]
+            else:
+                yield event
+        results = comfy_utils.fetch_output_images(job, outputs, get_local_output_dir(config, job, current_comfy_url))
+        finished = True
+
+        # 8. 履歴への追加実行 (画像URLはジョブを実行したバックエンドを指す)
+        saved_entries = save_generation(config, new_entry, results, job["comfy_url"])
         
-        return output_image, "✅ Success", saved_entry
+        status = "✅ Success" if len(results) == 1 else f"✅ Success ({len(results)} images)"
+        yield ("result", [img for img, _ in results], status, saved_entries)
 
     except Exception as e:
+        finished = True
         print("\n[ERROR] Exception in generate_and_save:")
         traceback.print_exc()
-        return None, f"❌ Error: {str(e)}", None
\ No newline at end of file
+        yield ("result", None, f"❌ Error: {str(e)}", None)
+    finally:
+        # 途中でジェネレーターが閉じられた (Gradio のイベントがキャンセルされた) 場合は ComfyUI 側も中止する
+        if job is not None and not finished:
+            comfy_utils.cancel_job(job)
+            comfy_utils.close_job(job)
+
+def generate_and_save(*args, **kwargs):
+    """
+    generate_and_save_stream を最後まで実行し、結果だけを返す (引数は同じ)。
+    戻り値: (画像のリスト, ステータス, 保存した履歴エントリのリスト)  失敗時は (None, ステータス, None)
+    """
+    for event in generate_and_save_stream(*args, **kwargs):
+        if event[0] == "result":
+            return event[1], event[2], event[3]
+
+def get_local_output_dir(config, job, current_comfy_url):
+    """
+    ジョブを実行したバックエンドの出力フォルダがこのPCから直接読める場合、そのパスを返す (なければ None)。
+    comfy_output_dir / launch_bat はメインの ComfyUI の設定なので、プールの他のバックエンドには使わない。
+    """
+    if job["comfy_url"] != str(current_comfy_url).strip().rstrip("/"):
+        return None
+    output_dir = config.get("comfy_output_dir", "")
+    if not output_dir and config.get("launch_bat", ""):
+        output_dir = os.path.join(os.path.dirname(config["launch_bat"]), "output")
+    return output_dir if output_dir and os.path.isdir(output_dir) else None
+
+def save_generation(config, new_entry, results, active_url):
+    """
+    生成結果 [(PIL画像 または ファイルパス, img_info), ...] を1枚ずつ履歴に追加し、保存したエントリのリストを返す (サムネイルもここで作成される)。
+    ComfyUI はバッチ全体のノイズを1つのシードから生成するため、各画像は (seed, batch_index) で再現できる。
+    """
+    saved_entries = []
+    batch_size = len(results)
+    for batch_index, (output_image, img_info) in enumerate(results):
+        entry = dict(new_entry)
+        if batch_size > 1:
+            entry["batch_size"] = batch_size
+            entry["batch_index"] = batch_index
+            entry["caption"] = f"Seed: {entry['seed']} #{batch_index + 1}/{batch_size} | {entry['sampler_name']}"
+        saved_entries.append(history_utils.add_to_history(config, entry, img_info, active_url, output_image))
+    return saved_entries
\ No newline at end of file
@@ -0,0 +1,291 @@
+# history_db.py
+# 履歴の SQLite ストア (config の "history_backend": "sqlite" の時に history_utils から使われる)
+# 絞り込み・ページングに使う列にはインデックスを張り、生成パラメータ一式は data 列に JSON で保存する。
+import json
+import os
+import re
+import sqlite3
+import threading
+
+DEFAULT_DB_PATH = "history.db"
+
+_connections = {}
+_db_lock = threading.RLock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,  -- 追加順 (大きいほど新しい)
+    id TEXT NOT NULL UNIQUE,
+    timestamp REAL,
+    is_favorite INTEGER NOT NULL DEFAULT 0,
+    ckpt_name TEXT,
+    seed TEXT,                              -- 64bit 符号なしのシードは INTEGER に収まらないため文字列で保存
+    width INTEGER,
+    height INTEGER,
+    image TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_favorite ON history(is_favorite, seq);
+CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp);
+CREATE INDEX IF NOT EXISTS idx_history_ckpt ON history(ckpt_name);
+CREATE INDEX IF NOT EXISTS idx_history_seed ON history(seed);
+CREATE INDEX IF NOT EXISTS idx_history_size ON history(width, height);
+CREATE INDEX IF NOT EXISTS idx_history_image ON history(image);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# プロンプト検索用の FTS5 テーブル (rowid = history.seq)。FTS5 が使えない SQLite では LIKE 検索になる
+FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(prompt, neg_prompt, artist_tags, custom_tags)"
+SEARCH_FIELDS = ("prompt", "neg_prompt", "artist_tags", "custom_tags")
+# LIKE 検索でも FTS5 と同じ項目だけを対象にする (data 列全体だと "sampler_name" などのキーや画像のパスにも当たる)
+LIKE_SEARCH_SQL = "(" + " || ' ' || ".join(f"IFNULL(json_extract(data, '$.{f}'), '')" for f in SEARCH_FIELDS) + ") LIKE ?"
+
+_fts_available = {}
+
+def get_db_path(config):
+    return config.get("history_db_path", DEFAULT_DB_PATH) or DEFAULT_DB_PATH
+
+def get_connection(config):
+    """DBファイルごとに1本の接続を共有する (呼び出しは _db_lock で直列化する)"""
+    path = os.path.abspath(get_db_path(config))
+    with _db_lock:
+        conn = _connections.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            _fts_available[path] = init_fts(conn)
+            _connections[path] = conn
+        return conn
+
+def init_fts(conn):
+    """FTS5 テーブルを用意する。既存の DB に後から作った場合は全件を登録し直す"""
+    try:
+        conn.execute(FTS_SCHEMA)
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ SQLite FTS5 is not available ({e}). History search falls back to LIKE.")
+        return False
+    if conn.execute("SELECT value FROM meta WHERE key = 'fts_built'").fetchone() is None:
+        with conn:
+            conn.execute("DELETE FROM history_fts")
+            rows = conn.execute("SELECT seq, data FROM history").fetchall()
+            conn.executemany("INSERT INTO history_fts (rowid, prompt, neg_prompt, artist_tags, custom_tags) VALUES (?, ?, ?, ?, ?)",
+                             [(seq,) + _search_columns(json.loads(data)) for seq, data in rows])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fts_built', '1')")
+    return True
+
+def fts_available(config):
+    get_connection(config)
+    return _fts_available.get(os.path.abspath(get_db_path(config)), False)
+
+def _search_columns(entry):
+    values = []
+    for field in SEARCH_FIELDS:
+        value = entry.get(field)
+        values.append(", ".join(str(v) for v in value) if isinstance(value, list) else str(value or ""))
+    return tuple(values)
+
+def close_connection(config):
+    path = os.path.abspath(get_db_path(config))
+    with _db_lock:
+        conn = _connections.pop(path, None)
+        if conn is not None:
+            conn.close()
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _entry_row(entry):
+    seed = entry.get("seed")
+    return (
+        entry["id"],
+        entry.get("timestamp"),
+        1 if entry.get("is_favorite", False) else 0,
+        entry.get("ckpt_name"),
+        str(seed) if seed is not None else None,
+        _to_int(entry.get("width")),
+        _to_int(entry.get("height")),
+        entry.get("image"),
+        json.dumps(entry, ensure_ascii=False),
+    )
+
+def _row_entry(row):
+    # お気に入りは列の値が正 (data 内の値は追加時点のもの)
+    entry = json.loads(row[0])
+    entry["is_favorite"] = bool(row[1])
+    return entry
+
+_INSERT_SQL = ("INSERT OR IGNORE INTO history (id, timestamp, is_favorite, ckpt_name, seed, width, height, image, data) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def is_migrated(config):
+    with _db_lock:
+        row = get_connection(config).execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+    return row is not None
+
+def _insert_entries(config, conn, entries):
+    """エントリを追加し、検索インデックスにも登録する (呼び出し側でトランザクションを張る)"""
+    use_fts = fts_available(config)
+    for entry in entries:
+        cur = conn.execute(_INSERT_SQL, _entry_row(entry))
+        if use_fts and cur.rowcount:
+            conn.execute("INSERT INTO history_fts (rowid, prompt, neg_prompt, artist_tags, custom_tags) VALUES (?, ?, ?, ?, ?)",
+                         (cur.lastrowid,) + _search_columns(entry))
+
+def import_entries(config, history):
+    """
+    JSON 形式の履歴 (新しい順のリスト) を取り込む。最初の1回だけ呼ばれる移行処理。
+    ID が重複するエントリは無視されるので、途中で失敗しても再実行できる。
+    """
+    with _db_lock:
+        conn = get_connection(config)
+        with conn:
+            _insert_entries(config, conn, [h for h in reversed(history) if "id" in h])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', '1')")
+
+def add_entry(config, entry):
+    with _db_lock:
+        conn = get_connection(config)
+        with conn:
+            _insert_entries(config, conn, [entry])
+
+def set_favorite(config, entry_id, value):
+    with _db_lock:
+        conn = get_connection(config)
+        with conn:
+            conn.execute("UPDATE history SET is_favorite = ? WHERE id = ?", (1 if value else 0, entry_id))
+
+def delete_entry(config, entry_id):
+    with _db_lock:
+        conn = get_connection(config)
+        with conn:
+            _delete(config, conn, entry_id)
+
+def _delete(config, conn, entry_id):
+    row = conn.execute("SELECT seq FROM history WHERE id = ?", (entry_id,)).fetchone()
+    if row is None:
+        return
+    conn.execute("DELETE FROM history WHERE seq = ?", (row[0],))
+    if fts_available(config):
+        conn.execute("DELETE FROM history_fts WHERE rowid = ?", (row[0],))
+
+def apply_records(config, records):
+    """ログと同じ形式のレコード ("add" / "fav" / "delete") をまとめて1つのトランザクションで反映する"""
+    with _db_lock:
+        conn = get_connection(config)
+        with conn:
+            for record in records:
+                op = record.get("op")
+                if op == "add":
+                    _insert_entries(config, conn, [record["entry"]])
+                elif op == "fav":
+                    conn.execute("UPDATE history SET is_favorite = ? WHERE id = ?", (1 if record.get("value") else 0, record["id"]))
+                elif op == "delete":
+                    _delete(config, conn, record["id"])
+
+def replace_all(config, history):
+    """履歴全体を置き換える (新しい順のリスト)"""
+    with _db_lock:
+        conn = get_connection(config)
+        with conn:
+            conn.execute("DELETE FROM history")
+            if fts_available(config):
+                conn.execute("DELETE FROM history_fts")
+            _insert_entries(config, conn, list(reversed(history)))
+
+def rewrite_all(config, transform):
+    """
+    全件を新しい順に読み、transform(エントリのリスト) が返したリストで置き換える (None なら何もしない)。
+    読み込みから置き換えまで _db_lock を持つので、その間の追加・削除が失われない。置き換えたら True
+    """
+    with _db_lock:
+        history = transform(load_all(config))
+        if history is None:
+            return False
+        replace_all(config, history)
+        return True
+
+def clear(config):
+    with _db_lock:
+        conn = get_connection(config)
+        with conn:
+            conn.execute("DELETE FROM history")
+            if fts_available(config):
+                conn.execute("DELETE FROM history_fts")
+
+def get_entry(config, entry_id):
+    with _db_lock:
+        row = get_connection(config).execute("SELECT data, is_favorite FROM history WHERE id = ?", (entry_id,)).fetchone()
+    return _row_entry(row) if row else None
+
+def get_entries(config, entry_ids):
+    """複数の ID のエントリを引く (ID -> エントリ の辞書。見つからない ID は含まない)"""
+    entry_ids = list(dict.fromkeys(entry_ids))
+    found = {}
+    with _db_lock:
+        conn = get_connection(config)
+        # SQLite の変数の上限を超えないよう分けて引く
+        for i in range(0, len(entry_ids), 500):
+            chunk = entry_ids[i:i + 500]
+            sql = "SELECT data, is_favorite FROM history WHERE id IN (" + ",".join("?" * len(chunk)) + ")"
+            for row in conn.execute(sql, chunk).fetchall():
+                entry = _row_entry(row)
+                found[entry["id"]] = entry
+    return found
+
+def load_all(config):
+    """全件を新しい順に返す"""
+    with _db_lock:
+        rows = get_connection(config).execute("SELECT data, is_favorite FROM history ORDER BY seq DESC").fetchall()
+    return [_row_entry(row) for row in rows]
+
+def _filter_sql(config, favorites_only, query):
+    """絞り込み条件の WHERE 句とパラメータを返す"""
+    conditions, params = [], []
+    if favorites_only:
+        conditions.append("is_favorite = 1")
+    tokens = tokenize_query(query)
+    if tokens:
+        if fts_available(config):
+            # 各トークンを前方一致の AND 検索にする ("blue hair" -> "blue"* "hair"*)
+            conditions.append("seq IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+            params.append(" ".join('"' + t.replace('"', '""') + '"*' for t in tokens))
+        else:
+            for t in tokens:
+                conditions.append(LIKE_SEARCH_SQL)
+                params.append(f"%{t}%")
+    where = (" WHERE " + " AND ".join(conditions)) if conditions else ""
+    return where, params
+
+def tokenize_query(query):
+    # FTS5 の unicode61 トークナイザと同じく、英数字以外 (アンダースコアを含む) を区切りとして扱う
+    return [t for t in re.split(r"[\W_]+", str(query or "").lower()) if t]
+
+def count(config, favorites_only=False, query=""):
+    where, params = _filter_sql(config, favorites_only, query)
+    with _db_lock:
+        return get_connection(config).execute("SELECT COUNT(*) FROM history" + where, params).fetchone()[0]
+
+def get_page(config, offset, limit, favorites_only=False, query=""):
+    """新しい順で offset 件目から limit 件を返す (お気に入りは (is_favorite, seq) のインデックス、検索は FTS5 で引く)"""
+    where, params = _filter_sql(config, favorites_only, query)
+    sql = "SELECT data, is_favorite FROM history" + where + " ORDER BY seq DESC LIMIT ? OFFSET ?"
+    with _db_lock:
+        rows = get_connection(config).execute(sql, params + [int(limit), int(offset)]).fetchall()
+    return [_row_entry(row) for row in rows]
+
+def backup(config, backup_path):
+    """オンラインバックアップ (書き込み中でも一貫したコピーを作る)"""
+    with _db_lock:
+        dest = sqlite3.connect(backup_path)
+        try:
+            get_connection(config).backup(dest)
+        finally:
+            dest.close()
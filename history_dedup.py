@@ -0,0 +1,195 @@
+# history_dedup.py
+# 履歴の近似重複 (Auto Gen などで出来たほぼ同じ画像) を探す。
+# 各エントリの 350px サムネイルから dHash (64bit) を計算してエントリ ID ごとに保存し (history_hashes.json)、
+# NumPy でハミング距離を一括計算してグループにまとめる。
+# 全組み合わせは比べず、64bit を 16bit ずつ 4 つの帯に分け、どれかの帯の違いが (しきい値 // 4) bit 以内のものだけを候補にする
+# (距離がしきい値以下なら鳩の巣原理でどれかの帯の違いは必ずその範囲に収まるので、取りこぼしは無い)。
+import json
+import os
+import threading
+import time
+import numpy as np
+import history_utils
+import thumbnail_manager
+
+DEFAULT_THRESHOLD = 5   # 近似重複とみなすハミング距離の既定値
+MAX_THRESHOLD = 7       # 帯ごとの違いを 1bit までに抑えるための上限 (8 以上は候補が急に増える)
+BANDS = 4
+BAND_BITS = 16
+HASH_CHUNKSIZE = 256    # プロセスプールに一度に渡すサムネイル数
+
+_hash_lock = threading.Lock()
+_hashes = {"loaded": None, "values": {}} # loaded: 読み込んだ保存先のパス / values: エントリID -> dHash
+
+def get_hash_path(config):
+    """dHash の保存先 (history.json -> history_hashes.json)"""
+    return os.path.splitext(history_utils.get_history_path(config))[0] + "_hashes.json"
+
+def _load_hashes(config):
+    path = get_hash_path(config)
+    if _hashes["loaded"] == path:
+        return _hashes["values"]
+    values = {}
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                values = {k: int(v, 16) for k, v in json.load(f).get("hashes", {}).items()}
+        except Exception as e:
+            print(f"⚠️ Failed to load image hashes: {e}")
+    _hashes["loaded"] = path
+    _hashes["values"] = values
+    return values
+
+def _save_hashes(config, values):
+    path = get_hash_path(config)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"hashes": {k: f"{v:016x}" for k, v in values.items()}}, f)
+    os.replace(tmp_path, path)
+
+def update_hashes(config, history):
+    """
+    サムネイルがあって dHash が未計算のエントリの分だけ計算して保存し、(エントリのリスト, dHash のリスト) を返す。
+    サムネイルの無いエントリ (リモートの画像・作成待ち) は対象外。
+    """
+    with _hash_lock:
+        values = _load_hashes(config)
+        entries = [item for item in list(history) if item.get("id")]
+        missing = []
+        for item in entries:
+            if item["id"] in values:
+                continue
+            try:
+                _, thumb_path = history_utils.get_thumbnail_target(item, config)
+            except Exception:
+                continue
+            if thumb_path is not None and history_utils.has_thumbnail(thumb_path):
+                missing.append((item, thumb_path))
+
+        if missing:
+            started = time.time()
+            print(f"🧬 Computing image hashes for {len(missing)} entries...")
+            executor = thumbnail_manager.get_executor()
+            results = executor.map(thumbnail_manager.compute_dhash, [p for _, p in missing], chunksize=HASH_CHUNKSIZE)
+            for (item, _), value in zip(missing, results):
+                if value is not None:
+                    values[item["id"]] = value
+            print(f"🧬 Image hashes computed in {time.time() - started:.1f}s.")
+
+        # 削除済みのエントリの分は捨てる
+        live = {item["id"] for item in entries}
+        stale = [k for k in values if k not in live]
+        for k in stale:
+            del values[k]
+        if missing or stale:
+            _save_hashes(config, values)
+        # 履歴の並び (新しい順) のまま返す
+        items = [item for item in entries if item["id"] in values]
+        return items, [values[item["id"]] for item in items]
+
+def _close_pairs(hashes, threshold):
+    """
+    帯の値が一致する (しきい値が 4 以上なら 1bit 違いまで許す) 組のうち、ハミング距離が threshold 以下の組 (添字の配列 a, b) を返す。
+    帯ごとに値でソートしておき、探す値の範囲を値ごとの件数の表から求めて、組をまとめて作る。
+    """
+    n = len(hashes)
+    radius = threshold // BANDS
+    mask = np.uint64((1 << BAND_BITS) - 1)
+    flips = [0] + ([1 << bit for bit in range(BAND_BITS)] if radius else [])
+    indices = np.arange(n)
+    pairs_a, pairs_b = [], []
+    for band in range(BANDS):
+        keys = (hashes >> np.uint64(band * BAND_BITS)) & mask
+        order = np.argsort(keys, kind="stable")
+        # 帯の値ごとの件数と、ソート済みの並びでの開始位置 (16bit なので表で引ける)
+        bucket_sizes = np.bincount(keys.astype(np.int64), minlength=1 << BAND_BITS)
+        bucket_starts = np.cumsum(bucket_sizes) - bucket_sizes
+        for flip in flips:
+            targets = (keys ^ np.uint64(flip)).astype(np.int64)
+            lo = bucket_starts[targets]
+            counts = bucket_sizes[targets]
+            total = int(counts.sum())
+            if not total:
+                continue
+            # i ごとに sorted_keys[lo[i]:hi[i]] の各要素と組にする
+            a = np.repeat(indices, counts)
+            starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            b = order[starts + np.arange(total)]
+            # 同じ組を2回数えないよう a < b だけを残す (自分自身との組もここで落ちる)
+            keep = a < b
+            a, b = a[keep], b[keep]
+            close = _hamming(hashes[a], hashes[b]) <= threshold
+            pairs_a.append(a[close])
+            pairs_b.append(b[close])
+    if not pairs_a:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+def _hamming(x, y):
+    """64bit 値どうしのハミング距離 (ビット演算による popcount)"""
+    v = np.bitwise_xor(x, y)
+    v = v - ((v >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    v = (v & np.uint64(0x3333333333333333)) + ((v >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    v = (v + (v >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (v * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def _connected_labels(n, a, b):
+    """辺 (a[i], b[i]) でつながった要素に同じラベル (グループ内の最小の添字) を付ける"""
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[a], labels[b])
+        previous = labels.copy()
+        np.minimum.at(labels, a, low)
+        np.minimum.at(labels, b, low)
+        # ラベルのラベルをたどって一気に縮める
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+def group_hashes(hashes, threshold):
+    """dHash の配列から、ハミング距離が threshold 以下でつながるグループ (添字のリスト、2件以上) を返す"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    n = len(hashes)
+    if n < 2:
+        return []
+    # まったく同じハッシュは先にまとめ、帯の比較は異なる値どうしだけで行う
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    a, b = _close_pairs(unique, threshold)
+    labels = _connected_labels(len(unique), a, b)[inverse]
+
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+    ends = np.r_[starts[1:], n]
+    return [order[s:e].tolist() for s, e in zip(starts, ends) if e - s > 1]
+
+def find_duplicate_groups(config, history, threshold=None):
+    """
+    履歴の近似重複のグループを返す。グループは件数の多い順、グループ内は履歴の並び (新しい順)。
+    戻り値: [[エントリ, ...], ...]
+    """
+    if threshold is None:
+        threshold = config.get("duplicate_threshold", DEFAULT_THRESHOLD)
+    threshold = max(0, min(int(threshold), MAX_THRESHOLD))
+    items, values = update_hashes(config, history)
+    groups = group_hashes(values, threshold)
+    # items は履歴の並び順なので、添字の小さい方が新しい
+    groups = [[items[i] for i in sorted(group)] for group in groups]
+    groups.sort(key=len, reverse=True)
+    return groups
+
+def pick_redundant(groups):
+    """
+    各グループで残すものを除いたエントリ ID (一括削除の候補) を返す。
+    お気に入りがあればそれを全部残し、無ければ最新 (timestamp が最も新しい) の1件を残す。
+    """
+    redundant = []
+    for group in groups:
+        favorites = [item for item in group if item.get("is_favorite", False)]
+        if favorites:
+            keep = {item["id"] for item in favorites}
+        else:
+            # 同じ時刻 (timestamp が無い古いエントリどうしなど) なら履歴の並びで先のものを残す
+            keep = {max(group, key=lambda item: history_utils.get_entry_time(item) or 0.0)["id"]}
+        redundant.extend(item["id"] for item in group if item["id"] not in keep)
+    return redundant
@@ -0,0 +1,118 @@
+# history_export.py
+# 選択した履歴エントリの元画像と設定を ZIP にまとめ、その場でストリーミングして返す (app.py の /export/{token})。
+# 一時ファイルを作らず、画像をチャンクごとに読んで書き出すので、アーカイブの大きさによらずメモリ使用量は一定。
+import json
+import os
+import secrets
+import threading
+import time
+import zipfile
+
+EXPORT_TOKEN_TTL = 3600         # エクスポート用トークンの有効期間 (秒)。スマホでのダウンロードのやり直しに備えて期間内は何度でも使える
+EXPORT_CHUNK_SIZE = 1024 * 1024 # 画像を読み込んで ZIP に書き出す単位
+
+_tokens_lock = threading.Lock()
+_tokens = {} # トークン -> (エントリIDのリスト, 発行時刻)
+
+def create_export_token(entry_ids):
+    """エントリIDのリストを登録し、ダウンロード URL 用のトークンを返す"""
+    token = secrets.token_urlsafe(16)
+    now = time.time()
+    with _tokens_lock:
+        # 期限切れのトークンはここでまとめて捨てる
+        for t in [t for t, (_, created) in _tokens.items() if now - created > EXPORT_TOKEN_TTL]:
+            del _tokens[t]
+        _tokens[token] = (list(entry_ids), now)
+    return token
+
+def get_export_ids(token):
+    """トークンに対応するエントリIDのリスト (無効・期限切れなら None)"""
+    with _tokens_lock:
+        value = _tokens.get(token)
+    if value is None or time.time() - value[1] > EXPORT_TOKEN_TTL:
+        return None
+    return value[0]
+
+def format_parameters(entry):
+    """A1111 形式に近いテキストの設定 (sidecar の .txt 用)"""
+    lines = [entry.get("prompt", "")]
+    if entry.get("neg_prompt"):
+        lines.append(f"Negative prompt: {entry['neg_prompt']}")
+    params = [
+        ("Steps", entry.get("steps")),
+        ("Sampler", entry.get("sampler_name")),
+        ("CFG scale", entry.get("cfg")),
+        ("Seed", entry.get("seed")),
+        ("Size", f"{entry['width']}x{entry['height']}" if entry.get("width") and entry.get("height") else None),
+        ("Model", entry.get("ckpt_name") if entry.get("ckpt_name") not in (None, "", "None") else None),
+    ]
+    for i in range(1, 6):
+        name = entry.get(f"lora{i}_name")
+        if name and name != "None":
+            params.append((f"LoRA {i}", f"{name}:{entry.get(f'lora{i}_strength', 0.0)}"))
+    lines.append(", ".join(f"{k}: {v}" for k, v in params if v is not None))
+    return "\n".join(lines) + "\n"
+
+class _StreamBuffer:
+    """zipfile の書き出し先。書かれたバイト列を溜めておき、take() で取り出す (シークはできない)"""
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_export_zip(items, resolve_path):
+    """
+    (エントリ, 画像のパス) から ZIP を組み立てながらバイト列を順に返すジェネレータ。
+    画像は圧縮済みなので無圧縮、sidecar (.json / .txt) は deflate で格納する。
+    resolve_path(entry) はローカルの画像パス (無ければ None) を返す関数。
+    """
+    buffer = _StreamBuffer()
+    names = set()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+        for entry in items:
+            img_path = resolve_path(entry)
+            if not img_path or str(img_path).lower().startswith("http") or not os.path.exists(img_path):
+                print(f"⚠️ Export skipped (image not found or is remote): {img_path}")
+                continue
+            filename = os.path.basename(img_path)
+            stem = os.path.splitext(filename)[0]
+            # 別フォルダの同名ファイルは ID を付けて区別する
+            if stem in names:
+                stem = f"{stem}_{entry.get('id', len(names))}"
+                filename = stem + os.path.splitext(filename)[1]
+            names.add(stem)
+
+            info = zipfile.ZipInfo(filename, date_time=time.localtime(os.path.getmtime(img_path))[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            try:
+                with open(img_path, "rb") as src, zf.open(info, "w", force_zip64=True) as dst:
+                    while True:
+                        chunk = src.read(EXPORT_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        yield buffer.take()
+            except OSError as e:
+                print(f"❌ Failed to export {img_path}: {e}")
+                continue
+
+            zf.writestr(f"{stem}.json", json.dumps(entry, indent=4, ensure_ascii=False), compress_type=zipfile.ZIP_DEFLATED)
+            zf.writestr(f"{stem}.txt", format_parameters(entry), compress_type=zipfile.ZIP_DEFLATED)
+            yield buffer.take()
+    # 中央ディレクトリ (close 時に書かれる)
+    yield buffer.take()
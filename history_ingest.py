@@ -0,0 +1,302 @@
+# history_ingest.py
+# 出力フォルダの PNG に ComfyUI が埋め込んだメタデータ (tEXt / iTXt / zTXt の "prompt") から履歴を作り直す・取り込む。
+# 画素データ (IDAT) の手前までチャンクを読むだけでデコードはしない。ノードの特定には生成時と同じ comfy_utils.compile_workflow を使う。
+# 走査はプロセスプールで並列に行い、調べたファイルは (mtime, サイズ) を状態ファイルに残して次回は変更分だけを読む。
+import functools
+import json
+import os
+import struct
+import time
+import urllib.parse
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import comfy_utils
+import history_utils
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TEXT_CHUNKS = (b"tEXt", b"zTXt", b"iTXt")
+MAX_TEXT_CHUNK = 64 * 1024 * 1024 # これより大きいテキストチャンクは壊れているとみなして読まない
+SCAN_CHUNKSIZE = 64               # プロセスプールに一度に渡すファイル数
+
+# 生成時に固定のパスで追加される LoRA (generation_manager と同じ既定値) -> 履歴のフラグ名
+SPECIAL_LORAS = {
+    "turbo_lora_path": ("anima\\anima-turbo-lora-v0.1.safetensors", "turbo_lora_en"),
+    "highres_lora_path": ("anima\\anima-highres-aesthetic-boost.safetensors", "highres_lora_en"),
+    "detail_lora_path": ("anima\\anima-rl-v0.1.safetensors", "detail_lora_en"),
+}
+
+def get_state_path(config):
+    """取り込み済みのファイルを記録する状態ファイル (history.json -> history_ingest.json)"""
+    return os.path.splitext(history_utils.get_history_path(config))[0] + "_ingest.json"
+
+def read_png_text(path):
+    """
+    PNG のテキストチャンクと画像サイズを読む。画素データの手前で読むのをやめる。
+    戻り値: ({キーワード: テキスト}, (幅, 高さ))。PNG でなければ None
+    """
+    texts = {}
+    size = None
+    with open(path, "rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type in (b"IDAT", b"IEND"):
+                break
+            if chunk_type == b"IHDR":
+                size = struct.unpack(">II", f.read(length)[:8])
+                f.seek(4, 1)
+            elif chunk_type in TEXT_CHUNKS and length <= MAX_TEXT_CHUNK:
+                data = f.read(length)
+                f.seek(4, 1)
+                try:
+                    key, text = _decode_text_chunk(chunk_type, data)
+                    texts[key] = text
+                except (ValueError, zlib.error):
+                    continue
+            else:
+                f.seek(length + 4, 1)
+    return texts, size
+
+def _decode_text_chunk(chunk_type, data):
+    key, _, rest = data.partition(b"\x00")
+    key = key.decode("latin-1")
+    if chunk_type == b"tEXt":
+        return key, rest.decode("latin-1")
+    if chunk_type == b"zTXt":
+        # 先頭1バイトは圧縮方式 (0 = zlib のみ)
+        return key, zlib.decompress(rest[1:]).decode("latin-1")
+    # iTXt: 圧縮フラグ, 圧縮方式, 言語タグ\0, 翻訳キーワード\0, UTF-8 テキスト
+    compressed = rest[0]
+    _, _, rest = rest[2:].partition(b"\x00")
+    _, _, text = rest.partition(b"\x00")
+    if compressed:
+        text = zlib.decompress(text)
+    return key, text.decode("utf-8")
+
+def _follow(graph, link, match, depth=8):
+    """入力のリンク [ノードID, 出力番号] を上流へたどり、match(node) を満たす最初のノードを返す"""
+    if depth <= 0 or not isinstance(link, list) or len(link) != 2:
+        return None
+    node = graph.get(str(link[0]))
+    if not isinstance(node, dict):
+        return None
+    if match(node):
+        return node
+    for value in node.get("inputs", {}).values():
+        found = _follow(graph, value, match, depth - 1)
+        if found is not None:
+            return found
+    return None
+
+def _plain(value, types):
+    """リンクではない値 (数値・文字列) だけを返す"""
+    return value if isinstance(value, types) and not isinstance(value, bool) else None
+
+def entry_from_prompt(graph, image_size=None, special_loras=None):
+    """
+    ComfyUI の API 形式のワークフロー (PNG の "prompt") から、履歴エントリの生成パラメータを取り出す。
+    ノードは生成時と同じくタイトル・クラス名で特定し、見つからなければ KSampler の入力から上流をたどる。
+    """
+    compiled = comfy_utils.compile_workflow(graph)
+    nodes = compiled["nodes"]
+
+    def node_inputs(role):
+        nid = nodes.get(role)
+        return graph[nid].get("inputs", {}) if nid and isinstance(graph.get(nid), dict) else None
+
+    sampler = node_inputs("sampler")
+    if sampler is None:
+        sampler_id = next((nid for class_type, ids in compiled["classes"].items() if "KSampler" in class_type for nid in ids), None)
+        sampler = graph[sampler_id].get("inputs", {}) if sampler_id else {}
+
+    has_text = lambda node: isinstance(node.get("inputs", {}).get("text"), str)
+    positive = node_inputs("positive") or (_follow(graph, sampler.get("positive"), has_text) or {}).get("inputs")
+    negative = node_inputs("negative") or (_follow(graph, sampler.get("negative"), has_text) or {}).get("inputs")
+    latent = node_inputs("latent") or (_follow(graph, sampler.get("latent_image"), lambda n: "width" in n.get("inputs", {})) or {}).get("inputs") or {}
+    if positive is None and not sampler:
+        return None
+
+    width = _plain(latent.get("width"), int) or (image_size[0] if image_size else 0)
+    height = _plain(latent.get("height"), int) or (image_size[1] if image_size else 0)
+    seed = _plain(sampler.get("seed", sampler.get("noise_seed")), int) or 0
+    sampler_name = _plain(sampler.get("sampler_name"), str) or "euler_ancestral"
+
+    entry = {
+        "prompt": _plain((positive or {}).get("text"), str) or "",
+        "neg_prompt": _plain((negative or {}).get("text"), str) or "",
+        "seed": seed,
+        "cfg": _plain(sampler.get("cfg"), (int, float)) or 0.0,
+        "steps": _plain(sampler.get("steps"), int) or 0,
+        "width": width, "height": height,
+        "sampler_name": sampler_name,
+        "caption": f"Seed: {seed} | {sampler_name}",
+        "ckpt_name": "None",
+        "turbo_lora_en": False, "highres_lora_en": False, "detail_lora_en": False,
+    }
+
+    ckpt = node_inputs("ckpt")
+    if ckpt:
+        entry["ckpt_name"] = _plain(ckpt.get("unet_name", ckpt.get("ckpt_name")), str) or "None"
+
+    # LoRA は Checkpoint に近い順に、強度 0 (未使用) のものを除いて lora1〜5 に割り当てる
+    special = special_loras or {}
+    slot = 1
+    for nid in compiled["lora_chain"]:
+        inputs = graph[nid].get("inputs", {})
+        name = _plain(inputs.get("lora_name"), str)
+        strength = _plain(inputs.get("strength_model"), (int, float)) or 0.0
+        if not name or name == "None" or strength == 0.0:
+            continue
+        if name in special:
+            entry[special[name]] = True
+            continue
+        if slot > 5:
+            break
+        entry[f"lora{slot}_name"] = name
+        entry[f"lora{slot}_strength"] = float(strength)
+        slot += 1
+    for i in range(slot, 6):
+        entry[f"lora{i}_name"] = "None"
+        entry[f"lora{i}_strength"] = 0.0
+    return entry
+
+def scan_png(path, special_loras=None):
+    """
+    1ファイル分の処理 (ワーカープロセスで実行される)。
+    戻り値: (パス, [mtime_ns, サイズ], エントリのパラメータ または None)
+    """
+    try:
+        st = os.stat(path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        result = read_png_text(path)
+        if result is None:
+            return path, stamp, None
+        texts, size = result
+        if "prompt" not in texts:
+            return path, stamp, None
+        graph = json.loads(texts["prompt"])
+        if not isinstance(graph, dict):
+            return path, stamp, None
+        return path, stamp, entry_from_prompt(graph, size, special_loras)
+    except Exception as e:
+        print(f"⚠️ Failed to read PNG metadata: {path} ({e})")
+        return path, None, None
+
+def get_scan_roots(config):
+    """取り込み対象のフォルダ (ComfyUI の出力フォルダとバックアップフォルダ)"""
+    roots = []
+    real_out_path = config.get("comfy_output_dir", "")
+    if real_out_path:
+        roots.append(real_out_path)
+    bat_path = config.get("launch_bat", "")
+    if bat_path:
+        roots.append(os.path.join(os.path.dirname(bat_path), "output"))
+    backup_dir = config.get("backup_output_dir", "")
+    if backup_dir:
+        roots.append(backup_dir)
+    return [r for r in dict.fromkeys(os.path.abspath(r) for r in roots) if os.path.isdir(r)]
+
+def iter_png_files(root):
+    """root 以下の PNG を (パス, サブフォルダ) で返す (サブフォルダは ComfyUI の /view と同じく / 区切り)"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        subfolder = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        subfolder = "" if subfolder == "." else subfolder
+        for name in filenames:
+            if name.lower().endswith(".png"):
+                yield os.path.join(dirpath, name), subfolder
+
+def load_state(config):
+    path = get_state_path(config)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("files", {})
+    except Exception as e:
+        print(f"⚠️ Failed to load ingest state: {e}")
+        return {}
+
+def save_state(config, files):
+    path = get_state_path(config)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"files": files}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def get_workers(config):
+    workers = int(config.get("history_ingest_workers", 0) or 0)
+    return workers if workers > 0 else max(1, (os.cpu_count() or 2) - 1)
+
+def ingest_png_metadata(config, history=None):
+    """
+    出力フォルダ・バックアップフォルダの PNG のうち、履歴に無いものをメタデータから履歴に取り込む。
+    前回から変わっていないファイルは読まない。取り込んだ件数と結果のメッセージを返す。
+    """
+    history = history_utils.as_history_list(history if history is not None else history_utils.get_shared_history(config))
+    state = load_state(config)
+
+    # 既に履歴にある画像はファイル名で判定する (resolve_image_path もファイル名で探すので同じ基準)
+    known = set()
+    for item in list(history):
+        filename = urllib.parse.parse_qs(urllib.parse.urlparse(item.get("image", "")).query).get("filename", [None])[0]
+        if filename:
+            known.add(os.path.normcase(filename))
+
+    targets = []
+    subfolders = {}
+    for root in get_scan_roots(config):
+        for path, subfolder in iter_png_files(root):
+            stamp = state.get(path)
+            if stamp is not None:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if stamp == [st.st_mtime_ns, st.st_size]:
+                    continue
+            if os.path.normcase(os.path.basename(path)) in known:
+                continue
+            targets.append(path)
+            subfolders[path] = subfolder
+    if not targets:
+        return 0, "✅ No new PNG files to import."
+
+    special_loras = {config.get(key, default): flag for key, (default, flag) in SPECIAL_LORAS.items()}
+    base_url = str(config.get("comfy_url", "")).strip().rstrip("/")
+    started = time.time()
+    found = []
+    print(f"🔍 Scanning {len(targets)} PNG files for metadata...")
+    with ProcessPoolExecutor(max_workers=get_workers(config)) as executor:
+        for i, (path, stamp, params) in enumerate(executor.map(functools.partial(scan_png, special_loras=special_loras), targets, chunksize=SCAN_CHUNKSIZE), 1):
+            if stamp is not None:
+                state[path] = stamp
+            if params is not None:
+                found.append((stamp[0], path, params))
+            if i % 5000 == 0:
+                print(f"🔍 {i} / {len(targets)} files scanned")
+
+    entries = []
+    for mtime_ns, path, params in sorted(found):
+        filename = os.path.basename(path)
+        # バックアップと出力フォルダに同じ画像がある場合は1件だけ取り込む
+        if os.path.normcase(filename) in known:
+            continue
+        known.add(os.path.normcase(filename))
+        entry = dict(params)
+        entry["id"] = history_utils.new_entry_id()
+        entry["timestamp"] = mtime_ns / 1e9
+        entry["image"] = f"{base_url}/view?filename={urllib.parse.quote(filename)}&subfolder={urllib.parse.quote(subfolders[path])}&type=output"
+        entry["imported"] = True
+        entries.append(entry)
+
+    if entries:
+        # 画像の更新時刻 (timestamp) の順で既存の履歴に混ぜる (保存は1回だけ)
+        history_utils.merge_history_entries(config, history, entries)
+    save_state(config, state)
+    elapsed = time.time() - started
+    print(f"✅ Imported {len(entries)} entries from PNG metadata ({len(targets)} files scanned in {elapsed:.1f}s).")
+    return len(entries), f"✅ Imported {len(entries)} entries from PNG metadata ({len(targets)} files scanned)."
@@ -0,0 +1,146 @@
+# history_search.py
+# 履歴のプロンプト検索用のメモリ内転置インデックス (JSONL 形式の履歴用。SQLite では history_db の FTS5 を使う)
+# トークン -> エントリID の集合を持ち、生成・削除のたびに差分だけ更新する。
+import bisect
+import re
+import threading
+
+SEARCH_FIELDS = ("prompt", "neg_prompt", "artist_tags", "custom_tags")
+
+_TOKEN_RE = re.compile(r"[^\W_]+")
+
+_index_lock = threading.RLock()
+_postings = {}     # トークン -> {エントリID}
+_vocab = []        # 前方一致検索用にソートしたトークン一覧
+_entries = {}      # エントリID -> (追加順, エントリ)
+_entry_tokens = {} # エントリID -> そのエントリのトークン (削除時に使う)
+_state = {"built": False, "seq": 0, "version": 0}
+_cache = {"key": None, "results": []}
+
+def tokenize(text):
+    """英数字 (日本語を含む) の連続を小文字のトークンにする。アンダースコア・カンマ・括弧などは区切り"""
+    return _TOKEN_RE.findall(str(text).lower())
+
+def entry_search_text(entry):
+    parts = []
+    for field in SEARCH_FIELDS:
+        value = entry.get(field)
+        if isinstance(value, list):
+            parts.extend(str(v) for v in value)
+        elif value:
+            parts.append(str(value))
+    return " ".join(parts)
+
+def is_built():
+    return _state["built"]
+
+def build(history):
+    """履歴 (新しい順のリスト) からインデックスを作り直す。最初の検索時に1回だけ呼ばれる"""
+    with _index_lock:
+        _postings.clear()
+        _entries.clear()
+        _entry_tokens.clear()
+        _state["seq"] = 0
+        for entry in reversed(history):
+            _add(entry)
+        _vocab[:] = sorted(_postings)
+        _state["built"] = True
+        _state["version"] += 1
+
+def _add(entry):
+    entry_id = entry.get("id")
+    if not entry_id or entry_id in _entries:
+        return []
+    _state["seq"] += 1
+    _entries[entry_id] = (_state["seq"], entry)
+    tokens = set(tokenize(entry_search_text(entry)))
+    _entry_tokens[entry_id] = tokens
+    new_tokens = []
+    for token in tokens:
+        ids = _postings.get(token)
+        if ids is None:
+            _postings[token] = {entry_id}
+            new_tokens.append(token)
+        else:
+            ids.add(entry_id)
+    return new_tokens
+
+def add_entry(entry):
+    """新しいエントリを追加する (インデックス未作成なら何もしない。最初の検索時にまとめて作る)"""
+    with _index_lock:
+        if not _state["built"]:
+            return
+        for token in _add(entry):
+            bisect.insort(_vocab, token)
+        _state["version"] += 1
+
+def remove_entry(entry_id):
+    with _index_lock:
+        if not _state["built"] or entry_id not in _entries:
+            return
+        del _entries[entry_id]
+        for token in _entry_tokens.pop(entry_id, ()):
+            ids = _postings.get(token)
+            if ids is None:
+                continue
+            ids.discard(entry_id)
+            if not ids:
+                del _postings[token]
+                i = bisect.bisect_left(_vocab, token)
+                if i < len(_vocab) and _vocab[i] == token:
+                    del _vocab[i]
+        _state["version"] += 1
+
+def set_favorite(entry_id, value):
+    with _index_lock:
+        item = _entries.get(entry_id)
+        if item is not None:
+            item[1]["is_favorite"] = bool(value)
+
+def reset():
+    """履歴全体が書き換えられた時に呼ぶ (次の検索で作り直す)"""
+    with _index_lock:
+        _state["built"] = False
+        _postings.clear()
+        _entries.clear()
+        _entry_tokens.clear()
+        _vocab.clear()
+        _state["version"] += 1
+
+def _prefix_ids(token):
+    """token で始まる全トークンの ID 集合 (ソート済みの語彙を二分探索する)"""
+    start = bisect.bisect_left(_vocab, token)
+    end = bisect.bisect_left(_vocab, token + "\U0010ffff")
+    if end - start == 1:
+        return _postings[_vocab[start]]
+    ids = set()
+    for word in _vocab[start:end]:
+        ids |= _postings[word]
+    return ids
+
+def search(history, query):
+    """
+    query の全トークンを (前方一致で) 含むエントリを新しい順に返す。
+    同じ検索の繰り返し (ページ送り・件数表示) はインデックスが変わるまで結果を使い回す。
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return history
+    with _index_lock:
+        if not _state["built"]:
+            build(history)
+        key = (tuple(tokens), _state["version"])
+        if _cache["key"] == key:
+            return _cache["results"]
+
+        result_ids = None
+        # 候補の少ないトークンから絞り込む
+        for ids in sorted((_prefix_ids(t) for t in tokens), key=len):
+            result_ids = set(ids) if result_ids is None else result_ids & ids
+            if not result_ids:
+                break
+        matched = sorted((_entries[i] for i in result_ids or ()), key=lambda item: item[0], reverse=True)
+        results = [entry for _, entry in matched]
+        _cache["key"] = key
+        _cache["results"] = results
+        return results
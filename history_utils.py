@@ -3,16 +3,72 @@ import os
 import urllib.parse
 import shutil
 import datetime
-from PIL import Image
+import threading
+import uuid
+import time
+import bisect
+import queue
+import atexit
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import history_db
+import history_search
+import history_export
+import thumbnail_manager
+
+# 履歴は「スナップショット (history.json)」+「追記専用ログ (history.jsonl)」で保存する。
+# 生成・お気に入り・削除のたびに全件を書き直さず、1行のレコードを追記するだけにする。
+#   {"op": "add", "entry": {...}} / {"op": "fav", "id": ..., "value": true} / {"op": "delete", "id": ...}
+# ログが history_compact_threshold 件を超えたら、バックグラウンドでスナップショットにまとめ直す。
+# ファイルへの書き込みは専用の書き込みスレッドだけが行い、history_write_delay 秒以内の連続した変更は1回の書き込みにまとめる。
+DEFAULT_COMPACT_THRESHOLD = 1000
+DEFAULT_WRITE_DELAY = 0.2
+EXIT_FLUSH_TIMEOUT = 10.0  # 終了時に書き込みスレッドを待つ上限 (秒)。書き込みが止まっていてもプロセスは終了できるようにする
+
+_history_lock = threading.RLock()
+_log_counts = {}           # ログのパス -> 追記済みレコード数
+_compacting = set()        # コンパクション実行中のスナップショットのパス
+_snapshot_generations = {} # スナップショットのパス -> 全体を書き直した回数 (コンパクションが古い内容で上書きしないように)
+
+_write_queue = queue.Queue()  # (種類, config, 内容)。種類は "records" / "snapshot" / "clear" / "flush" (内容は完了を知らせる Event)
+_writer_state = {"thread": None, "delay": DEFAULT_WRITE_DELAY}
+
+FILE_POOL_WORKERS = 4
+_file_pool = {"executor": None}
+_file_pool_lock = threading.Lock()
+
+_shared_load_lock = threading.Lock()  # 共有の履歴を2回読み込まないためのロック (_history_lock とは別)
+_shared_store = {"history": None}  # 全セッションで共有する履歴 (get_shared_history で最初に読み込む)
+
+# 履歴の保存先 ("jsonl": history.json + history.jsonl / "sqlite": history_db)。起動時に configure_history_store で設定する
+_store_settings = {"history_backend": "jsonl", "history_db_path": history_db.DEFAULT_DB_PATH}
+
+def configure_history_store(config):
+    _store_settings["history_backend"] = config.get("history_backend", "jsonl")
+    _store_settings["history_db_path"] = config.get("history_db_path", history_db.DEFAULT_DB_PATH)
+    _writer_state["delay"] = float(config.get("history_write_delay", DEFAULT_WRITE_DELAY))
+
+def use_sqlite(config=None):
+    return (config or _store_settings).get("history_backend", _store_settings["history_backend"]) == "sqlite"
 
 def get_history_path(config):
     return config.get("history_file_path", "history.json")
 
-def load_history(config):
+def get_history_log_path(config):
+    """追記ログのパス (history.json -> history.jsonl)"""
+    return os.path.splitext(get_history_path(config))[0] + ".jsonl"
+
+def get_compacting_log_path(config):
+    """コンパクション中のログの退避先。途中で落ちても次回の読み込みで再適用される"""
+    return get_history_log_path(config) + ".compacting"
+
+def new_entry_id():
+    return uuid.uuid4().hex
+
+def read_snapshot(config):
     path = get_history_path(config)
     if not os.path.exists(path):
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump([], f)
         return []
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -20,26 +76,646 @@ def load_history(config):
     except:
         return []
 
-def resolve_image_path(item, config):
-    img_url = item.get("image", "")
-    if not img_url: return None
+def write_snapshot(config, history):
+    """スナップショットを一時ファイルに書いてから置き換える (書き込み途中で落ちても壊れない)"""
+    path = get_history_path(config)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
 
-    parsed = urllib.parse.urlparse(img_url)
-    params = urllib.parse.parse_qs(parsed.query)
-    
-    filename = params.get("filename", [None])[0]
-    subfolder = params.get("subfolder", [""])[0]
-    
-    if not filename: return img_url
+def read_log_records(log_path):
+    """ログのレコードを順に返す。書き込み途中で壊れた行は読み飛ばす"""
+    if not os.path.exists(log_path):
+        return []
+    records = []
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print(f"⚠️ Skipping broken history log record in {log_path}")
+    return records
 
-    basename = os.path.splitext(filename)[0]
-    exts = [os.path.splitext(filename)[1], ".png", ".jpg", ".webp", ".jxl"]
+def apply_log_records(history, records):
+    """
+    レコードを履歴 (新しい順のリスト) に適用する。同じレコードを2回適用しても結果が変わらない (冪等) ので、
+    コンパクションの途中で落ちてログとスナップショットが重複しても問題ない。
+    """
+    if not records:
+        return history
+    by_id = {h["id"]: h for h in history if "id" in h}
+    deleted = set()
+    added = []
+    for record in records:
+        op = record.get("op")
+        if op == "add":
+            entry = record.get("entry") or {}
+            entry_id = entry.get("id")
+            if entry_id and entry_id not in by_id and entry_id not in deleted:
+                by_id[entry_id] = entry
+                added.append(entry)
+        elif op == "fav":
+            entry = by_id.get(record.get("id"))
+            if entry is not None:
+                entry["is_favorite"] = bool(record.get("value"))
+        elif op == "delete":
+            entry_id = record.get("id")
+            if by_id.pop(entry_id, None) is not None:
+                deleted.add(entry_id)
+    # 追加分は新しいものが先頭
+    history = added[::-1] + history
+    if deleted:
+        history = [h for h in history if h.get("id") not in deleted]
+    return history
+
+def migrate_history(config, history):
+    """
+    旧形式 (ID なしの history.json) からの一度きりの移行。全エントリに ID を振ってスナップショットを書き直す。
+    """
+    missing = [h for h in history if "id" not in h]
+    if not missing:
+        return history
+    for h in missing:
+        h["id"] = new_entry_id()
+    write_snapshot(config, history)
+    print(f"✅ History migrated: assigned IDs to {len(missing)} entries.")
+    return history
+
+class HistoryList(list):
+    """
+    新しい順の履歴リストに、エントリID の索引を付けたもの。
+    ID -> (順位, エントリ) を持ち、順位 (新しいほど大きい) の降順にリストが並ぶことを利用して、リスト上の位置も二分探索で求める。
+    選択・削除・お気に入りなどは位置ではなく ID で行い、削除でずれる添字に依存しない。
+    お気に入りは順位のソート済みリストで別に持ち、追加・削除・切り替えのたびに差分だけ更新する
+    (お気に入りのページ送りは履歴全体を走査せず、ページ分だけを取り出す)。
+
+    アプリでは get_shared_history のプロセス全体で1つのインスタンスを全セッションが共有する。
+    変更はロックで直列化し、変更のたびに version を進める (各セッションは表示した version と比べて再描画を判断する)。
+    """
+    def __init__(self, entries=()):
+        super().__init__(entries)
+        self._lock = threading.RLock()
+        self.version = 0
+        self.reindex()
+
+    def reindex(self):
+        with self._lock:
+            n = len(self)
+            self._by_id = {h["id"]: (n - i, h) for i, h in enumerate(self) if "id" in h}
+            self._by_rank = {rank: h for rank, h in self._by_id.values()}
+            self._favorites = sorted(rank for rank, h in self._by_id.values() if h.get("is_favorite", False))
+            self._top = n
+
+    def get_entry(self, entry_id):
+        item = self._by_id.get(entry_id)
+        return item[1] if item is not None else None
+
+    def position(self, entry_id):
+        """ID のエントリのリスト上の位置 (無ければ -1)"""
+        with self._lock:
+            item = self._by_id.get(entry_id)
+            if item is None:
+                return -1
+            rank, entry = item
+            lo, hi = 0, len(self)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                mid_item = self._by_id.get(self[mid].get("id"))
+                if mid_item is None:
+                    break
+                if mid_item[0] > rank:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(self) and self[lo] is entry:
+                return lo
+            # リストが索引を通さずに書き換えられていた場合は作り直す
+            self.reindex()
+            return next((i for i, h in enumerate(self) if h is entry), -1)
+
+    def add_front(self, entry):
+        """新しいエントリを先頭に追加する (同じ ID が既にあれば何もしない)"""
+        with self._lock:
+            if entry.get("id") in self._by_id:
+                return
+            self.insert(0, entry)
+            if "id" in entry:
+                self._top += 1
+                self._by_id[entry["id"]] = (self._top, entry)
+                self._by_rank[self._top] = entry
+                if entry.get("is_favorite", False):
+                    # 最新のエントリなので末尾に追加すればソート順が保たれる
+                    self._favorites.append(self._top)
+            self.version += 1
+
+    def add_many_front(self, entries):
+        """複数のエントリを古い順に受け取り、まとめて先頭に追加する (索引の作り直しは1回だけ)"""
+        with self._lock:
+            new = [e for e in entries if e.get("id") not in self._by_id]
+            if not new:
+                return
+            self[:0] = new[::-1]
+            self.reindex()
+            self.version += 1
+
+    def remove_entry(self, entry_id):
+        """ID のエントリをリストから取り除いて返す (無ければ None)"""
+        with self._lock:
+            index = self.position(entry_id)
+            if index < 0:
+                return None
+            rank, _ = self._by_id.pop(entry_id)
+            del self._by_rank[rank]
+            self._discard_favorite(rank)
+            self.version += 1
+            return self.pop(index)
+
+    def mark_favorite(self, entry_id, value):
+        """お気に入り状態を変更し、お気に入りの索引も更新する"""
+        with self._lock:
+            item = self._by_id.get(entry_id)
+            if item is None:
+                return None
+            rank, entry = item
+            entry["is_favorite"] = bool(value)
+            if value:
+                i = bisect.bisect_left(self._favorites, rank)
+                if i == len(self._favorites) or self._favorites[i] != rank:
+                    self._favorites.insert(i, rank)
+            else:
+                self._discard_favorite(rank)
+            self.version += 1
+            return entry
+
+    def remove_entries(self, entry_ids):
+        """複数のエントリをまとめて取り除く (リストの作り直しは1回だけ)"""
+        with self._lock:
+            ids = {i for i in entry_ids if i in self._by_id}
+            if not ids:
+                return
+            self[:] = [h for h in self if h.get("id") not in ids]
+            self.reindex()
+            self.version += 1
+
+    def mark_favorites(self, entry_ids, value):
+        """複数のエントリのお気に入り状態を変更し、実際に変わった ID のリストを返す"""
+        with self._lock:
+            changed = [i for i in entry_ids if i in self._by_id and self._by_id[i][1].get("is_favorite", False) != bool(value)]
+            for entry_id in changed:
+                self.mark_favorite(entry_id, value)
+            return changed
+
+    def replace_entries(self, entries):
+        """中身を丸ごと入れ替える (履歴の全消去・全体の書き直し時)"""
+        with self._lock:
+            self[:] = list(entries)
+            self.reindex()
+            self.version += 1
+
+    def _discard_favorite(self, rank):
+        i = bisect.bisect_left(self._favorites, rank)
+        if i < len(self._favorites) and self._favorites[i] == rank:
+            del self._favorites[i]
+
+    def count_favorites(self):
+        return len(self._favorites)
+
+    def favorites_page(self, start, count):
+        """お気に入りを新しい順に start 件目から count 件返す"""
+        with self._lock:
+            end = len(self._favorites) - start
+            ranks = self._favorites[max(0, end - count):max(0, end)]
+            return [self._by_rank[rank] for rank in reversed(ranks)]
+
+class DbHistory:
+    """
+    SQLite モードの共有の履歴。HistoryList と同じ操作を持つが、エントリはメモリに持たずに毎回 DB から引く。
+    変更は append_history_records などが DB に書くので、ここでは何もしない (DB に書いた後で touch が version を進める)。
+    全件を走査する処理 (重複の検出・PNG の取り込み・サムネイルの作成) の時だけ、その場で全件を読み込む。
+    """
+    def __init__(self, config):
+        self._config = {"history_db_path": history_db.get_db_path(config)}
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def touch(self):
+        with self._lock:
+            self.version += 1
+
+    def __iter__(self):
+        return iter(history_db.load_all(self._config))
 
+    def __len__(self):
+        return history_db.count(self._config)
+
+    def get_entry(self, entry_id):
+        return history_db.get_entry(self._config, entry_id) if entry_id else None
+
+    def add_front(self, entry):
+        pass
+
+    def add_many_front(self, entries):
+        pass
+
+    def remove_entry(self, entry_id):
+        return self.get_entry(entry_id)
+
+    def remove_entries(self, entry_ids):
+        pass
+
+    def mark_favorite(self, entry_id, value):
+        entry = self.get_entry(entry_id)
+        if entry is not None:
+            entry["is_favorite"] = bool(value)
+        return entry
+
+    def mark_favorites(self, entry_ids, value):
+        """実際に変わる (DB の値と異なる) ID のリストを返す"""
+        entries = history_db.get_entries(self._config, entry_ids)
+        return [i for i in dict.fromkeys(entry_ids) if i in entries and entries[i].get("is_favorite", False) != bool(value)]
+
+    def replace_entries(self, entries):
+        self.touch()
+
+    def count_favorites(self):
+        return history_db.count(self._config, True)
+
+    def favorites_page(self, start, count):
+        return history_db.get_page(self._config, start, count, True)
+
+def as_history_list(history):
+    """
+    UI から渡された履歴を HistoryList にする (既にそうならそのまま返す。SQLite モードの共有の履歴は DbHistory)。
+    None (ページ読み込み直後で State にまだ参照が入っていない) なら共有の履歴を返す。
+    """
+    if isinstance(history, (HistoryList, DbHistory)):
+        return history
+    if history is None and _shared_store["history"] is not None:
+        return _shared_store["history"]
+    return HistoryList(history or [])
+
+def get_history_entry(history, entry_id):
+    """ID で履歴のエントリを引く (見つからなければ None)"""
+    if not entry_id:
+        return None
+    return as_history_list(history).get_entry(entry_id)
+
+def get_shared_history(config):
+    """
+    プロセス全体で共有する履歴 (HistoryList) を返す。最初の呼び出しで読み込み、以降は同じインスタンスを返す。
+    スマホ・タブレット・PC など複数のブラウザから接続しても、履歴はメモリ上に1つだけ持つ。
+    """
+    if _shared_store["history"] is not None:
+        return _shared_store["history"]
+    # 読み込み (書き込み待ちの flush を含む) は _history_lock の外で行う。
+    # 書き込みスレッドは _history_lock を使うので、持ったまま flush を待つとデッドロックする
+    with _shared_load_lock:
+        if _shared_store["history"] is None:
+            history = load_history(config)
+            with _history_lock:
+                _shared_store["history"] = history
+        return _shared_store["history"]
+
+def load_history(config):
+    """履歴を新しい順の HistoryList で返す (SQLite では DB から引く DbHistory)"""
+    # 書き込み待ちの変更をファイルに反映してから読む
+    flush_history_writes()
+    if use_sqlite(config):
+        # 初回のみ、既存の history.json / history.jsonl を DB に取り込む
+        if not history_db.is_migrated(config):
+            history_db.import_entries(config, load_json_history(config))
+            print("✅ History imported into SQLite.")
+        # 全件をメモリに読み込まず、必要な分だけ DB から引く
+        return DbHistory(config)
+    return HistoryList(load_json_history(config))
+
+def load_json_history(config):
+    path = get_history_path(config)
+    with _history_lock:
+        if not any(os.path.exists(p) for p in (path, get_history_log_path(config), get_compacting_log_path(config))):
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump([], f)
+            return []
+        history = migrate_history(config, read_snapshot(config))
+        history = apply_log_records(history, read_log_records(get_compacting_log_path(config)))
+        history = apply_log_records(history, read_log_records(get_history_log_path(config)))
+    return history
+
+def count_history(history, favorites_only=False, query=""):
+    """履歴 (またはお気に入り・検索結果) の件数。SQLite ではインデックスで数える"""
+    if use_sqlite():
+        return history_db.count(_store_settings, favorites_only, query)
+    if favorites_only and not (query and query.strip()):
+        return as_history_list(history).count_favorites()
+    return len(filter_history(history, favorites_only, query))
+
+def get_history_page(history, page, per_page, favorites_only=False, query=""):
+    """新しい順で page ページ目のエントリを返す。SQLite では LIMIT/OFFSET のクエリになる"""
+    start = page * per_page
+    if use_sqlite():
+        return history_db.get_page(_store_settings, start, per_page, favorites_only, query)
+    if favorites_only and not (query and query.strip()):
+        # お気に入りの索引からページ分だけ取り出す
+        return as_history_list(history).favorites_page(start, per_page)
+    return filter_history(history, favorites_only, query)[start:start + per_page]
+
+def filter_history(history, favorites_only=False, query=""):
+    """JSONL 形式の履歴をお気に入り・検索語で絞り込む (検索は history_search の転置インデックスを使う)"""
+    history = as_history_list(history)
+    target_history = history_search.search(history, query) if query and query.strip() else history
+    if favorites_only:
+        target_history = [h for h in target_history if h.get("is_favorite", False)]
+    return target_history
+
+def find_history_entry(config, entry_id):
+    """ID でエントリを1件引く (見つからなければ None)"""
+    if use_sqlite(config):
+        return history_db.get_entry(config, entry_id)
+    return get_shared_history(config).get_entry(entry_id)
+
+def append_history_records(config, records):
+    """
+    レコードを履歴に反映する。JSONL では書き込みスレッドに渡してすぐに戻る (ログへの追記は後でまとめて行う)。
+    """
+    if use_sqlite(config):
+        apply_db_records(config, records)
+        return
+    update_search_index(records)
+    enqueue_history_write(config, "records", records)
+
+def write_history_records(config, records):
+    """レコードをログに追記し、件数がしきい値を超えたらバックグラウンドでコンパクションする (書き込みスレッドから呼ばれる)"""
+    log_path = get_history_log_path(config)
+    with _history_lock:
+        if log_path not in _log_counts:
+            _log_counts[log_path] = len(read_log_records(log_path))
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        _log_counts[log_path] += len(records)
+        count = _log_counts[log_path]
+
+    threshold = int(config.get("history_compact_threshold", DEFAULT_COMPACT_THRESHOLD))
+    if count >= threshold:
+        start_compaction(config)
+
+def write_full_history(config, history):
+    """履歴全体をスナップショットに書き直し、ログを空にする (書き込みスレッドから呼ばれる)"""
+    with _history_lock:
+        write_snapshot(config, history)
+        for log_path in (get_history_log_path(config), get_compacting_log_path(config)):
+            if os.path.exists(log_path):
+                os.remove(log_path)
+        _log_counts[get_history_log_path(config)] = 0
+        bump_snapshot_generation(config)
+
+def enqueue_history_write(config, kind, payload=None):
+    """書き込みスレッドに変更を渡す (スレッドは最初の書き込み時に起動する)"""
+    with _history_lock:
+        thread = _writer_state["thread"]
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=_history_writer_loop, daemon=True, name="history-writer")
+            thread.start()
+            if _writer_state["thread"] is None:
+                # 終了時に書き残しがないようにする (restart_gradio の前は明示的に flush する)
+                atexit.register(flush_history_writes, EXIT_FLUSH_TIMEOUT)
+            _writer_state["thread"] = thread
+    _write_queue.put((kind, config, payload))
+
+def flush_history_writes(timeout=None):
+    """
+    キューに残っている書き込みが全てファイルに反映されるまで待つ (timeout 秒を過ぎたら諦めて False を返す)。
+    書き込みスレッドが _history_lock を使うので、_history_lock を持ったまま呼んではいけない。
+    """
+    if _writer_state["thread"] is None or not _writer_state["thread"].is_alive():
+        return True
+    done = threading.Event()
+    _write_queue.put(("flush", None, done))
+    if not done.wait(timeout):
+        print("⚠️ Timed out waiting for pending history writes.")
+        return False
+    return True
+
+def _history_writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        # 最初の変更から history_write_delay 秒の間に来た変更をまとめる (flush が来たらすぐ書く)
+        deadline = time.monotonic() + _writer_state["delay"]
+        while batch[-1][0] != "flush":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _write_history_batch(batch)
+        except Exception as e:
+            print(f"❌ Failed to write history: {e}")
+        finally:
+            for kind, _, payload in batch:
+                if kind == "flush":
+                    payload.set()
+
+def _write_history_batch(batch):
+    """まとめた変更を履歴ファイルごとに1回の書き込みにする"""
+    by_path = {}
+    for kind, config, payload in batch:
+        if kind == "flush":
+            continue
+        ops = by_path.setdefault(get_history_path(config), (config, []))[1]
+        if kind in ("snapshot", "clear"):
+            # 全体の書き直しより前の追記は、書き直す内容に含まれているので捨てる
+            ops.clear()
+        ops.append((kind, payload))
+    for config, ops in by_path.values():
+        records = []
+        for kind, payload in ops:
+            if kind == "records":
+                records.extend(payload)
+            else:
+                write_full_history(config, payload if kind == "snapshot" else [])
+        if records:
+            write_history_records(config, records)
+
+def update_search_index(records):
+    """追記するレコードを検索インデックスにも反映する"""
+    for record in records:
+        op = record.get("op")
+        if op == "add":
+            history_search.add_entry(record["entry"])
+        elif op == "fav":
+            history_search.set_favorite(record["id"], record.get("value"))
+        elif op == "delete":
+            history_search.remove_entry(record["id"])
+
+def apply_db_records(config, records):
+    """ログと同じ形式のレコードを SQLite に反映する (一括操作も1つのトランザクションにまとめる)"""
+    history_db.apply_records(config, records)
+    # 他のセッションのギャラリーにも反映されるよう、書いた後で version を進める
+    store = _shared_store["history"]
+    if isinstance(store, DbHistory):
+        store.touch()
+
+def bump_snapshot_generation(config):
+    """履歴全体を書き直したことを記録する (_history_lock を持って呼ぶ)"""
+    path = get_history_path(config)
+    _snapshot_generations[path] = _snapshot_generations.get(path, 0) + 1
+
+def start_compaction(config):
+    path = get_history_path(config)
+    with _history_lock:
+        if path in _compacting:
+            return
+        _compacting.add(path)
+    threading.Thread(target=compact_history, args=(config,), daemon=True).start()
+
+def compact_history(config):
+    """
+    ログをスナップショットにまとめ、ログを空にする。
+    ロックはログの退避とスナップショットの置き換えの間だけ持ち、その間も生成は新しいログに追記できる。
+    """
+    path = get_history_path(config)
+    log_path = get_history_log_path(config)
+    compacting_path = get_compacting_log_path(config)
+    try:
+        with _history_lock:
+            # 前回のコンパクションが途中で終わっていれば、退避済みのログから続ける
+            if not os.path.exists(compacting_path):
+                if not os.path.exists(log_path):
+                    return
+                os.replace(log_path, compacting_path)
+            _log_counts[log_path] = 0
+            snapshot = read_snapshot(config)
+            generation = _snapshot_generations.get(path, 0)
+
+        history = apply_log_records(migrate_history(config, snapshot), read_log_records(compacting_path))
+        # ロックの外で書くので、write_snapshot (ロック内で path.tmp を使う) とは別の一時ファイルにする
+        tmp_path = f"{path}.compact.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(history, f, indent=4, ensure_ascii=False)
+
+        with _history_lock:
+            if _snapshot_generations.get(path, 0) != generation:
+                # まとめている間に履歴全体が書き直された (退避したログもその内容に含まれている)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            os.remove(compacting_path)
+        print(f"✅ History compacted: {len(history)} entries.")
+    except Exception as e:
+        print(f"❌ History compaction failed: {e}")
+    finally:
+        with _history_lock:
+            _compacting.discard(path)
+
+# --- 出力フォルダのインデックス ---
+# 画像の場所を探すたびに os.path.exists を何十回も呼ばないよう、フォルダごとに scandir 1回でファイル名の一覧を作る。
+# 一覧は output_index_ttl 秒ごとにフォルダの mtime を確認し、変わっていた時だけ作り直す。
+# 作り直した時は前の一覧との差分を取り、増減したファイル名 (拡張子を除いた名前) の解決結果だけを無効にする。
+DEFAULT_INDEX_TTL = 2.0
+RESOLVED_CACHE_SIZE = 20000  # 画像パスの解決結果を覚えておく件数 (古く使われていないものから捨てる)
+
+_index_lock = threading.Lock()
+_dir_index = {}       # フォルダの絶対パス -> {"mtime", "checked", "version", "files": {正規化したファイル名: ファイル名}} (存在しなければ None)
+_resolved_cache = collections.OrderedDict()  # 画像URL -> (解決したパス, (参照したフォルダ一覧のバージョン, 名前のバージョン))。最近使った順
+_resolved_lock = threading.Lock()
+_name_versions = {}   # 正規化した拡張子を除くファイル名 -> 増減した回数 (その名前の解決結果を無効にする)
+_index_settings = {"ttl": DEFAULT_INDEX_TTL, "version": 0} # version はフォルダの一覧が作られる (フォルダが現れる・消える) たびに進む
+
+def _scan_dir(path):
+    files = {}
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                if e.is_file():
+                    files[os.path.normcase(e.name)] = e.name
+            except OSError:
+                continue
+    return files
+
+def get_dir_listing(path):
+    """フォルダ内のファイル一覧 (インデックス) を返す。フォルダがなければ None"""
+    path = os.path.abspath(path)
+    now = time.time()
+    with _index_lock:
+        listing = _dir_index.get(path)
+        if listing is not None and now - listing["checked"] < _index_settings["ttl"]:
+            return listing if listing["files"] is not None else None
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+    with _index_lock:
+        listing = _dir_index.get(path)
+        if listing is not None and listing["mtime"] == mtime:
+            listing["checked"] = now
+            return listing if listing["files"] is not None else None
+    files = None
+    if mtime is not None:
+        try:
+            files = _scan_dir(path)
+        except OSError:
+            files = None
+    with _index_lock:
+        listing = _dir_index.get(path)
+        if listing is not None and listing["files"] is not None and files is not None:
+            # フォルダの中身が変わっただけなら、増減したファイル名の分だけ無効にする
+            _touch_names(listing["files"].keys() ^ files.keys())
+            listing.update(mtime=mtime, checked=now, files=files)
+        else:
+            _index_settings["version"] += 1
+            listing = {"mtime": mtime, "checked": now, "version": _index_settings["version"], "files": files}
+            _dir_index[path] = listing
+    return listing if files is not None else None
+
+def _touch_names(names):
+    """ファイル名 (正規化済み) の増減を記録し、その名前の解決結果を次回作り直させる (_index_lock を持って呼ぶ)"""
+    for name in names:
+        stem = os.path.splitext(name)[0]
+        _name_versions[stem] = _name_versions.get(stem, 0) + 1
+
+def note_file_added(file_path):
+    """自分で作ったファイルをインデックスに反映する (フォルダの再スキャンを待たない)"""
+    _update_listing(file_path, add=True)
+
+def note_file_removed(file_path):
+    _update_listing(file_path, add=False)
+
+def _update_listing(file_path, add):
+    folder, name = os.path.split(os.path.abspath(file_path))
+    try:
+        mtime = os.stat(folder).st_mtime
+    except OSError:
+        mtime = None
+    with _index_lock:
+        listing = _dir_index.get(folder)
+        if listing is None or listing["files"] is None:
+            return
+        if add:
+            listing["files"][os.path.normcase(name)] = name
+        else:
+            listing["files"].pop(os.path.normcase(name), None)
+        _touch_names([os.path.normcase(name)])
+        # 自分の変更で変わった mtime を記録し、次の確認で再スキャンしないようにする
+        if mtime is not None:
+            listing["mtime"] = mtime
+
+def configure_output_index(config):
+    _index_settings["ttl"] = float(config.get("output_index_ttl", DEFAULT_INDEX_TTL))
+
+def get_search_dirs(config, subfolder):
+    """画像を探すフォルダの候補 (優先順)。存在確認はインデックス側で行う"""
     search_dirs = []
     
     # 1. バックアップフォルダ
     backup_dir = config.get("backup_output_dir", "")
-    if backup_dir and os.path.exists(backup_dir):
+    if backup_dir:
         search_dirs.append(backup_dir)
         if subfolder:
             search_dirs.append(os.path.join(backup_dir, subfolder))
@@ -47,72 +723,136 @@ def resolve_image_path(item, config):
     # 2. ComfyUI Output (Batchファイルからの推測)
     bat_path = config.get("launch_bat", "")
     if bat_path:
-        comfy_base = os.path.dirname(bat_path)
-        output_dir = os.path.join(comfy_base, "output")
-        if os.path.exists(output_dir):
-            if subfolder:
-                search_dirs.append(os.path.join(output_dir, subfolder))
-            else:
-                search_dirs.append(output_dir)
+        output_dir = os.path.join(os.path.dirname(bat_path), "output")
+        search_dirs.append(os.path.join(output_dir, subfolder) if subfolder else output_dir)
 
     # 3. 【追加】ComfyUI Output (明示的設定)
     real_out_path = config.get("comfy_output_dir", "")
-    if real_out_path and os.path.exists(real_out_path):
-        if subfolder:
-            search_dirs.append(os.path.join(real_out_path, subfolder))
-        else:
-            search_dirs.append(real_out_path)
-
-    # 走査実行
-    for d in search_dirs:
-        if not os.path.exists(d): continue
-        for e in exts:
-            if not e: continue
-            target = os.path.join(d, basename + e)
-            if os.path.exists(target): return target
-            
-            target_exact = os.path.join(d, filename)
-            if os.path.exists(target_exact): return target_exact
+    if real_out_path:
+        search_dirs.append(os.path.join(real_out_path, subfolder) if subfolder else real_out_path)
+    return search_dirs
+
+def resolve_image_path(item, config):
+    img_url = item.get("image", "")
+    if not img_url: return None
+
+    parsed = urllib.parse.urlparse(img_url)
+    params = urllib.parse.parse_qs(parsed.query)
+    
+    filename = params.get("filename", [None])[0]
+    subfolder = params.get("subfolder", [""])[0]
+    
+    if not filename: return img_url
+
+    basename = os.path.splitext(filename)[0]
+    # 名前のバージョンは一覧を見る前に読む (途中で増減があれば次回は作り直す)
+    name_version = _name_versions.get(os.path.normcase(basename), 0)
+    listings = [(d, get_dir_listing(d)) for d in get_search_dirs(config, subfolder)]
+    # 参照したフォルダと同じ名前のファイルが前回から変わっていなければ、前回の結果をそのまま使う (ページ送りでファイルシステムに触れない)
+    stamp = (tuple(listing["version"] if listing else None for _, listing in listings), name_version)
+    with _resolved_lock:
+        cached = _resolved_cache.get(img_url)
+        if cached is not None and cached[1] == stamp:
+            _resolved_cache.move_to_end(img_url)
+            return cached[0]
+
+    # 元のファイル名を最優先し、次に拡張子違い (バックアップ時に変換された画像など) を探す
+    candidates = [filename] + [basename + e for e in (".png", ".jpg", ".webp", ".jxl")]
+
+    result = img_url
+    for d, listing in listings:
+        if listing is None: continue
+        found = next((listing["files"][os.path.normcase(c)] for c in candidates if os.path.normcase(c) in listing["files"]), None)
+        if found:
+            result = os.path.join(d, found)
+            break
 
-    return img_url
+    with _resolved_lock:
+        _resolved_cache[img_url] = (result, stamp)
+        _resolved_cache.move_to_end(img_url)
+        while len(_resolved_cache) > RESOLVED_CACHE_SIZE:
+            _resolved_cache.popitem(last=False)
+    return result
 
 def get_thumbnail_dir():
     thumb_dir = "thumbnails"
-    if not os.path.exists(thumb_dir):
+    # フォルダの存在確認はインデックスで行い、ギャラリー描画のたびに stat しない
+    if get_dir_listing(thumb_dir) is None:
         os.makedirs(thumb_dir, exist_ok=True)
+        with _index_lock:
+            _dir_index.pop(os.path.abspath(thumb_dir), None)
     return thumb_dir
 
-def resolve_thumbnail_path(item, config):
-    """ギャラリー表示用にサムネイルのパスを解決する。なければ生成する。"""
+def get_thumbnail_target(item, config):
+    """(元画像のパス, サムネイルのパス) を返す。ローカルの画像でなければ (元画像のパスまたはURL, None)"""
     full_path = resolve_image_path(item, config)
-    
-    # ローカルファイルでない、または存在しない場合はそのまま返す
-    if not full_path or not isinstance(full_path, str) or not os.path.exists(full_path):
-        return full_path
-    
-    # HTTP URLならそのまま返す
-    if full_path.startswith("http"): return full_path
-
-    thumb_dir = get_thumbnail_dir()
-    filename = os.path.basename(full_path)
-    name, _ = os.path.splitext(filename)
-    thumb_filename = f"thumb_{name}.webp"
-    thumb_path = os.path.join(thumb_dir, thumb_filename)
-    
-    if os.path.exists(thumb_path):
-        return thumb_path
-        
+    # ローカルファイルでない場合はサムネイルを作らない (インデックスで見つかったパスは存在確認済み)
+    if not full_path or not isinstance(full_path, str) or full_path.startswith("http"):
+        return full_path, None
+    name, _ = os.path.splitext(os.path.basename(full_path))
+    return full_path, os.path.join(get_thumbnail_dir(), f"thumb_{name}.webp")
+
+def has_thumbnail(thumb_path):
+    listing = get_dir_listing(os.path.dirname(thumb_path))
+    return bool(listing) and os.path.normcase(os.path.basename(thumb_path)) in listing["files"]
+
+def resolve_thumbnail_path(item, config):
+    """
+    ギャラリー表示用にサムネイルのパスを解決する。
+    なければバックグラウンドで作成を依頼し、出来上がるまではプレースホルダーを返す。
+    """
+    full_path, thumb_path = get_thumbnail_target(item, config)
+    if thumb_path is None or has_thumbnail(thumb_path):
+        return thumb_path or full_path
     try:
-        with Image.open(full_path) as img:
-            img.thumbnail((350, 350))
-            img.save(thumb_path, "WEBP", quality=80)
-        return thumb_path
-    except:
+        if thumbnail_manager.request_thumbnail(full_path, thumb_path, note_file_added) is None:
+            # サムネイルを作れなかった画像は元画像のまま表示する
+            return full_path
+        return thumbnail_manager.get_placeholder_path(os.path.dirname(thumb_path))
+    except Exception as e:
+        print(f"⚠️ Thumbnail request failed: {e}")
+        return full_path
+
+def resolve_thumbnail_url(item, config, base_url):
+    """
+    ギャラリー表示用のサムネイル URL (app.py の /thumb/{id})。
+    Gradio のキャッシュへのコピーを避け、ブラウザに長期キャッシュさせる。
+    作成待ちの間は別の URL にして、プレースホルダーがキャッシュに残らないようにする。
+    """
+    if not item.get("id"):
+        return resolve_thumbnail_path(item, config)
+    full_path, thumb_path = get_thumbnail_target(item, config)
+    if thumb_path is None:
         return full_path
+    url = f"{base_url}/thumb/{urllib.parse.quote(item['id'])}"
+    if has_thumbnail(thumb_path):
+        return url
+    if thumbnail_manager.request_thumbnail(full_path, thumb_path, note_file_added) is None:
+        # サムネイルを作れなかった画像は作成待ちにしない (/thumb は 404 を返す)
+        return url
+    return url + "?pending=1"
+
+def iter_missing_thumbnails(config):
+    """サムネイルが無い履歴の (元画像のパス, サムネイルのパス) を新しい順に返す"""
+    for item in list(get_shared_history(config)):
+        try:
+            full_path, thumb_path = get_thumbnail_target(item, config)
+        except Exception:
+            continue
+        if thumb_path is not None and not has_thumbnail(thumb_path):
+            yield full_path, thumb_path
+
+def start_thumbnail_warmup(config):
+    """起動時に足りないサムネイルをプロセスプールでまとめて作り始める"""
+    thumbnail_manager.configure(config)
+    if not config.get("thumbnail_warmup", True):
+        return
+    thumbnail_manager.start_warmup(lambda: iter_missing_thumbnails(config), note_file_added)
 
 def add_to_history(config, entry, img_info, current_url, pil_image=None):
-    history = load_history(config)
     history_entry = entry.copy()
+    history_entry["id"] = new_entry_id()
+    history_entry["timestamp"] = time.time()
     
     filename = img_info["filename"]
     subfolder = img_info["subfolder"]
@@ -134,26 +874,51 @@ def add_to_history(config, entry, img_info, current_url, pil_image=None):
     history_entry["lora3_name"] = entry.get("lora3_name", "None")
     history_entry["lora3_strength"] = entry.get("lora3_strength", 0.0)
     history_entry["trigger_first"] = entry.get("trigger_first", False)
-    history.insert(0, history_entry)
-    with open(get_history_path(config), "w", encoding="utf-8") as f:
-        json.dump(history, f, indent=4, ensure_ascii=False)
+    # 共有の履歴にも追加し、他のセッションのギャラリーにも反映させる。
+    # 先にメモリに載せてからログに追記する (merge_history_entries の全体の書き直しと重なっても、どちらかに必ず残る)
+    store = _shared_store["history"]
+    if store is not None:
+        store.add_front(history_entry)
+    # 全件を書き直さず、ログに1行追記するだけ
+    append_history_records(config, [{"op": "add", "entry": history_entry}])
     
-    # 生成直後のPIL画像がある場合は即座にサムネイルを作成
+    # 生成直後の画像がある場合は即座にサムネイルを作成
+    # (ローカルの出力フォルダから取得した場合はファイルパスが渡されるので、ここで初めて開く)
     if pil_image:
         try:
             thumb_dir = get_thumbnail_dir()
             name, _ = os.path.splitext(filename)
             thumb_path = os.path.join(thumb_dir, f"thumb_{name}.webp")
-            img_copy = pil_image.copy()
-            img_copy.thumbnail((350, 350))
-            img_copy.save(thumb_path, "WEBP", quality=80)
+            if isinstance(pil_image, str):
+                # 出力フォルダの再スキャンを待たずに、生成直後の画像をインデックスに載せる
+                note_file_added(pil_image)
+                # ファイルのデコードはワーカープロセスに任せ、生成ループを止めない
+                thumbnail_manager.request_thumbnail(pil_image, thumb_path, note_file_added)
+            else:
+                img_copy = pil_image.copy()
+                img_copy.thumbnail(thumbnail_manager.THUMBNAIL_SIZE)
+                img_copy.save(thumb_path, "WEBP", quality=80)
+                note_file_added(thumb_path)
         except Exception as e:
             print(f"⚠️ Thumbnail creation failed: {e}")
             
     return history_entry
 
 def backup_history(config):
+    if use_sqlite(config):
+        try:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            backup_path = f"{history_db.get_db_path(config)}.{timestamp}.bak"
+            history_db.backup(config, backup_path)
+            return True, f"Backup created: {backup_path}"
+        except Exception as e:
+            print(f"❌ Backup failed: {e}")
+            return False, f"Backup failed: {e}"
+
     path = get_history_path(config)
+    # 書き込み待ちの変更とログの内容もバックアップに含まれるよう、先にスナップショットへまとめる
+    flush_history_writes()
+    compact_history(config)
     if os.path.exists(path):
         try:
             timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -166,67 +931,191 @@ def backup_history(config):
     return False, "History file not found."
 
 def save_history_json(config, history):
-    path = get_history_path(config)
+    """履歴全体をスナップショットとして書き直す (ログは不要になるので空にする。JSONL では書き込みスレッドで行う)"""
     try:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(history, f, indent=4, ensure_ascii=False)
+        for h in history:
+            h.setdefault("id", new_entry_id())
+        if use_sqlite(config):
+            history_db.replace_all(config, history)
+            sync_shared_history(history)
+            return True
+        history_search.reset()
+        sync_shared_history(history)
+        enqueue_history_write(config, "snapshot", list(history))
         return True
     except Exception as e:
         print(f"❌ Failed to save history: {e}")
         return False
 
-def delete_history_entry(config, history, index):
+def set_favorite(config, entry, value):
+    """お気に入り状態を変更してログに追記する"""
+    entry["is_favorite"] = bool(value)
+    if "id" not in entry:
+        # 移行前のデータが UI に残っている場合など、ID がなければ呼び出し側で全体保存してもらう
+        return False
+    append_history_records(config, [{"op": "fav", "id": entry["id"], "value": bool(value)}])
+    return True
+
+def delete_history_entry(config, history, entry_id):
+    """ID のエントリを画像・サムネイルごと削除し、履歴 (HistoryList) を返す"""
+    return delete_history_entries(config, history, [entry_id])
+
+def get_file_pool():
+    """画像・サムネイルの削除などのファイル操作用のスレッドプール"""
+    with _file_pool_lock:
+        if _file_pool["executor"] is None:
+            _file_pool["executor"] = ThreadPoolExecutor(max_workers=FILE_POOL_WORKERS, thread_name_prefix="history-files")
+        return _file_pool["executor"]
+
+def remove_entry_files(img_path):
+    """画像とサムネイルを削除する (ファイル用のスレッドプールで実行される)"""
+    if not os.path.exists(img_path):
+        print(f"⚠️ Image file not found or is remote: {img_path}")
+        return
     try:
-        index = int(index)
-    except:
+        os.remove(img_path)
+        note_file_removed(img_path)
+        print(f"🗑️ Deleted image file: {img_path}")
+        
+        # サムネイルも削除
+        thumb_dir = "thumbnails"
+        fname = os.path.basename(img_path)
+        name, _ = os.path.splitext(fname)
+        thumb_path = os.path.join(thumb_dir, f"thumb_{name}.webp")
+        if os.path.exists(thumb_path):
+            os.remove(thumb_path)
+            note_file_removed(thumb_path)
+    except Exception as e:
+        print(f"❌ Failed to delete image file: {e}")
+
+def delete_history_entries(config, history, entry_ids):
+    """
+    複数のエントリを画像・サムネイルごと削除し、履歴 (HistoryList) を返す。
+    履歴の更新と保存は件数によらず1回だけ行い、ファイルの削除はスレッドプールに任せてすぐに戻る。
+    """
+    history = as_history_list(history)
+    items = [item for item in (history.get_entry(i) for i in dict.fromkeys(entry_ids)) if item is not None]
+    if not items:
         return history
 
-    if 0 <= index < len(history):
-        item = history[index]
+    pool = get_file_pool()
+    for item in items:
         img_path = resolve_image_path(item, config)
-        
-        print(f"[DEBUG] Attempting to delete: {img_path}")
-
-        if img_path and os.path.exists(img_path) and not str(img_path).lower().startswith("http"):
-            try:
-                os.remove(img_path)
-                print(f"🗑️ Deleted image file: {img_path}")
-                
-                # サムネイルも削除
-                thumb_dir = "thumbnails"
-                fname = os.path.basename(img_path)
-                name, _ = os.path.splitext(fname)
-                thumb_path = os.path.join(thumb_dir, f"thumb_{name}.webp")
-                if os.path.exists(thumb_path):
-                    os.remove(thumb_path)
-            except Exception as e:
-                print(f"❌ Failed to delete image file: {e}")
+        if img_path and not str(img_path).lower().startswith("http"):
+            pool.submit(remove_entry_files, img_path)
         else:
             print(f"⚠️ Image file not found or is remote: {img_path}")
 
-        history.pop(index)
+    history.remove_entries([item["id"] for item in items])
+    # 削除したエントリの画像パスの解決結果はもう使わない
+    with _resolved_lock:
+        for item in items:
+            _resolved_cache.pop(item.get("image", ""), None)
+    
+    try:
+        append_history_records(config, [{"op": "delete", "id": item["id"]} for item in items])
+        print(f"✅ History updated ({len(items)} deleted).")
+    except Exception as e:
+        print(f"❌ Failed to save history: {e}")
         
-        path = config.get("history_file_path", "history.json")
-        try:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(history, f, indent=4, ensure_ascii=False)
-            print("✅ History JSON updated.")
-        except Exception as e:
-            print(f"❌ Failed to save history JSON: {e}")
-            
-        return history
     return history
 
+def set_favorites(config, history, entry_ids, value):
+    """複数のエントリのお気に入り状態をまとめて変更する (保存は1回)。変更した件数を返す"""
+    history = as_history_list(history)
+    changed = history.mark_favorites(entry_ids, value)
+    if changed:
+        append_history_records(config, [{"op": "fav", "id": entry_id, "value": bool(value)} for entry_id in changed])
+    return len(changed)
+
+def get_entry_time(entry):
+    """エントリの作成時刻 (timestamp が無い古いエントリは None)"""
+    value = entry.get("timestamp")
+    return float(value) if isinstance(value, (int, float)) else None
+
+def _merge_by_time(history, entries):
+    """
+    (新しく加えるエントリの古い順のリスト, 並べ直した履歴) を返す。
+    全て既存のエントリより新しければ並べ直す必要が無いので、履歴は None になる。
+    """
+    known = {item.get("id") for item in history}
+    entries = sorted((e for e in entries if e.get("id") not in known), key=lambda e: get_entry_time(e) or 0.0)
+    if not entries:
+        return entries, None
+    times = [t for t in (get_entry_time(item) for item in history) if t is not None]
+    if not times or (get_entry_time(entries[0]) or 0.0) >= max(times):
+        return entries, None
+
+    # 新しい順の履歴に、取り込んだものを新しい順に差し込む。timestamp の無いエントリは直前 (より新しい側) の時刻とみなす
+    incoming = entries[::-1]
+    merged = []
+    i = 0
+    current = float("inf")
+    for item in history:
+        t = get_entry_time(item)
+        if t is not None:
+            current = t
+        while i < len(incoming) and (get_entry_time(incoming[i]) or 0.0) > current:
+            merged.append(incoming[i])
+            i += 1
+        merged.append(item)
+    merged.extend(incoming[i:])
+    return entries, merged
+
+def merge_history_entries(config, history, entries):
+    """
+    外部から取り込んだエントリ (順不同) を timestamp の順で履歴に混ぜて保存する。
+    全て既存のエントリより新しければ先頭への追加 (ログへの追記) で済ませ、
+    古いものが混ざる場合は途中に入るので、並べ直した履歴全体をスナップショットとして書き直す。
+    読み込みから保存までロックを持ち、その間に生成されたエントリが書き直しで消えないようにする。
+    """
+    history = as_history_list(history)
+    if isinstance(history, DbHistory):
+        added = []
+        def transform(current):
+            new, merged = _merge_by_time(current, entries)
+            added.extend(new)
+            return merged
+        if history_db.rewrite_all(config, transform):
+            history.touch()
+        elif added:
+            append_history_records(config, [{"op": "add", "entry": entry} for entry in added])
+        return
+
+    with history._lock:
+        new, merged = _merge_by_time(list(history), entries)
+        if not new:
+            return
+        if merged is None:
+            history.add_many_front(new)
+            append_history_records(config, [{"op": "add", "entry": entry} for entry in new])
+            return
+        save_history_json(config, merged)
+        if history is not _shared_store["history"]:
+            history.replace_entries(merged)
+
+def iter_history_export(config, entry_ids):
+    """選択したエントリの元画像と設定 (.json / .txt) を ZIP にして、バイト列を順に返すジェネレータ"""
+    items = [item for item in (find_history_entry(config, i) for i in dict.fromkeys(entry_ids)) if item is not None]
+    return history_export.iter_export_zip(items, lambda item: resolve_image_path(item, config))
+
+def sync_shared_history(history):
+    """履歴全体を書き直した時に、共有の履歴の中身も合わせる"""
+    store = _shared_store["history"]
+    if store is not None:
+        # 共有の履歴そのものが渡された場合も、ID を振り直した分の索引を作り直す
+        store.replace_entries(list(history))
+
 def clear_history(config):
-    # (変更なし)
-    path = config.get("history_file_path", "history.json")
-    if os.path.exists(path):
-        # バックアップ関数を呼ぶならここで呼ぶ
+    if use_sqlite(config):
         try:
-            os.remove(path)
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump([], f)
-            return True
-        except:
+            history_db.clear(config)
+        except Exception as e:
+            print(f"❌ Failed to clear history: {e}")
             return False
-    return False
\ No newline at end of file
+        sync_shared_history([])
+        return True
+    sync_shared_history([])
+    history_search.reset()
+    enqueue_history_write(config, "clear")
+    return True
@@ -0,0 +1,87 @@
+# tests/test_backend_pool.py
+# バックエンドプールの選択 (comfy_utils.select_backend) を、/queue だけを返すスタブの HTTP サーバーで確認する。
+# 実行: python -m pytest -q tests (または python -m unittest discover tests)
+import json
+import os
+import socket
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import comfy_utils
+
+class _QueueHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/queue" or self.server.queue is None:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.queue).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def _queue(running, pending):
+    """ComfyUI の /queue と同じ形 (中身は件数だけ合わせる)"""
+    return {"queue_running": [[i] for i in range(running)], "queue_pending": [[i] for i in range(pending)]}
+
+def _closed_url():
+    """何も待ち受けていないポートの URL"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+class SelectBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def start_backend(self, queue):
+        """/queue が queue を返すスタブを起動して URL を返す (queue が None なら 500 を返す)"""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _QueueHandler)
+        server.queue = queue
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    def select(self, primary, backends):
+        return comfy_utils.select_backend(primary, {"comfy_backends": backends})
+
+    def test_picks_least_loaded_backend(self):
+        primary = self.start_backend(_queue(1, 2))
+        idle = self.start_backend(_queue(0, 0))
+        busy = self.start_backend(_queue(1, 0))
+        self.assertEqual(self.select(primary, [busy, idle]), idle)
+
+    def test_tie_goes_to_primary(self):
+        primary = self.start_backend(_queue(1, 0))
+        other = self.start_backend(_queue(0, 1))
+        self.assertEqual(self.select(primary, [other]), primary)
+
+    def test_skips_unhealthy_backends(self):
+        primary = self.start_backend(None)
+        healthy = self.start_backend(_queue(1, 3))
+        self.assertEqual(self.select(primary, [_closed_url(), healthy]), healthy)
+
+    def test_falls_back_to_primary_when_none_healthy(self):
+        primary = self.start_backend(None)
+        self.assertEqual(self.select(primary, [_closed_url()]), primary)
+
+    def test_single_backend_is_not_probed(self):
+        primary = _closed_url()
+        self.assertEqual(self.select(primary + "/", []), primary)
+
+if __name__ == "__main__":
+    unittest.main()
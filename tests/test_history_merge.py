@@ -0,0 +1,89 @@
+# tests/test_history_merge.py
+# PNG の取り込みなどで履歴全体を書き直す merge_history_entries の途中に生成結果が届いても、そのエントリが失われないことを確認する。
+# 実行: python -m pytest -q tests (または python -m unittest discover tests)
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import history_utils
+
+IMAGE_INFO = {"filename": "new.png", "subfolder": "", "type": "output"}
+
+class MergeDuringGenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self._merge_by_time = history_utils._merge_by_time
+        history_utils._shared_store["history"] = None
+
+    def tearDown(self):
+        history_utils._merge_by_time = self._merge_by_time
+        history_utils.flush_history_writes()
+        history_utils._shared_store["history"] = None
+        history_utils.configure_history_store({})
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def make_config(self, backend):
+        config = {
+            "history_file_path": os.path.join(self.dir, "history.json"),
+            "history_backend": backend,
+            "history_db_path": os.path.join(self.dir, "history.db"),
+            "history_write_delay": 0.05,
+        }
+        history_utils.configure_history_store(config)
+        return config
+
+    def merge_with_concurrent_add(self, config):
+        """古い画像の取り込み (全体の書き直しになる) の最中に、別スレッドで生成結果を履歴に追加する"""
+        history = history_utils.get_shared_history(config)
+        history_utils.save_history_json(config, [
+            {"id": "new", "timestamp": 300.0, "prompt": "a"},
+            {"id": "old", "timestamp": 100.0, "prompt": "b"},
+        ])
+        added = {}
+
+        def add():
+            added["entry"] = history_utils.add_to_history(config, {"prompt": "generated"}, IMAGE_INFO, "http://127.0.0.1:8188")
+
+        def merge_by_time(current, entries):
+            result = self._merge_by_time(current, entries)
+            thread = threading.Thread(target=add)
+            thread.start()
+            # 追加側がロックで待たされていなければ、ここで追加が済んでしまう
+            thread.join(0.3)
+            threads.append(thread)
+            return result
+
+        threads = []
+        history_utils._merge_by_time = merge_by_time
+        history_utils.merge_history_entries(config, history, [{"id": "imported", "timestamp": 200.0, "prompt": "c"}])
+        for thread in threads:
+            thread.join(5)
+        history_utils.flush_history_writes()
+        return history, added["entry"]["id"]
+
+    def reload(self, config):
+        history_utils._shared_store["history"] = None
+        return history_utils.get_shared_history(config)
+
+    def test_jsonl_keeps_entry_added_during_merge(self):
+        config = self.make_config("jsonl")
+        history, added_id = self.merge_with_concurrent_add(config)
+        self.assertIsNotNone(history.get_entry(added_id))
+        self.assertEqual([h["id"] for h in history][1:], ["new", "imported", "old"])
+        on_disk = self.reload(config)
+        self.assertEqual([h["id"] for h in on_disk], [added_id, "new", "imported", "old"])
+
+    def test_sqlite_keeps_entry_added_during_merge(self):
+        config = self.make_config("sqlite")
+        _, added_id = self.merge_with_concurrent_add(config)
+        on_disk = self.reload(config)
+        self.assertIsNotNone(on_disk.get_entry(added_id))
+        self.assertEqual([h["id"] for h in on_disk], [added_id, "new", "imported", "old"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+# thumbnail_manager.py
+# 履歴のサムネイルをバックグラウンドのプロセスプールで作成する。
+# 起動時に履歴を新しい順に走査して足りないサムネイルを作り (ウォームアップ)、ギャラリー表示中に見つかった不足分もここに回す。
+# 作成待ちの間、ギャラリーにはプレースホルダー画像を表示して画像のデコードを待たない。
+import os
+import threading
+import time
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+THUMBNAIL_SIZE = (350, 350)
+PLACEHOLDER_NAME = "_placeholder.webp"
+DHASH_SIZE = 8 # dHash は 8x8 = 64bit
+COMPLETED_MEMORY = 1000 # 完成時刻を覚えておく件数 (再描画の判定は直前の確認以降の分しか見ないので、最近の分だけで足りる)
+FAILED_MEMORY = 10000   # 失敗を覚えておく元画像の件数 (あふれた古いものは次に表示された時に1回だけ作り直しを試す)
+
+_lock = threading.Lock()
+_pool = {"executor": None, "workers": None}
+_pending = {}     # サムネイルのパス -> Future
+_completed = collections.OrderedDict() # サムネイルのパス -> 完成 (または失敗) した時刻 (ギャラリーの再描画判定用)。古い順
+_queued = set()   # ウォームアップの順番待ちのサムネイルのパス
+_failed = collections.OrderedDict()    # 作成に失敗した元画像のパス -> その時の更新時刻 (同じファイルのままなら作り直さない)。古い順
+_progress = {"total": 0, "done": 0, "failed": 0, "warming": False, "last_completed": 0}
+
+def make_thumbnail(src_path, thumb_path):
+    """
+    元画像から WebP サムネイルを作る (ワーカープロセスで実行される)。
+    書き込み途中のファイルが表示されないよう、一時ファイルに保存してから置き換える。
+    """
+    tmp_path = thumb_path + ".tmp"
+    try:
+        with Image.open(src_path) as img:
+            # JPEG は縮小しながらデコードできるので、フル解像度での展開を避ける
+            img.draft("RGB", (THUMBNAIL_SIZE[0] * 2, THUMBNAIL_SIZE[1] * 2))
+            img.thumbnail(THUMBNAIL_SIZE)
+            img.save(tmp_path, "WEBP", quality=80)
+        os.replace(tmp_path, thumb_path)
+    except Exception:
+        # 壊れた画像などで途中まで書いた一時ファイルを残さない
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return thumb_path
+
+def compute_dhash(thumb_path):
+    """
+    サムネイルから 64bit の dHash (横に隣り合う画素の明暗の差) を計算する (ワーカープロセスで実行される)。
+    読めなければ None
+    """
+    try:
+        with Image.open(thumb_path) as img:
+            pixels = list(img.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(DHASH_SIZE):
+        offset = row * (DHASH_SIZE + 1)
+        for col in range(DHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def get_placeholder_path(thumb_dir):
+    """作成待ちの間に表示するプレースホルダー画像 (無ければ作る)"""
+    path = os.path.join(thumb_dir, PLACEHOLDER_NAME)
+    if not os.path.exists(path):
+        Image.new("RGB", THUMBNAIL_SIZE, (64, 64, 64)).save(path, "WEBP", quality=50)
+    return path
+
+def configure(config):
+    """ワーカー数を設定する (0 以下なら CPU コア数 - 1)。プールは最初の依頼時に作る"""
+    workers = int(config.get("thumbnail_workers", 0) or 0)
+    _pool["workers"] = workers if workers > 0 else max(1, (os.cpu_count() or 2) - 1)
+
+def get_executor():
+    with _lock:
+        if _pool["executor"] is None:
+            if not _pool["workers"]:
+                _pool["workers"] = max(1, (os.cpu_count() or 2) - 1)
+            _pool["executor"] = ProcessPoolExecutor(max_workers=_pool["workers"])
+        return _pool["executor"]
+
+def is_pending(thumb_path):
+    with _lock:
+        return thumb_path in _pending
+
+def _source_stamp(src_path):
+    try:
+        return os.stat(src_path).st_mtime_ns
+    except (OSError, TypeError, ValueError):
+        return None
+
+def _remember(table, key, value, limit):
+    """件数に上限のある記録に追加する (_lock を持って呼ぶ)"""
+    table[key] = value
+    table.move_to_end(key)
+    while len(table) > limit:
+        table.popitem(last=False)
+
+def has_failed(src_path):
+    """この元画像のサムネイル作成が前回失敗していて、その後ファイルが変わっていないか"""
+    with _lock:
+        if src_path not in _failed:
+            return False
+        stamp = _failed[src_path]
+    if _source_stamp(src_path) == stamp:
+        return True
+    # 置き換えられていれば作り直せるかもしれない
+    with _lock:
+        _failed.pop(src_path, None)
+    return False
+
+def request_thumbnail(src_path, thumb_path, on_done=None):
+    """
+    サムネイル作成をプールに登録し、Future を返す (作成中なら既存の Future)。
+    on_done(thumb_path) は完成時にメインプロセスのスレッドから呼ばれる。
+    前回失敗した元画像がそのままなら、作り直さずに None を返す (プレースホルダーで待たせない)。
+    """
+    if has_failed(src_path):
+        return None
+    stamp = _source_stamp(src_path)
+    executor = get_executor()
+    with _lock:
+        future = _pending.get(thumb_path)
+        if future is not None:
+            return future
+        future = executor.submit(make_thumbnail, src_path, thumb_path)
+        _pending[thumb_path] = future
+        _queued.discard(thumb_path)
+        _progress["total"] += 1
+
+    def finished(f):
+        error = f.exception() if not f.cancelled() else None
+        with _lock:
+            _pending.pop(thumb_path, None)
+            if f.cancelled() or error is not None:
+                _progress["failed"] += 1
+                if error is not None:
+                    _remember(_failed, src_path, stamp, FAILED_MEMORY)
+                    # 作成待ちの表示のままにしないよう、ギャラリーを描き直させる
+                    _progress["last_completed"] = time.time()
+                    _remember(_completed, thumb_path, _progress["last_completed"], COMPLETED_MEMORY)
+            else:
+                _progress["last_completed"] = time.time()
+                _remember(_completed, thumb_path, _progress["last_completed"], COMPLETED_MEMORY)
+                _progress["done"] += 1
+        if error is not None:
+            print(f"⚠️ Thumbnail creation failed: {src_path} ({error})")
+        elif not f.cancelled() and on_done is not None:
+            on_done(thumb_path)
+    future.add_done_callback(finished)
+    return future
+
+def last_completed_time():
+    return _progress["last_completed"]
+
+def completed_since(thumb_paths, since):
+    """thumb_paths のうち since 以降に完成したものがあるか"""
+    with _lock:
+        return any(_completed.get(p, 0) >= since for p in thumb_paths)
+
+def start_warmup(get_jobs, on_done=None):
+    """
+    足りないサムネイルを順に作るスレッドを開始する。
+    get_jobs() は (元画像のパス, サムネイルのパス) を新しい順に返すイテレータ (スレッド内で呼ぶので重い走査でもよい)。
+    一度に登録するのはワーカー数の2倍までにして、ギャラリーからの依頼が待たされないようにする。
+    """
+    def run():
+        _progress["warming"] = True
+        try:
+            jobs = [job for job in get_jobs() if not is_pending(job[1])]
+            with _lock:
+                _queued.update(thumb_path for _, thumb_path in jobs)
+            slots = threading.Semaphore(max(1, (_pool["workers"] or 1) * 2))
+            for src_path, thumb_path in jobs:
+                # 順番待ちの間にギャラリー側の依頼で作られたものは飛ばす
+                with _lock:
+                    if thumb_path not in _queued:
+                        continue
+                if os.path.exists(thumb_path):
+                    with _lock:
+                        _queued.discard(thumb_path)
+                    continue
+                slots.acquire()
+                future = request_thumbnail(src_path, thumb_path, on_done)
+                if future is None:
+                    # 前回作れなかった画像
+                    slots.release()
+                    with _lock:
+                        _queued.discard(thumb_path)
+                    continue
+                future.add_done_callback(lambda f: slots.release())
+        except Exception as e:
+            print(f"⚠️ Thumbnail warm-up stopped: {e}")
+        finally:
+            with _lock:
+                _queued.clear()
+            _progress["warming"] = False
+
+    threading.Thread(target=run, daemon=True).start()
+
+def get_progress_text():
+    """History タブに表示する進捗 (作るものが無ければ空文字)"""
+    with _lock:
+        total, done, failed, pending = _progress["total"] + len(_queued), _progress["done"], _progress["failed"], len(_pending)
+    if not total:
+        return ""
+    if pending or _progress["warming"]:
+        return f"🖼️ Generating thumbnails... {done + failed} / {total}"
+    return f"🖼️ Thumbnails ready ({done} created" + (f", {failed} failed)" if failed else ")")
+
+def shutdown():
+    with _lock:
+        executor = _pool["executor"]
+        _pool["executor"] = None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -1,11 +1,20 @@
 import gradio as gr
 import generation_manager
+import comfy_utils
 import system_manager
 import config_utils
 import history_utils
+import history_export
+import history_ingest
+import history_dedup
+import thumbnail_manager
 import pandas as pd
 import traceback
-from urllib.parse import urlparse
+import random
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, quote
 
 def clean_url(url):
     if not url: return ""
@@ -13,28 +22,72 @@ def clean_url(url):
 
 GALLERY_PER_PAGE = 60
 
-def get_gallery_display_data(history, config, page=0, show_favs=False):
-    if show_favs:
-        # お気に入りのみ抽出
-        target_history = [h for h in history if h.get("is_favorite", False)]
-    else:
-        target_history = history
-        
-    start = page * GALLERY_PER_PAGE
-    end = start + GALLERY_PER_PAGE
-    subset = target_history[start:end]
-    return [(history_utils.resolve_thumbnail_path(item, config), item.get("caption", "")) for item in subset]
-
-def get_page_label(page, history, show_favs=False):
-    if show_favs:
-        target_history = [h for h in history if h.get("is_favorite", False)]
-    else:
-        target_history = history
-        
-    total = len(target_history)
+def get_gallery_display_data(history, config, page=0, show_favs=False, query="", request=None, selected=None):
+    # 表示するページ分だけを取得する (SQLite ではお気に入り・検索の絞り込みも含めてインデックスで引く)
+    subset = history_utils.get_history_page(history, page, GALLERY_PER_PAGE, show_favs, query)
+    base_url = get_media_base_url(request)
+    selected = set(selected or ())
+    # 複数選択中のエントリはキャプションに印を付ける
+    return [(get_thumbnail_value(item, config, base_url), ("☑ " if item.get("id") in selected else "") + item.get("caption", ""))
+            for item in subset]
+
+def get_thumbnail_value(item, config, base_url):
+    """ギャラリーに渡すサムネイル (/thumb/{id} の URL、起点の URL が分からなければファイルのパス)"""
+    if base_url is None:
+        return history_utils.resolve_thumbnail_path(item, config)
+    # /thumb/{id} の URL を渡すと、Gradio はファイルをキャッシュにコピーせずブラウザに直接読み込ませる
+    return history_utils.resolve_thumbnail_url(item, config, base_url)
+
+def get_media_base_url(request):
+    """ブラウザからアクセスされている URL の起点 (app.py の /thumb・/original 用)。分からなければ None"""
+    if request is None:
+        return None
+    headers = request.headers
+    host = headers.get("x-forwarded-host") or headers.get("host")
+    if not host:
+        return None
+    scheme = headers.get("x-forwarded-proto") or getattr(getattr(request, "url", None), "scheme", None) or "http"
+    return f"{scheme}://{host}"
+
+def get_original_preview_html(item):
+    """Original Image Preview 用の HTML (/original/{id} を直接表示し、Gradio のキャッシュへのコピーを避ける)"""
+    if not item.get("id"):
+        return ""
+    return f'<img src="/original/{quote(item["id"])}" style="max-width:100%; height:auto;" loading="lazy">'
+
+def poll_history_updates(history, config, page, show_favs, query, last_tick, cursor, selected=None, request: gr.Request = None):
+    """
+    History タブの定期更新 (gr.Timer から呼ばれる)。
+    履歴は全セッションで共有しているので、他の端末での生成・削除・お気に入りで version が進んでいればギャラリーを描き直す。
+    表示中のページのサムネイルが前回以降に出来上がった時も描き直す。
+    """
+    now = time.time()
+    history = history_utils.as_history_list(history)
+    version = history.version
+    changed = version != cursor
+    if not changed and thumbnail_manager.last_completed_time() >= (last_tick or 0):
+        subset = history_utils.get_history_page(history, page, GALLERY_PER_PAGE, show_favs, query)
+        thumb_paths = [history_utils.get_thumbnail_target(item, config)[1] for item in subset]
+        changed = thumbnail_manager.completed_since([p for p in thumb_paths if p], last_tick or 0)
+    progress = thumbnail_manager.get_progress_text()
+    if not changed:
+        return gr.update(), gr.update(), gr.update(), progress, now, version
+    # 削除でページ数が減っていれば最後のページに合わせる
+    page = min(page, get_max_page(history, show_favs, query))
+    return (get_gallery_display_data(history, config, page, show_favs, query, request, selected), page,
+            get_page_label(page, history, show_favs, query), progress, now, version)
+
+def get_max_page(history, show_favs=False, query=""):
+    total = history_utils.count_history(history, show_favs, query)
+    return max(0, (total - 1) // GALLERY_PER_PAGE)
+
+def get_page_label(page, history, show_favs=False, query=""):
+    total = history_utils.count_history(history, show_favs, query)
     max_page = max(0, (total - 1) // GALLERY_PER_PAGE)
     
     mode_label = " (Favorites)" if show_favs else ""
+    if query and query.strip():
+        mode_label += f" (Search: {query.strip()})"
     return f"Page {page + 1} / {max_page + 1} (Total: {total}){mode_label}"
 
 def parse_tagged_str(input_str):
@@ -77,70 +130,196 @@ def handle_save_settings(url, bat_path, backup_path, real_out_path, workflow_fil
     )
     return "✅ 保存完了。再起動後に反映されます。" if success else "❌ 保存失敗。"
 
-def predict(prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, history, ckpt_name, 
-            l1_name, l1_str, turbo_lora_en, highres_lora_en, detail_lora_en, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str, quality_tags, 
-            y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, decade_tags, period_tags, meta_tags, safety_tags, artist_tags, artist_random_en, artist_random_num, artist_tags_list, custom_tags, current_comfy_url, config, workflow_file,
-            lllite_en=False, lllite_model="None", lllite_img=None, lllite_str=1.0, lllite_start=0.0, lllite_end=1.0, lllite_auto_res=True):
-    
+def prepare_prompt_inputs(prompt, neg_prompt, artist_tags, artist_random_en, artist_random_num, artist_tags_list):
+    """生成前のプロンプト前処理 (アンダースコア置換・ランダムアーティスト抽出)"""
     # プロンプトのクリーニング処理 (アンダースコアをスペースに変換、scoreタグは除外)
     prompt = process_underscores(prompt)
     neg_prompt = process_underscores(neg_prompt)
     artist_tags = process_underscores(artist_tags)
 
     if artist_random_en and artist_tags_list:
-        import random
         num = int(artist_random_num)
         sampled_artists = random.sample(artist_tags_list, min(num, len(artist_tags_list)))
         if artist_tags:
             artist_tags = artist_tags + ", " + ", ".join(sampled_artists)
         else:
             artist_tags = ", ".join(sampled_artists)
+    return prompt, neg_prompt, artist_tags
+
+def predict(prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, history, ckpt_name, 
+            l1_name, l1_str, turbo_lora_en, highres_lora_en, detail_lora_en, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str, quality_tags, 
+            y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, decade_tags, period_tags, meta_tags, safety_tags, artist_tags, artist_random_en, artist_random_num, artist_tags_list, custom_tags, current_comfy_url, config, workflow_file,
+            lllite_en=False, lllite_model="None", lllite_img=None, lllite_str=1.0, lllite_start=0.0, lllite_end=1.0, lllite_auto_res=True, batch_size=1, request: gr.Request = None):
+    """通常生成 (Generate ボタン)。進行状況・プレビューを流しながら最終結果を表示するジェネレーター"""
+    prompt, neg_prompt, artist_tags = prepare_prompt_inputs(prompt, neg_prompt, artist_tags, artist_random_en, artist_random_num, artist_tags_list)
 
     try:
-        output_image, status, saved_entry = generation_manager.generate_and_save(
+        output_images, status, saved_entries = None, "❌ Error: no result", None
+        preview_interval = float(config.get("live_preview_interval", 0.5))
+        # 生成中はステップ数とプレビュー画像を逐次表示し、結果を待たずに Stop / 再生成を判断できるようにする
+        for event in generation_manager.generate_and_save_stream(
             prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, 
             ckpt_name, l1_name, l1_str, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str,
             turbo_lora_en, highres_lora_en, detail_lora_en,
             quality_tags, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, 
             decade_tags, period_tags, meta_tags, safety_tags, artist_tags, custom_tags, 
             current_comfy_url, workflow_file, config,
-            lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res
-        )
-        if saved_entry:
-            history.insert(0, saved_entry)
+            lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res,
+            batch_size, get_session_id(request), preview_interval
+        ):
+            if event[0] == "progress":
+                yield gr.update(), f"⏳ Sampling... {event[1]}/{event[2]}", history, gr.update(), gr.update(), gr.update()
+            elif event[0] == "preview":
+                yield event[1], gr.update(), history, gr.update(), gr.update(), gr.update()
+            elif event[0] == "result":
+                output_images, status, saved_entries = event[1], event[2], event[3]
+        # バッチ生成時も Result には1枚目を表示する (全画像は履歴に追加される)
+        output_image = output_images[0] if output_images else None
+        if saved_entries:
+            history = history_utils.as_history_list(history)
+            for saved_entry in saved_entries:
+                history.add_front(saved_entry)
             # 生成後は1ページ目(index 0)に戻す
-            return output_image, status, history, get_gallery_display_data(history, config, 0), 0, get_page_label(0, history, False)
-        return output_image, status, history, gr.update(), gr.update(), gr.update()
+            yield output_image, status, history, get_gallery_display_data(history, config, 0, request=request), 0, get_page_label(0, history, False)
+            return
+        yield output_image, status, history, gr.update(), gr.update(), gr.update()
     except Exception as e:
         print("\n[ERROR] Unhandled Exception in predict:")
         traceback.print_exc()
-        return None, f"❌ System Error: {str(e)}", history, gr.update(), gr.update(), gr.update()
+        yield None, f"❌ System Error: {str(e)}", history, gr.update(), gr.update(), gr.update()
 
 def continuous_predict(prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, history, ckpt_name, 
             l1_name, l1_str, turbo_lora_en, highres_lora_en, detail_lora_en, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str, quality_tags, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, decade_tags, period_tags, meta_tags, safety_tags, artist_tags, artist_random_en, artist_random_num, artist_tags_list, custom_tags, current_comfy_url, config, workflow_file,
-            lllite_en=False, lllite_model="None", lllite_img=None, lllite_str=1.0, lllite_start=0.0, lllite_end=1.0, lllite_auto_res=True):
-    """連続生成(Auto Gen)用のジェネレーター関数（50件で自動停止）"""
+            lllite_en=False, lllite_model="None", lllite_img=None, lllite_str=1.0, lllite_start=0.0, lllite_end=1.0, lllite_auto_res=True, batch_size=1, inflight_depth=1, request: gr.Request = None):
+    """
+    連続生成(Auto Gen)用のジェネレーター関数（50件で自動停止）
+    inflight_depth 件までのジョブを ComfyUI のキューに積んだまま実行し、
+    画像のダウンロード・サムネイル作成・履歴保存は次のジョブの実行中にバックグラウンドで行う。
+    Stop やブラウザを閉じてキャンセルされた場合は、送信済みのジョブも ComfyUI 側で中止する。
+    """
+    owner = get_session_id(request)
+    history = history_utils.as_history_list(history)
     auto_images = []
-    
-    for i in range(50):
-        # 既存のpredict関数を呼び出して画像を1枚生成
-        output_image, status, new_history, _, _, _ = predict(
-            prompt, neg_prompt, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, history, ckpt_name, 
-            l1_name, l1_str, turbo_lora_en, highres_lora_en, detail_lora_en, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str, quality_tags, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, decade_tags, period_tags, meta_tags, safety_tags, artist_tags, artist_random_en, artist_random_num, artist_tags_list, custom_tags, current_comfy_url, config, workflow_file,
-            lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res
+    errors = []
+    job_timeout = config.get("comfy_job_timeout", comfy_utils.DEFAULT_JOB_TIMEOUT)
+    depth = max(1, int(inflight_depth or 1))
+
+    def submit_next():
+        # 1件分のワークフローを組み立てて送信する (ランダムシード・ランダムアーティストは毎回再抽選)
+        p, n, a = prepare_prompt_inputs(prompt, neg_prompt, artist_tags, artist_random_en, artist_random_num, artist_tags_list)
+        workflow, new_entry, status = generation_manager.build_generation(
+            p, n, trigger_first, enable_negpip, seed, randomize_seed, cfg, steps, width, height, sampler_name, 
+            ckpt_name, l1_name, l1_str, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str,
+            turbo_lora_en, highres_lora_en, detail_lora_en,
+            quality_tags, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, 
+            decade_tags, period_tags, meta_tags, safety_tags, a, custom_tags, 
+            current_comfy_url, workflow_file, config,
+            lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res,
+            batch_size
         )
-        
-        history = new_history
-        if output_image is not None:
-            # スマホで下にスクロールしながら見れるように、リストの末尾に追加する
-            auto_images.append(output_image)
-            
-        # UIに現在の状態をストリーミング更新する
-        yield auto_images, f"⏳ **Status:** Auto Generating... ({len(auto_images)}/50)", history
-        
+        if workflow is None:
+            raise RuntimeError(status)
+        # ジョブごとに最も空いているバックエンドが選ばれるため、複数台あれば自然に分散される
+        job = comfy_utils.submit_prompt(workflow, new_entry["backend"], owner)
+        job["entry"] = new_entry
+        return job
+
+    def collect(job, outputs):
+        # ダウンロード → 履歴保存 (サムネイル作成を含む) を行う。保存順を保つため1スレッドで実行する
+        results = comfy_utils.fetch_output_images(job, outputs, generation_manager.get_local_output_dir(config, job, current_comfy_url))
+        saved_entries = generation_manager.save_generation(config, job["entry"], results, job["comfy_url"])
+        return [img for img, _ in results], saved_entries
+
+    def status_text():
+        msg = f"⏳ **Status:** Auto Generating... ({finished_jobs}/50)"
+        if errors:
+            msg += f"\n\n❌ {errors[-1]}"
+        return msg
+
+    queued = collections.deque()     # ComfyUI に送信済みのジョブ
+    collecting = collections.deque() # ダウンロード・保存中の Future
+    submitted = 0
+    finished_jobs = 0
+    collector = ThreadPoolExecutor(max_workers=1)
+
+    def drain(block=False):
+        # 完了した収集処理を順番に取り出して UI 用の状態に反映する
+        nonlocal finished_jobs
+        while collecting and (block or collecting[0].done()):
+            future = collecting.popleft()
+            finished_jobs += 1
+            try:
+                output_images, saved_entries = future.result()
+                for saved_entry in saved_entries:
+                    history.add_front(saved_entry)
+                # スマホで下にスクロールしながら見れるように、リストの末尾に追加する
+                auto_images.extend(output_images)
+            except Exception as e:
+                traceback.print_exc()
+                errors.append(f"Error: {e}")
+
+    def fill_queue():
+        # キューが inflight_depth 件になるまで次のジョブを積む
+        nonlocal submitted
+        while submitted < 50 and len(queued) < depth:
+            submitted += 1
+            try:
+                queued.append(submit_next())
+            except Exception as e:
+                traceback.print_exc()
+                errors.append(f"Error: {e}")
+
+    try:
+        fill_queue()
+        while queued:
+            # 先頭のジョブの完了を待ち、結果の収集はバックグラウンドへ回す
+            job = queued.popleft()
+            try:
+                outputs = comfy_utils.wait_for_job(job, job_timeout)
+                collecting.append(collector.submit(collect, job, outputs))
+            except Exception as e:
+                if comfy_utils.is_cancelled(job):
+                    # Stop が押された: 新しいジョブは送信せずに終了する (残りは finally で中止)
+                    break
+                traceback.print_exc()
+                errors.append(f"Error: {e}")
+
+            # 次のジョブを先に送信してから、UIに現在の状態をストリーミング更新する
+            fill_queue()
+            drain()
+            yield auto_images, status_text(), history
+
+        drain(block=True)
+    finally:
+        # 途中で止められた場合、まだ待っていないジョブは ComfyUI のキューから削除する
+        for job in queued:
+            comfy_utils.cancel_job(job)
+            comfy_utils.close_job(job)
+        collector.shutdown(wait=False)
+
     # 50件到達時の完了ステータス
     yield auto_images, f"✅ **Status:** Finished. (Total generated: {len(auto_images)})", history
 
+def get_session_id(request):
+    """ジョブの持ち主を識別するための Gradio セッションID (取得できなければ None)"""
+    return getattr(request, "session_hash", None) if request is not None else None
+
+def stop_generation(request: gr.Request = None):
+    """Stop ボタン: このセッションが ComfyUI に送信した実行中・待機中のジョブを中止する"""
+    cancelled = comfy_utils.cancel_owner_jobs(get_session_id(request))
+    if cancelled:
+        return gr.update(value=f"**Status:** ⏹️ Stopped ({cancelled} job(s) cancelled on ComfyUI)")
+    return gr.update(value="**Status:** ⏹️ Stopped")
+
+def stop_predict(request: gr.Request = None):
+    """Generate タブの Stop ボタン: 生成中のジョブを中止する"""
+    cancelled = comfy_utils.cancel_owner_jobs(get_session_id(request))
+    return "⏹️ Stopped" if cancelled else gr.update()
+
+def cancel_session_jobs(request: gr.Request = None):
+    """タブを閉じた・リロードした時に、そのセッションの未完了ジョブを中止する"""
+    comfy_utils.cancel_owner_jobs(get_session_id(request))
+
 def check_server_status(url):
     target = clean_url(url)
     try:
@@ -152,11 +331,11 @@ def launch_server(bat, url):
     if not bat: return "❌ Path is empty."
     return system_manager.launch_comfy(bat, clean_url(url)) or "🚀 Process Started"
 
-def send_to_chat_action(idx, history, config):
-    if idx < 0 or not history or idx >= len(history):
+def send_to_chat_action(entry_id, history, config):
+    item = history_utils.get_history_entry(history, entry_id)
+    if item is None:
         return gr.update(), gr.update()
         
-    item = history[idx]
     img_path = history_utils.resolve_image_path(item, config)
     
     parts = []
@@ -199,26 +378,28 @@ def send_to_chat_action(idx, history, config):
     msg_text = full_prompt
     return img_path, msg_text
 
-def send_to_lllite_action(idx, history, config):
-    if idx < 0 or not history or idx >= len(history):
+def send_to_lllite_action(entry_id, history, config):
+    item = history_utils.get_history_entry(history, entry_id)
+    if item is None:
         return gr.update()
         
-    item = history[idx]
     img_path = history_utils.resolve_image_path(item, config)
     
     return img_path
 
-def on_image_select(evt: gr.SelectData, history, page, config, show_favs):
-    # ページネーションを考慮したインデックス計算
-    view_index = (page * GALLERY_PER_PAGE) + evt.index
-    
-    target_list = history
-    if show_favs:
-        target_list = [h for h in history if h.get("is_favorite", False)]
+ON_IMAGE_SELECT_OUTPUTS = 29
 
-    if not target_list or view_index >= len(target_list): 
+def on_image_select(evt: gr.SelectData, history, page, config, show_favs, query="", bulk_mode=False):
+    # 複数選択モード中のクリックは toggle_bulk_selection が扱うので、詳細表示は変えない
+    if bulk_mode:
+        return [gr.update()] * ON_IMAGE_SELECT_OUTPUTS
+
+    # ギャラリーと同じ方法で表示中のページを取得し、クリックされた位置のエントリを特定する
+    page_items = history_utils.get_history_page(history, page, GALLERY_PER_PAGE, show_favs, query)
+
+    if evt.index is None or evt.index >= len(page_items): 
         return [
-            -1, "", "", "", "", "", "", "", "", 
+            None, "", "", "", "", "", "", "", "", 
             "", # ckpt_name
             "", # lora1_name
             0.0, # lora1_strength
@@ -238,15 +419,12 @@ def on_image_select(evt: gr.SelectData, history, page, config, show_favs):
             gr.update(value=None) # history_preview
         ]
     
-    item = target_list[view_index]
+    item = page_items[evt.index]
     
-    # フィルタリングされている場合、元のhistoryリスト内でのインデックスを探す必要がある
-    # ここではオブジェクトの同一性(id)ではなく、内容の一致で探す（簡易的に）
-    # ただし、historyリスト内のオブジェクトそのものを参照しているはずなので、index()で検索可能
-    try:
-        real_index = history.index(item)
-    except ValueError:
-        real_index = -1 # Error case
+    # 以降の操作 (復元・削除・お気に入りなど) は位置ではなく ID で行う
+    # (SQLite から取得したエントリは別オブジェクトなので、ID で履歴側のエントリに差し替える)
+    entry_id = item.get("id")
+    item = history_utils.get_history_entry(history, entry_id) or item
 
     q = ", ".join(item.get("quality_tags", []))
     d = ", ".join(item.get("decade_tags", []))
@@ -271,7 +449,7 @@ def on_image_select(evt: gr.SelectData, history, page, config, show_favs):
     detail_lora_en = item.get("detail_lora_en", False)
     
     return [
-        real_index,
+        entry_id,
         q, d, p, m, s, a, c, 
         item.get("prompt", ""),
         item.get("neg_prompt", ""),
@@ -293,12 +471,12 @@ def on_image_select(evt: gr.SelectData, history, page, config, show_favs):
         gr.update(visible=True, value=original_image_path),
         gr.update(visible=True, value=fav_label, variant=fav_variant), # fav_btn
         gr.update(visible=True), # preview_accordion
-        gr.update(value=original_image_path) # history_preview
+        gr.update(value=get_original_preview_html(item)) # history_preview
     ]
 
-def restore_from_history_by_index(idx, history):
-    if idx < 0 or not history or idx >= len(history): return [gr.update()] * 45
-    s = history[idx]
+def restore_from_history(entry_id, history):
+    s = history_utils.get_history_entry(history, entry_id)
+    if s is None: return [gr.update()] * 47
     return (
         s["prompt"], s["neg_prompt"], s.get("trigger_first", False), s.get("enable_negpip", False), s["seed"], True, s["cfg"], s["steps"], s["width"], s["height"],
 
@@ -327,7 +505,9 @@ def restore_from_history_by_index(idx, history):
         float(s.get("lllite_str", 1.0)),
         float(s.get("lllite_start", 0.0)),
         float(s.get("lllite_end", 1.0)),
-        s.get("lllite_auto_res", True)
+        s.get("lllite_auto_res", True),
+        # バッチ生成の画像は同じシード・同じ枚数で再生成すると batch_index 番目として再現される
+        int(s.get("batch_size", 1))
     )
 def check_url_warning(config):
     current_url = config.get("comfy_url", "")
@@ -348,32 +528,32 @@ def check_url_warning(config):
         
     return gr.update(visible=False)
 
-def load_latest_history_on_load():
+def load_latest_history_on_load(request: gr.Request = None):
     current_cfg = config_utils.load_config() 
-    hist = history_utils.load_history(current_cfg)
+    hist = history_utils.get_shared_history(current_cfg)
     warn = check_url_warning(current_cfg)
-    # 初期ロード時はページ0
-    return hist, get_gallery_display_data(hist, current_cfg, 0, False), 0, get_page_label(0, hist, False), False, "❤ Favorites Only", warn
+    # 初期ロード時はページ0 (お気に入り・検索の絞り込みも解除する)
+    return hist, get_gallery_display_data(hist, current_cfg, 0, False, request=request), 0, get_page_label(0, hist, False), False, "❤ Favorites Only", warn, "", ""
 
-def on_history_tab_select(first_visit):
+def on_history_tab_select(first_visit, request: gr.Request = None):
     if not first_visit:
         # 2回目以降は何もしない（フラグはFalseのまま維持）
-        return gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), False, gr.update()
+        return gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), False, gr.update(), gr.update(), gr.update()
     
     # 初回のみリフレッシュを実行
-    hist, gallery, page, label, fav_state, fav_label, warn = load_latest_history_on_load()
-    return hist, gallery, page, label, fav_state, fav_label, False, warn
+    hist, gallery, page, label, fav_state, fav_label, warn, query, query_box = load_latest_history_on_load(request)
+    return hist, gallery, page, label, fav_state, fav_label, False, warn, query, query_box
 
 def load_history_state_only():
     """起動時用: 内部データだけ更新し、重いギャラリー描画はスキップする"""
     current_cfg = config_utils.load_config() 
-    hist = history_utils.load_history(current_cfg)
+    hist = history_utils.get_shared_history(current_cfg)
     # Galleryは gr.update() で「変更なし」を返す
     return hist, gr.update(), 0, get_page_label(0, hist, False)
 
-def handle_delete_entry(idx, history, page, show_favs):
-    if idx < 0: 
-        return (history, gr.update(), -1, 
+def handle_delete_entry(entry_id, history, page, show_favs, query="", request: gr.Request = None):
+    if not entry_id: 
+        return (history, gr.update(), None, 
                 "", "", "", "", "", "", "", "", "",
                 "", "", 0.0,
                 False, False, False,
@@ -388,10 +568,10 @@ def handle_delete_entry(idx, history, page, show_favs):
                 gr.update(value=None))
     
     current_config = config_utils.load_config()
-    new_h = history_utils.delete_history_entry(current_config, history, idx)
+    new_h = history_utils.delete_history_entry(current_config, history, entry_id)
     
     if not new_h:
-        return (new_h, [], -1, 
+        return (new_h, [], None, 
                 "", "", "", "", "", "", "", "", "",
                 "", "", 0.0,
                 False, False, False,
@@ -406,25 +586,15 @@ def handle_delete_entry(idx, history, page, show_favs):
                 gr.update(value=None))
     
     # 削除後にページ範囲外にならないよう調整
-    if show_favs:
-        target_list = [h for h in new_h if h.get("is_favorite", False)]
-    else:
-        target_list = new_h
-        
-    total = len(target_list)
-    max_page = max(0, (total - 1) // GALLERY_PER_PAGE)
+    max_page = get_max_page(new_h, show_favs, query)
     if page > max_page: page = max_page
     
-    new_gallery = get_gallery_display_data(new_h, current_config, page, show_favs)
-    new_label = get_page_label(page, new_h, show_favs)
+    new_gallery = get_gallery_display_data(new_h, current_config, page, show_favs, query, request)
+    new_label = get_page_label(page, new_h, show_favs, query)
 
     # 削除後は選択状態を解除する（複雑さを避けるため）
-    new_idx = idx
-    # if new_idx >= len(new_h):
-    #     new_idx = len(new_h) - 1
-    
     return (
-        new_h, new_gallery, -1, 
+        new_h, new_gallery, None, 
         "", "", "", "", "", "", "", "", "",
         "", "", 0.0,
         False, False, False,
@@ -447,7 +617,7 @@ def handle_delete_entry(idx, history, page, show_favs):
 def handle_clear_history(history):
     current_config = config_utils.load_config()
     history_utils.clear_history(current_config)
-    return [], [], "", gr.update(visible=False), gr.update(visible=False), gr.update(visible=True), 0, get_page_label(0, [], False), gr.update(visible=False, value=None), gr.update(visible=False), gr.update(visible=False), gr.update(value=None)
+    return history_utils.get_shared_history(current_config), [], "", gr.update(visible=False), gr.update(visible=False), gr.update(visible=True), 0, get_page_label(0, [], False), gr.update(visible=False, value=None), gr.update(visible=False), gr.update(visible=False), gr.update(value=None)
 
 def append_prompt(current, added):
     if not added: return current
@@ -458,36 +628,44 @@ def append_prompt(current, added):
     return text + ", " + added
 
 def restart_app(app_name):
+    # execv で置き換わると atexit が走らないので、書き込み待ちの履歴をここで書き切る
+    history_utils.flush_history_writes()
+    thumbnail_manager.shutdown()
     system_manager.restart_gradio(app_name)
 
 def backup_history_action(config):
     return f"✅ {history_utils.backup_history(config)[1]}"
 
-def next_page(page, history, config, show_favs):
-    if show_favs:
-        target_list = [h for h in history if h.get("is_favorite", False)]
-    else:
-        target_list = history
-        
-    total = len(target_list)
-    max_page = max(0, (total - 1) // GALLERY_PER_PAGE)
+def ingest_png_history_action(config):
+    """出力フォルダの PNG メタデータから、履歴に無い画像を取り込む (ギャラリーは定期更新で反映される)"""
+    try:
+        return history_ingest.ingest_png_metadata(config)[1]
+    except Exception as e:
+        traceback.print_exc()
+        return f"❌ Import failed: {e}"
+
+def next_page(page, history, config, show_favs, query="", selected=None, request: gr.Request = None):
+    max_page = get_max_page(history, show_favs, query)
     new_page = min(page + 1, max_page)
-    return new_page, get_gallery_display_data(history, config, new_page, show_favs), get_page_label(new_page, history, show_favs)
+    return new_page, get_gallery_display_data(history, config, new_page, show_favs, query, request, selected), get_page_label(new_page, history, show_favs, query)
 
-def prev_page(page, history, config, show_favs):
+def prev_page(page, history, config, show_favs, query="", selected=None, request: gr.Request = None):
     new_page = max(0, page - 1)
-    return new_page, get_gallery_display_data(history, config, new_page, show_favs), get_page_label(new_page, history, show_favs)
+    return new_page, get_gallery_display_data(history, config, new_page, show_favs, query, request, selected), get_page_label(new_page, history, show_favs, query)
 
-def toggle_favorite(idx, history, config, show_favs, page):
-    if idx < 0 or idx >= len(history):
+def toggle_favorite(entry_id, history, config, show_favs, page, query="", request: gr.Request = None):
+    history = history_utils.as_history_list(history)
+    item = history.get_entry(entry_id)
+    if item is None:
         return gr.update(), history, gr.update(), gr.update()
     
-    item = history[idx]
     new_state = not item.get("is_favorite", False)
-    item["is_favorite"] = new_state
+    # お気に入りの索引も合わせて更新する
+    history.mark_favorite(entry_id, new_state)
     
-    # 保存
-    history_utils.save_history_json(config, history)
+    # 保存 (ログに1行追記するだけ。ID のない古いデータのみ全体を書き直す)
+    if not history_utils.set_favorite(config, item, new_state):
+        history_utils.save_history_json(config, history)
     
     # UI更新用
     fav_label = "❤ Liked" if new_state else "🤍 Like"
@@ -497,17 +675,130 @@ def toggle_favorite(idx, history, config, show_favs, page):
     # ただし、即座に消えると操作しづらい場合もあるが、整合性のため更新する
     if show_favs and not new_state:
         # ページ範囲チェック
-        target_list = [h for h in history if h.get("is_favorite", False)]
-        total = len(target_list)
-        max_page = max(0, (total - 1) // GALLERY_PER_PAGE)
+        max_page = get_max_page(history, show_favs, query)
         if page > max_page: page = max_page
         
-        return gr.update(value=fav_label, variant=fav_variant), history, get_gallery_display_data(history, config, page, show_favs), get_page_label(page, history, show_favs)
+        return gr.update(value=fav_label, variant=fav_variant), history, get_gallery_display_data(history, config, page, show_favs, query, request), get_page_label(page, history, show_favs, query)
     
     return gr.update(value=fav_label, variant=fav_variant), history, gr.update(), gr.update()
 
-def toggle_fav_filter(current_state, history, config):
+def toggle_fav_filter(current_state, history, config, query="", selected=None, request: gr.Request = None):
     new_state = not current_state
     btn_label = "❤ Favorites Only" if not new_state else "Show All"
     # フィルタ切り替え時はページ0に戻す
-    return new_state, get_gallery_display_data(history, config, 0, new_state), 0, get_page_label(0, history, new_state), btn_label
+    return new_state, get_gallery_display_data(history, config, 0, new_state, query, request, selected), 0, get_page_label(0, history, new_state, query), btn_label
+
+def search_history(query, history, config, show_favs, selected=None, request: gr.Request = None):
+    """履歴をプロンプト (prompt / neg_prompt / artist_tags / custom_tags) で検索する。空欄なら検索を解除"""
+    query = (query or "").strip()
+    return query, get_gallery_display_data(history, config, 0, show_favs, query, request, selected), 0, get_page_label(0, history, show_favs, query)
+
+# --- 複数選択と一括操作 ---
+
+def get_selection_label(selected):
+    return f"☑ {len(selected or [])} selected"
+
+def toggle_bulk_mode(enabled, selected, history, config, page, show_favs, query="", request: gr.Request = None):
+    """
+    複数選択モードの切り替え。モードを抜けると選択を解除し、一括操作のボタンはモード中だけ表示する。
+    (Duplicates から選択済みの状態でモードに入る場合もあるので、入る時は選択をそのまま使う)
+    """
+    selected = list(selected or []) if enabled else []
+    return (selected, get_selection_label(selected), gr.update(visible=enabled), gr.update(visible=False),
+            get_gallery_display_data(history, config, page, show_favs, query, request, selected))
+
+def toggle_bulk_selection(evt: gr.SelectData, enabled, selected, history, page, config, show_favs, query="", request: gr.Request = None):
+    """複数選択モード中にクリックされたエントリを選択に追加・解除する"""
+    if not enabled:
+        return gr.update(), gr.update(), gr.update()
+    page_items = history_utils.get_history_page(history, page, GALLERY_PER_PAGE, show_favs, query)
+    if evt.index is None or evt.index >= len(page_items):
+        return gr.update(), gr.update(), gr.update()
+    entry_id = page_items[evt.index].get("id")
+    selected = list(selected or [])
+    if entry_id in selected:
+        selected.remove(entry_id)
+    elif entry_id:
+        selected.append(entry_id)
+    return selected, get_selection_label(selected), get_gallery_display_data(history, config, page, show_favs, query, request, selected)
+
+def select_page_entries(selected, history, config, page, show_favs, query="", request: gr.Request = None):
+    """表示中のページのエントリをすべて選択に加える"""
+    page_items = history_utils.get_history_page(history, page, GALLERY_PER_PAGE, show_favs, query)
+    selected = list(dict.fromkeys(list(selected or []) + [item["id"] for item in page_items if item.get("id")]))
+    return selected, get_selection_label(selected), get_gallery_display_data(history, config, page, show_favs, query, request, selected)
+
+def clear_bulk_selection(history, config, page, show_favs, query="", request: gr.Request = None):
+    return [], get_selection_label([]), get_gallery_display_data(history, config, page, show_favs, query, request)
+
+def bulk_set_favorite(value, selected, history, config, page, show_favs, query="", request=None):
+    """選択したエントリをまとめてお気に入りに登録・解除する (保存は1回)"""
+    history = history_utils.as_history_list(history)
+    if not selected:
+        return history, gr.update(), gr.update(), "⚠️ No entries selected."
+    changed = history_utils.set_favorites(config, history, selected, value)
+    page = min(page, get_max_page(history, show_favs, query))
+    action = "favorited" if value else "unfavorited"
+    return (history, get_gallery_display_data(history, config, page, show_favs, query, request, selected),
+            get_page_label(page, history, show_favs, query), f"✅ {changed} entries {action}.")
+
+def bulk_favorite(selected, history, config, page, show_favs, query="", request: gr.Request = None):
+    return bulk_set_favorite(True, selected, history, config, page, show_favs, query, request)
+
+def bulk_unfavorite(selected, history, config, page, show_favs, query="", request: gr.Request = None):
+    return bulk_set_favorite(False, selected, history, config, page, show_favs, query, request)
+
+def bulk_delete_entries(selected, history, page, show_favs, query="", request: gr.Request = None):
+    """選択したエントリをまとめて削除する (履歴の保存は1回、ファイルの削除はバックグラウンド)"""
+    if not selected:
+        return history, gr.update(), page, gr.update(), [], get_selection_label([]), "⚠️ No entries selected.", gr.update(visible=False)
+    current_config = config_utils.load_config()
+    new_h = history_utils.delete_history_entries(current_config, history, selected)
+    page = min(page, get_max_page(new_h, show_favs, query))
+    return (new_h, get_gallery_display_data(new_h, current_config, page, show_favs, query, request), page,
+            get_page_label(page, new_h, show_favs, query), [], get_selection_label([]),
+            f"🗑️ {len(selected)} entries deleted.", gr.update(visible=False))
+
+def bulk_export_entries(selected):
+    """選択したエントリの画像と設定を ZIP でダウンロードするリンクを表示する (ZIP は app.py の /export がその場で作る)"""
+    if not selected:
+        return gr.update(visible=False, value=""), "⚠️ No entries selected."
+    token = history_export.create_export_token(selected)
+    link = f'<a href="/export/{token}" download>📦 Download ZIP ({len(selected)} entries)</a>'
+    return gr.update(visible=True, value=link), f"📦 Export of {len(selected)} entries is ready."
+
+# --- 近似重複 (Duplicates) ---
+
+DUPLICATES_GALLERY_LIMIT = 120 # Duplicates に並べる画像の最大数 (件数の多いグループから)
+
+def find_duplicates(history, config, threshold, request: gr.Request = None):
+    """近似重複のグループを探して並べ、削除候補 (各グループで残すもの以外) の ID を返す"""
+    history = history_utils.as_history_list(history)
+    try:
+        groups = history_dedup.find_duplicate_groups(config, history, threshold)
+    except Exception as e:
+        traceback.print_exc()
+        return [], f"❌ Duplicate search failed: {e}", gr.update(visible=False, value=None), gr.update(visible=False)
+    if not groups:
+        return [], "✅ No near-duplicates found.", gr.update(visible=False, value=None), gr.update(visible=False)
+
+    redundant = history_dedup.pick_redundant(groups)
+    redundant_ids = set(redundant)
+    base_url = get_media_base_url(request)
+    gallery = []
+    for number, group in enumerate(groups, 1):
+        for item in group:
+            if len(gallery) >= DUPLICATES_GALLERY_LIMIT:
+                break
+            mark = "" if item["id"] in redundant_ids else " · keep"
+            gallery.append((get_thumbnail_value(item, config, base_url), f"Group {number}{mark}"))
+    summary = f"🧬 {len(groups)} groups ({sum(len(g) for g in groups)} images). {len(redundant)} can be removed, keeping favorites or the newest of each group."
+    return redundant, summary, gr.update(visible=True, value=gallery), gr.update(visible=bool(redundant))
+
+def select_duplicates(duplicate_ids, history, config, page, show_favs, query="", request: gr.Request = None):
+    """削除候補を複数選択に入れ、一括操作 (Delete Selected) で消せるようにする"""
+    history = history_utils.as_history_list(history)
+    selected = [i for i in duplicate_ids or [] if history.get_entry(i) is not None]
+    return (selected, True, gr.update(visible=True), get_selection_label(selected),
+            get_gallery_display_data(history, config, page, show_favs, query, request, selected),
+            f"🧬 {len(selected)} duplicates selected. Review them and press 🗑️ Delete Selected.")
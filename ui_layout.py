@@ -22,7 +22,7 @@ def get_lora_list(config):
     # 1. API経由での取得を試みる
     if comfy_url:
         try:
-            response = requests.get(f"{comfy_url}/models/loras", timeout=2)
+            response = comfy_utils.http_get(f"{comfy_url}/models/loras", timeout=2)
             response.raise_for_status()
             loras.extend(response.json())
             print("✅ LoRA list fetched from ComfyUI API.")
@@ -53,7 +53,7 @@ def get_checkpoint_list(config):
 
     if comfy_url:
         try:
-            response = requests.get(f"{comfy_url}/models/checkpoints", timeout=2)
+            response = comfy_utils.http_get(f"{comfy_url}/models/checkpoints", timeout=2)
             response.raise_for_status()
             ckpts.extend(response.json())
             print("✅ Checkpoint list fetched from ComfyUI API.")
@@ -81,7 +81,7 @@ def get_controlnet_list(config):
 
     if comfy_url:
         try:
-            response = requests.get(f"{comfy_url}/models/controlnet", timeout=2)
+            response = comfy_utils.http_get(f"{comfy_url}/models/controlnet", timeout=2)
             response.raise_for_status()
             cn_models.extend(response.json())
         except requests.exceptions.RequestException as e:
@@ -236,11 +236,18 @@ def create_ui(config):
         gr.Markdown(f"# 🎨 {app_name} <small>v{version}</small>")
         
         # 起動時点の履歴（プレースホルダー）
-        raw_history_startup = history_utils.load_history(config)
-        history_state = gr.State(raw_history_startup)
-        selected_index = gr.State(-1)
+        # 履歴はプロセス全体で1つを共有し、各セッションの State はその参照だけを持つ
+        # (gr.State の初期値はセッションごとに複製されるので None にしておき、ページ読み込み時に参照を入れる)
+        raw_history_startup = history_utils.get_shared_history(config)
+        history_state = gr.State(None)
+        selected_id = gr.State(None) # 選択中の履歴エントリの ID
+        bulk_selection_state = gr.State([]) # 複数選択モードで選んだ履歴エントリの ID のリスト
+        duplicate_ids_state = gr.State([]) # 近似重複のうち削除候補のエントリの ID のリスト
         page_state = gr.State(0) # 現在のページ番号 (0始まり)
         show_favs_state = gr.State(False) # お気に入りフィルタ状態
+        search_state = gr.State("") # 履歴のプロンプト検索語
+        thumb_tick_state = gr.State(0.0) # サムネイル更新を最後に確認した時刻
+        history_cursor_state = gr.State(-1) # このセッションが最後に表示した共有履歴の version
         history_first_visit = gr.State(True) # 初回訪問フラグ
         
         # Handlers 用の State
@@ -310,6 +317,7 @@ def create_ui(config):
                         image_output = gr.Image(label="Result", format="png")
                         status_output = gr.Textbox(label="Status", interactive=False)
                         generate_button_side = gr.Button("Generate Image", variant="primary")
+                        stop_generate_btn = gr.Button("⏹️ Stop", variant="stop", size="sm")
                         with gr.Row():
                             seed_input = gr.Number(label="Seed", value=0, precision=0, scale=3)
                             randomize_seed = gr.Checkbox(label="Randomize Seed", value=True, scale=1)
@@ -368,6 +376,7 @@ def create_ui(config):
                                 steps_slider = gr.Slider(label="Steps", minimum=1, maximum=100, value=default_steps, step=1)
                             with gr.Row():
                                 width_slider = gr.Slider(label="Width", minimum=512, maximum=2048, value=default_w, step=64); height_slider = gr.Slider(label="Height", minimum=512, maximum=2048, value=default_h, step=64)
+                            batch_size_slider = gr.Slider(label="Batch Size", minimum=1, maximum=8, value=1, step=1, info="1回のジョブで生成する枚数 (全画像が履歴に保存されます)")
                         with gr.Row():
                             refresh_btn_adv = gr.Button("🔄 Status"); launch_btn_adv = gr.Button("🚀 Launch ComfyUI", variant="primary")
                         restart_btn_adv = gr.Button(f"♻️ Restart App", variant="secondary")
@@ -379,6 +388,7 @@ def create_ui(config):
                     with gr.Row():
                         start_auto_btn = gr.Button("▶️ Start Auto Gen", variant="primary")
                         stop_auto_btn = gr.Button("⏹️ Stop", variant="stop")
+                    auto_inflight = gr.Slider(label="In-flight Jobs", minimum=1, maximum=4, step=1, value=config.get("auto_gen_inflight", 2), info="ComfyUIのキューに同時に積んでおくジョブ数 (2以上でダウンロード・保存中もGPUを止めません)")
                     auto_status = gr.Markdown("**Status:** Ready")
                 
                 auto_gallery = gr.Gallery(show_label=False, columns=1, height="auto", object_fit="contain")
@@ -393,6 +403,37 @@ def create_ui(config):
                     page_label = gr.Textbox(value="Page 1 / 1", interactive=False, show_label=False, scale=2, text_align="center")
                     next_btn = gr.Button("Next ▶️", scale=1)
                     fav_filter_btn = gr.Button("❤ Favorites Only", scale=1)
+                with gr.Row(variant="compact"):
+                    history_search_box = gr.Textbox(placeholder="🔍 Search prompts (Enter)", show_label=False, scale=4)
+                    history_search_btn = gr.Button("Search", scale=1)
+                thumbnail_progress = gr.Markdown("")
+                history_timer = gr.Timer(2)
+                
+                # 複数選択と一括操作 (モード中はギャラリーのクリックで選択を切り替える)
+                bulk_mode_checkbox = gr.Checkbox(label="☑ Multi-select", value=False)
+                with gr.Row(variant="compact", visible=False) as bulk_actions_row:
+                    bulk_selection_label = gr.Markdown("☑ 0 selected")
+                    bulk_select_page_btn = gr.Button("Select Page", size="sm", scale=1)
+                    bulk_clear_btn = gr.Button("Clear Selection", size="sm", scale=1)
+                    bulk_fav_btn = gr.Button("❤ Favorite", size="sm", scale=1)
+                    bulk_unfav_btn = gr.Button("🤍 Unfavorite", size="sm", scale=1)
+                    bulk_export_btn = gr.Button("📦 Export", size="sm", scale=1)
+                    bulk_delete_btn = gr.Button("🗑️ Delete Selected", variant="stop", size="sm", scale=1)
+                with gr.Row(visible=False) as bulk_confirm_row:
+                    gr.Markdown("⚠️ **Delete selected entries and their images?**")
+                    bulk_yes_delete_btn = gr.Button("Yes", variant="stop", size="sm", scale=1)
+                    bulk_no_delete_btn = gr.Button("No", size="sm", scale=1)
+                bulk_status = gr.Markdown("")
+                bulk_export_link = gr.HTML(visible=False) # /export/{token} へのダウンロードリンク
+                
+                # 近似重複 (サムネイルの dHash で探し、削除候補を複数選択に入れる)
+                with gr.Accordion("🧬 Duplicates", open=False):
+                    with gr.Row(variant="compact"):
+                        duplicate_threshold_slider = gr.Slider(0, 7, value=config.get("duplicate_threshold", 5), step=1, label="Max Hamming Distance", scale=2)
+                        find_duplicates_btn = gr.Button("Find Duplicates", size="sm", scale=1)
+                        select_duplicates_btn = gr.Button("Select Duplicates for Deletion", variant="stop", size="sm", scale=1, visible=False)
+                    duplicates_summary = gr.Markdown("")
+                    duplicates_gallery = gr.Gallery(show_label=False, columns=6, height="auto", visible=False)
                 
                 # 初期値としてサーバー起動時の最新データをセット（ページネーション適用済み）
                 with gr.Row():
@@ -400,7 +441,8 @@ def create_ui(config):
                         history_gallery = gr.Gallery(label="Past Generations", columns=4, height="auto", value=ui_handlers.get_gallery_display_data(raw_history_startup, config, 0))
                     with gr.Column(scale=1):
                         with gr.Accordion("Original Image Preview", open=True, visible=False) as preview_accordion:
-                            history_preview = gr.Image(show_label=False, interactive=False)
+                            # /original/{id} を <img> で直接読み込む (Gradio のキャッシュにコピーしない)
+                            history_preview = gr.HTML()
                 
                 with gr.Accordion("Selected Tag Groups", open=False, visible=False) as tag_accordion:
                     h_q_tags = gr.Textbox(label="Quality Tags", interactive=False, lines=2) 
@@ -446,6 +488,7 @@ def create_ui(config):
                 with gr.Row():
                     clear_history_btn = gr.Button("Clear All History", variant="stop", size="sm")
                     backup_history_btn = gr.Button("Backup History", variant="secondary", size="sm")
+                    ingest_png_btn = gr.Button("Import from PNG Metadata", variant="secondary", size="sm")
                 clear_history_notice = gr.Markdown("⚠️ **本当に履歴を消しますか？消去時にバックアップが必ずできます。画像は消えません**", visible=False)
                 with gr.Row(visible=False) as confirm_clear_row:
                     yes_clear_btn = gr.Button("Yes, Clear All", variant="stop", size="sm")
@@ -596,7 +639,7 @@ def create_ui(config):
         demo.load(fn=ui_handlers.load_history_state_only, inputs=None, outputs=[history_state, history_gallery, page_state, page_label])
         
         # 手動リフレッシュボタン
-        refresh_history_btn.click(fn=ui_handlers.load_latest_history_on_load, inputs=None, outputs=[history_state, history_gallery, page_state, page_label, show_favs_state, fav_filter_btn, history_url_warning])
+        refresh_history_btn.click(fn=ui_handlers.load_latest_history_on_load, inputs=None, outputs=[history_state, history_gallery, page_state, page_label, show_favs_state, fav_filter_btn, history_url_warning, search_state, history_search_box])
         
         refresh_btn_adv.click(fn=ui_handlers.check_server_status, inputs=[url_in], outputs=[status_output])
         launch_btn_adv.click(fn=ui_handlers.launch_server, inputs=[bat_in, url_in], outputs=[status_output])
@@ -625,10 +668,12 @@ def create_ui(config):
             inputs=[prompt_input, neg_input, trigger_first, enable_negpip, seed_input, randomize_seed, cfg_slider, steps_slider, width_slider, height_slider, sampler_dropdown, history_state, ckpt_name, 
                     l1_name, l1_str, turbo_lora_en, highres_lora_en, detail_lora_en, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str, quality_tags_input, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, decade_tags_input, period_tags_input, meta_tags_input, safety_tags_input, artist_tags_input, artist_random_en, artist_random_num, artist_tags_state,
                     custom_tags_input, url_in, config_state, workflow_file_state,
-                    lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res], 
+                    lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res, batch_size_slider], 
             outputs=[image_output, status_output, history_state, history_gallery, page_state, page_label]
         )
-        generate_button.click(**predict_params); generate_button_side.click(**predict_params)
+        predict_event = generate_button.click(**predict_params); predict_event_side = generate_button_side.click(**predict_params)
+        # プレビューを見て不要と判断した生成を途中で止める (ComfyUI 側のジョブも中止される)
+        stop_generate_btn.click(fn=ui_handlers.stop_predict, inputs=None, outputs=[status_output], cancels=[predict_event, predict_event_side])
         
         # 連続生成 (Auto Gen) イベント
         auto_gen_event = start_auto_btn.click(
@@ -636,22 +681,24 @@ def create_ui(config):
             inputs=[prompt_input, neg_input, trigger_first, enable_negpip, seed_input, randomize_seed, cfg_slider, steps_slider, width_slider, height_slider, sampler_dropdown, history_state, ckpt_name, 
                     l1_name, l1_str, turbo_lora_en, highres_lora_en, detail_lora_en, l2_name, l2_str, l3_name, l3_str, l4_name, l4_str, l5_name, l5_str, quality_tags_input, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val, decade_tags_input, period_tags_input, meta_tags_input, safety_tags_input, artist_tags_input, artist_random_en, artist_random_num, artist_tags_state,
                     custom_tags_input, url_in, config_state, workflow_file_state,
-                    lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res],
+                    lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res, batch_size_slider, auto_inflight],
             outputs=[auto_gallery, auto_status, history_state]
         )
 
         stop_auto_btn.click(
-            fn=lambda: gr.update(value="**Status:** ⏹️ Stopped"),
+            fn=ui_handlers.stop_generation,
             inputs=None,
             outputs=[auto_status],
-            cancels=[auto_gen_event]  # 無限ループのジェネレーターを強制停止する
+            cancels=[auto_gen_event]  # 無限ループのジェネレーターを強制停止し、ComfyUI 側のジョブも中止する
         )
+        # タブを閉じた場合も、誰も見ない画像の生成を ComfyUI に続けさせない
+        demo.unload(ui_handlers.cancel_session_jobs)
 
         history_gallery.select(
             fn=ui_handlers.on_image_select, 
-            inputs=[history_state, page_state, config_state, show_favs_state], 
+            inputs=[history_state, page_state, config_state, show_favs_state, search_state, bulk_mode_checkbox], 
             outputs=[
-                selected_index, 
+                selected_id, 
                 h_q_tags, h_d_tags, h_p_tags, h_m_tags, h_s_tags, h_a_tags, h_c_tags, 
                 selected_prompt_preview, h_neg_prompt,
                 h_ckpt_name,
@@ -673,20 +720,20 @@ def create_ui(config):
         )
         
         # Restore時にLoRA情報も復元する
-        restore_btn.click(fn=ui_handlers.restore_from_history_by_index, inputs=[selected_index, history_state],
+        restore_btn.click(fn=ui_handlers.restore_from_history, inputs=[selected_id, history_state],
             outputs=[prompt_input, neg_input, trigger_first, enable_negpip, seed_input, randomize_seed, cfg_slider, steps_slider, width_slider, height_slider,
                      sampler_dropdown, quality_tags_input, y1_en, y1_val, y2_en, y2_val, y3_en, y3_val,
                      decade_tags_input, period_tags_input, meta_tags_input, safety_tags_input, artist_tags_input, custom_tags_input, tabs, 
                      ckpt_name, l1_name, l1_str, l2_name, l2_str, l3_name, l3_str, turbo_lora_en, highres_lora_en, detail_lora_en, l4_name, l4_str, l5_name, l5_str,
-                     lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res])
+                     lllite_en, lllite_model, lllite_img, lllite_str, lllite_start, lllite_end, lllite_auto_res, batch_size_slider])
 
         delete_entry_btn.click(fn=lambda: (gr.update(visible=False), gr.update(visible=True)), outputs=[delete_entry_btn, confirm_delete_row])
         no_delete_btn.click(fn=lambda: (gr.update(visible=True), gr.update(visible=False)), outputs=[delete_entry_btn, confirm_delete_row])
 
         yes_delete_btn.click(fn=ui_handlers.handle_delete_entry, 
-            inputs=[selected_index, history_state, page_state, show_favs_state], 
+            inputs=[selected_id, history_state, page_state, show_favs_state, search_state], 
             outputs=[
-                history_state, history_gallery, selected_index, 
+                history_state, history_gallery, selected_id, 
                 h_q_tags, h_d_tags, h_p_tags, h_m_tags, h_s_tags, h_a_tags, h_c_tags, 
                 selected_prompt_preview, h_neg_prompt,
                 h_ckpt_name,
@@ -708,7 +755,7 @@ def create_ui(config):
             outputs=[tabs]
         ).then(
             fn=ui_handlers.send_to_chat_action,
-            inputs=[selected_index, history_state, config_state],
+            inputs=[selected_id, history_state, config_state],
             outputs=[chat_img_input, chat_msg_input]
         )
 
@@ -719,7 +766,7 @@ def create_ui(config):
             outputs=[tabs]
         ).then(
             fn=ui_handlers.send_to_lllite_action,
-            inputs=[selected_index, history_state, config_state],
+            inputs=[selected_id, history_state, config_state],
             outputs=[lllite_img]
         )
 
@@ -731,6 +778,7 @@ def create_ui(config):
                                 outputs=[history_state, history_gallery, selected_prompt_preview, clear_history_notice, confirm_clear_row, clear_history_btn, page_state, page_label, download_original_file, fav_btn, preview_accordion, history_preview])
         
         backup_history_btn.click(fn=lambda: gr.update(value=ui_handlers.backup_history_action(config)), outputs=[history_msg])
+        ingest_png_btn.click(fn=ui_handlers.ingest_png_history_action, inputs=[config_state], outputs=[history_msg])
 
         save_btn.click(fn=ui_handlers.handle_save_settings, 
             inputs=[url_in, bat_in, backup_in, real_out_in, workflow_file_in, q_tags_edit, d_tags_edit, t_tags_edit, m_tags_edit, s_tags_edit, c_tags_edit, tags_path_in, res_editor, cfg_steps_editor, neg_edit, gr.State(ext_link_name), gr.State(ext_link_url), port_in], 
@@ -750,23 +798,61 @@ def create_ui(config):
         restart_btn.click(fn=lambda: ui_handlers.restart_app(app_name), js=restart_js)
         
         # ページネーションイベント
-        prev_btn.click(fn=ui_handlers.prev_page, inputs=[page_state, history_state, config_state, show_favs_state], outputs=[page_state, history_gallery, page_label])
-        next_btn.click(fn=ui_handlers.next_page, inputs=[page_state, history_state, config_state, show_favs_state], outputs=[page_state, history_gallery, page_label])
+        prev_btn.click(fn=ui_handlers.prev_page, inputs=[page_state, history_state, config_state, show_favs_state, search_state, bulk_selection_state], outputs=[page_state, history_gallery, page_label])
+        next_btn.click(fn=ui_handlers.next_page, inputs=[page_state, history_state, config_state, show_favs_state, search_state, bulk_selection_state], outputs=[page_state, history_gallery, page_label])
+        
+        # プロンプト検索 (Enter またはボタン。空欄で解除)
+        search_params = dict(fn=ui_handlers.search_history, inputs=[history_search_box, history_state, config_state, show_favs_state, bulk_selection_state], outputs=[search_state, history_gallery, page_state, page_label])
+        history_search_box.submit(**search_params); history_search_btn.click(**search_params)
+
+        # 他のセッションでの履歴の変更・バックグラウンドで作成したサムネイルの反映と進捗表示
+        history_timer.tick(fn=ui_handlers.poll_history_updates,
+                           inputs=[history_state, config_state, page_state, show_favs_state, search_state, thumb_tick_state, history_cursor_state, bulk_selection_state],
+                           outputs=[history_gallery, page_state, page_label, thumbnail_progress, thumb_tick_state, history_cursor_state], show_progress="hidden")
 
         # お気に入り機能イベント
         fav_btn.click(fn=ui_handlers.toggle_favorite, 
-                      inputs=[selected_index, history_state, config_state, show_favs_state, page_state], 
+                      inputs=[selected_id, history_state, config_state, show_favs_state, page_state, search_state], 
                       outputs=[fav_btn, history_state, history_gallery, page_label])
         
         fav_filter_btn.click(fn=ui_handlers.toggle_fav_filter,
-                             inputs=[show_favs_state, history_state, config_state],
+                             inputs=[show_favs_state, history_state, config_state, search_state, bulk_selection_state],
                              outputs=[show_favs_state, history_gallery, page_state, page_label, fav_filter_btn])
 
+        # 複数選択と一括操作イベント
+        bulk_view_inputs = [history_state, config_state, page_state, show_favs_state, search_state]
+        bulk_mode_checkbox.change(fn=ui_handlers.toggle_bulk_mode, inputs=[bulk_mode_checkbox, bulk_selection_state] + bulk_view_inputs,
+                                  outputs=[bulk_selection_state, bulk_selection_label, bulk_actions_row, bulk_confirm_row, history_gallery])
+        history_gallery.select(fn=ui_handlers.toggle_bulk_selection,
+                               inputs=[bulk_mode_checkbox, bulk_selection_state, history_state, page_state, config_state, show_favs_state, search_state],
+                               outputs=[bulk_selection_state, bulk_selection_label, history_gallery])
+        bulk_select_page_btn.click(fn=ui_handlers.select_page_entries, inputs=[bulk_selection_state] + bulk_view_inputs,
+                                   outputs=[bulk_selection_state, bulk_selection_label, history_gallery])
+        bulk_clear_btn.click(fn=ui_handlers.clear_bulk_selection, inputs=bulk_view_inputs,
+                             outputs=[bulk_selection_state, bulk_selection_label, history_gallery])
+        bulk_fav_btn.click(fn=ui_handlers.bulk_favorite, inputs=[bulk_selection_state] + bulk_view_inputs,
+                           outputs=[history_state, history_gallery, page_label, bulk_status])
+        bulk_unfav_btn.click(fn=ui_handlers.bulk_unfavorite, inputs=[bulk_selection_state] + bulk_view_inputs,
+                             outputs=[history_state, history_gallery, page_label, bulk_status])
+        bulk_export_btn.click(fn=ui_handlers.bulk_export_entries, inputs=[bulk_selection_state],
+                              outputs=[bulk_export_link, bulk_status])
+        bulk_delete_btn.click(fn=lambda: gr.update(visible=True), outputs=[bulk_confirm_row])
+        bulk_no_delete_btn.click(fn=lambda: gr.update(visible=False), outputs=[bulk_confirm_row])
+        bulk_yes_delete_btn.click(fn=ui_handlers.bulk_delete_entries,
+                                  inputs=[bulk_selection_state, history_state, page_state, show_favs_state, search_state],
+                                  outputs=[history_state, history_gallery, page_state, page_label, bulk_selection_state, bulk_selection_label, bulk_status, bulk_confirm_row])
+
+        # 近似重複イベント
+        find_duplicates_btn.click(fn=ui_handlers.find_duplicates, inputs=[history_state, config_state, duplicate_threshold_slider],
+                                  outputs=[duplicate_ids_state, duplicates_summary, duplicates_gallery, select_duplicates_btn])
+        select_duplicates_btn.click(fn=ui_handlers.select_duplicates, inputs=[duplicate_ids_state] + bulk_view_inputs,
+                                    outputs=[bulk_selection_state, bulk_mode_checkbox, bulk_actions_row, bulk_selection_label, history_gallery, bulk_status])
+
         # Historyタブ初回切り替え時の自動リフレッシュ
         history_tab.select(
             fn=ui_handlers.on_history_tab_select,
             inputs=[history_first_visit],
-            outputs=[history_state, history_gallery, page_state, page_label, show_favs_state, fav_filter_btn, history_first_visit, history_url_warning]
+            outputs=[history_state, history_gallery, page_state, page_label, show_favs_state, fav_filter_btn, history_first_visit, history_url_warning, search_state, history_search_box]
         )
 
         # 【追加】GenerateタブのRestart Appボタンにもイベントを紐付け